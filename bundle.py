@@ -0,0 +1,21 @@
+'''
+PyLib - Datalayer Python API
+
+Write all the schemas of a version to a single bundle file, which is
+loaded at once with JSONSchemaObject.preload_schemas
+
+    python bundle.py file://schema latest schema/latest.bundle
+'''
+import sys
+from schema import JSONSchemaObject
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) != 4:
+        print("usage: python bundle.py <schemas uri> <version> <bundle file>")
+        sys.exit(1)
+
+    JSONSchemaObject.set_schemas_location(sys.argv[1], sys.argv[2])
+    names = JSONSchemaObject.bundle_schemas(sys.argv[3])
+    print("{} schemas written to {}".format(len(names), sys.argv[3]))
@@ -1,4 +1,11 @@
-from schema import JSONSchemaObject, JSONSchemaArray
+import asyncio
+from collections import OrderedDict
+from itertools import islice
+from json import dumps
+from schema import JSONSchemaObject, JSONSchemaArray, JSONSchemaException, JSONSchemaPlan, JSONSchemaQuery, \
+    JSONSchemaRecord
+from threading import Lock
+import time
 import uuid
 
 
@@ -19,10 +26,24 @@ class DatabaseDriver(object):
     def find_by_ref(self, ref:str):
         raise NotImplementedError()
 
+    def find_by_refs(self, refs: list):
+        # the json of every ref (or None) in the same order, drivers should
+        # fetch them at once
+        return [self.find_by_ref(ref) for ref in refs]
+
     def find_id_by(self, idx:str, value:str, version:str):
         raise NotImplementedError()
 
+    # drivers which can't change the stored documents in place get the
+    # whole json of the changed objects
+    partial_writes = True
+
     def save(self, obj_list: list, indexed_attrs: list):
+        # obj_list has [schema path, id, json] or, for objects loaded or
+        # saved before and drivers with partial_writes, [schema path, id,
+        # None, changes] where changes are (operation, path, json) tuples,
+        # operation is "set" or "append" and path a tuple of attr names and
+        # array indexes
         raise NotImplementedError()
 
 
@@ -65,125 +86,329 @@ class NullDriver(DatabaseDriver):
         return ids
 
 
+class DatabaseCache(object):
+    """
+    A LRU cache of the stored documents by ref, shared by the layers of a
+    process. At most size documents are kept for ttl seconds (or until
+    written by a layer using the cache), every read gets its own copy
+    """
+
+    def __init__(self, size: int = 10000, ttl: float = None):
+        self._size = size
+        self._ttl = ttl
+        self._documents = OrderedDict()
+        self._lock = Lock()
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def generation(self):
+        # changes on every invalidation, the documents read before it are
+        # not cached since they may be stale
+        return self._generation
+
+    def get_many(self, refs: list):
+
+        # the json of the cached refs
+        result = {}
+        now = time.monotonic()
+        with self._lock:
+            for ref in refs:
+                entry = self._documents.get(ref)
+                if entry is not None and entry[0] is not None and entry[0] < now:
+                    del self._documents[ref]
+                    entry = None
+
+                if entry is None:
+                    self._misses += 1
+                    continue
+
+                self._hits += 1
+                self._documents.move_to_end(ref)
+                result[ref] = entry[1]
+
+        decode = JSONSchemaObject._decoder.decode
+        return {ref: decode(data) for ref, data in result.items()}
+
+    def put_many(self, refs: list, documents: list, generation: int):
+
+        # the documents are kept encoded, missing documents are not cached
+        entries = [(ref, dumps(json)) for ref, json in zip(refs, documents) if json is not None]
+        expires = None if self._ttl is None else time.monotonic() + self._ttl
+
+        with self._lock:
+            if generation != self._generation:
+                return
+
+            for ref, data in entries:
+                self._documents[ref] = (expires, data)
+                self._documents.move_to_end(ref)
+
+            while len(self._documents) > self._size:
+                self._documents.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, refs: list):
+        with self._lock:
+            self._generation += 1
+            for ref in refs:
+                self._documents.pop(ref, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._documents.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self._hits, "misses": self._misses,
+                "evictions": self._evictions, "size": len(self._documents)}
+
+
 class DatabaseLayer(object):
 
     @staticmethod
-    def _extract_relations(obj: JSONSchemaObject):
+    def _extract_relations(obj: JSONSchemaObject, full: bool = False):
 
-        # result is always a tuple (last schema path, last _id, list of objects to save, indexed_attrs )
+        # result is always a tuple (last schema path, last _id, list of objects to save, indexed_attrs,
+        # list of (ref, object) of the objects with _id )
         schema_path = None
         last_id = None
         d = {}
         obj_list = []
         indexed_attrs = []
+        objects = []
 
         # Check if this object has an _id field,
         # if it have then means it is probably related to
         # something
-        if "_id" in obj.__dict__["__attrs__"]:
+        if "_id" in obj.__attrs__:
 
             # If _id is empty means we must add an ID, we are most probably
             # saving the object for the first time
-            if obj.__dict__["__attrs__"]["_id"] == "" or obj.__dict__["__attrs__"]["_id"] is None:
-                obj.__dict__["__attrs__"]["_id"] = str(uuid.uuid4())
+            if obj.__attrs__["_id"] == "" or obj.__attrs__["_id"] is None:
+                obj.__attrs__["_id"] = str(uuid.uuid4())
 
             # we set the second element of our tuple as our id
             schema_path = obj._schema_path
-            last_id = obj.__dict__["__attrs__"]["_id"]
+            last_id = obj.__attrs__["_id"]
 
             # We can only have version of objects with id's
-            if "_version" in obj.__dict__["__attrs__"]:
+            if "_version" in obj.__attrs__:
 
                 # If _id is empty means we must add an ID, we are most probably
                 # saving the object for the first time
-                if obj.__dict__["__attrs__"]["_version"] == "" or obj.__dict__["__attrs__"]["_version"] is None:
-                    obj.__dict__["__attrs__"]["_version"] = "latest"
+                if obj.__attrs__["_version"] == "" or obj.__attrs__["_version"] is None:
+                    obj.__attrs__["_version"] = "latest"
 
                 # we set the second element of our tuple as our id
                 schema_path = obj._schema_path
-                last_id = "{}:{}".format(last_id, obj.__dict__[
-                                         "__attrs__"]["_version"])
+                last_id = "{}:{}".format(last_id, obj.__attrs__["_version"])
+
+            objects.append(("{}:{}".format(schema_path, last_id), obj))
+
+        # objects loaded or saved before only write the changed attributes,
+        # unless the key of the object changed or the whole json is written
+        dirty = obj.__dirty__
+        if not full and last_id is not None and dirty is not None and \
+                "_id" not in dirty and "_version" not in dirty:
+            changes = []
+            DatabaseLayer._extract_changes(obj, (), changes, obj_list, indexed_attrs, objects, last_id)
+
+            # unchanged objects are not written
+            if changes:
+                obj_list.append([obj._schema_path, last_id, None, changes])
+            return (schema_path, last_id, None, obj_list, indexed_attrs, objects)
 
         # now we copy all attrs to our new dict
-        for attr_name, value in obj.__dict__["__attrs__"].items():
+        relations = obj._plan.relations
+        for attr_name, value in JSONSchemaObject._json_attrs(obj).items():
+
+            # lazy objects keep the json of the nested objects and arrays,
+            # we only convert them if they might have relations
+            if attr_name in relations and type(value) in (dict, list):
+                value = obj._materialize(attr_name)
 
             # To have indexed names we must have an _id on the schema
             if str(attr_name).startswith("_") and last_id is not None:
                 indexed_attrs.append(
                     (obj._schema_path, attr_name, value, last_id))
 
-            # If this object we need to check for a one to one relation
-            if isinstance(value, JSONSchemaObject):
+            d[attr_name] = DatabaseLayer._extract_value(
+                value, obj_list, indexed_attrs, objects, full)
 
-                # Try to extract the relation of the object
-                relation = DatabaseLayer._extract_relations(value)
+        # if this object have an _id we must append this json to the object list
+        if last_id is not None:
+            obj_list.append(
+                [obj._schema_path, last_id, d])
 
-                # check if we have a relation
-                if relation[0] is not None:
-                    # set the value of this attr to the ref
-                    d[attr_name] = "ref:{}:{}".format(relation[0], relation[1])
-                else:
-                    # otherwisw just add the returned json
-                    d[attr_name] = relation[2]
+        # result is always a tuple ( last schema path, last _id, list of objects to save )
+        return (schema_path, last_id, d, obj_list, indexed_attrs, objects)
 
-                # append to our object list the returned objects if any
-                obj_list.extend(relation[3])
+    @staticmethod
+    def _extract_value(value: object, obj_list: list, indexed_attrs: list, objects: list,
+                       full: bool = False):
 
-                # Append our indexed attrs if any
-                indexed_attrs.extend(relation[4])
+        # returns the json of an attribute value, the related objects and
+        # their indexed attrs are appended to obj_list, indexed_attrs and objects
 
-            # If this is an array we must check for a one to many relation
-            elif isinstance(value, JSONSchemaArray):
+        # If this object we need to check for a one to one relation
+        if isinstance(value, JSONSchemaObject):
 
-                d[attr_name] = []
-                for svalue in value:
+            # Try to extract the relation of the object
+            relation = DatabaseLayer._extract_relations(value, full)
 
-                    # If this object we need to check for a one to one relation
-                    if isinstance(svalue, JSONSchemaObject):
+            # append to our object list the returned objects if any
+            obj_list.extend(relation[3])
 
-                        # Try to extract the relation of the object
-                        relation = DatabaseLayer._extract_relations(svalue)
+            # Append our indexed attrs if any
+            indexed_attrs.extend(relation[4])
+            objects.extend(relation[5])
 
-                        # check if we have a relation
-                        if relation[0] is not None:
-                            # set the value of this attr to the ref
-                            d[attr_name].append("ref:{}:{}".format(
-                                relation[0], relation[1]))
-                        else:
-                            # otherwisw just add the returned json
-                            d[attr_name].append(relation[2])
+            # check if we have a relation
+            if relation[0] is not None:
+                # set the value of this attr to the ref
+                return "ref:{}:{}".format(relation[0], relation[1])
 
-                        # append to our object list the returned objects if any
-                        obj_list.extend(relation[3])
+            # otherwisw just add the returned json
+            return relation[2]
+
+        # If this is an array we must check for a one to many relation
+        if isinstance(value, JSONSchemaArray):
+            return [
+                DatabaseLayer._extract_value(svalue, obj_list, indexed_attrs, objects, full)
+                if isinstance(svalue, JSONSchemaObject) else svalue
+                for svalue in value]
+
+        return value
+
+    @staticmethod
+    def _extract_changes(obj: JSONSchemaObject, path: tuple, changes: list,
+                         obj_list: list, indexed_attrs: list, objects: list,
+                         last_id: str = None):
+
+        # appends the changes of a tracked object to changes, every change
+        # is a tuple (operation, path, json) where operation is "set" or
+        # "append" and path is a tuple of attr names and array indexes
+        plan = obj._plan
+        if plan is None:
+            plan = JSONSchemaPlan.compile(type(obj))
+
+        dirty = obj.__dirty__
+        for attr_name, value in obj.__attrs__.items():
+
+            # the json of untouched lazy attrs did not change
+            value_type = type(value)
+            if attr_name in plan.lazy and value_type in (dict, list):
+                continue
 
-                        # Append our indexed attrs if any
-                        indexed_attrs.extend(relation[4])
+            attr_path = path + (attr_name,)
+
+            # plain dicts can be changed in place, so they are always written
+            if attr_name in dirty or value_type is dict:
+
+                # only the changed indexes are updated
+                if str(attr_name).startswith("_") and last_id is not None:
+                    indexed_attrs.append(
+                        (obj._schema_path, attr_name, value, last_id))
+
+                changes.append(("set", attr_path, DatabaseLayer._extract_value(
+                    value, obj_list, indexed_attrs, objects)))
+
+            elif isinstance(value, (JSONSchemaObject, JSONSchemaArray)):
+                DatabaseLayer._extract_nested_changes(
+                    value, attr_path, changes, obj_list, indexed_attrs, objects)
+
+    @staticmethod
+    def _extract_nested_changes(value: object, path: tuple, changes: list,
+                                obj_list: list, indexed_attrs: list, objects: list):
+
+        # appends the changes of an object or array which was not replaced
+
+        if isinstance(value, JSONSchemaObject):
+
+            dirty = value.__dirty__
+            if dirty is None:
+                # we don't know what changed, so we write it all
+                changes.append(("set", path, DatabaseLayer._extract_value(
+                    value, obj_list, indexed_attrs, objects)))
+
+            elif "_id" in value.__attrs__:
+                # related objects are stored on their own, our ref only
+                # changes with their key
+                ref = DatabaseLayer._extract_value(value, obj_list, indexed_attrs, objects)
+                if "_id" in dirty or "_version" in dirty:
+                    changes.append(("set", path, ref))
 
-                    else:
-                        # append to our json this value
-                        d[attr_name].append(svalue)
             else:
-                d[attr_name] = value
+                DatabaseLayer._extract_changes(
+                    value, path, changes, obj_list, indexed_attrs, objects)
 
-        # if this object have an _id we must append this json to the object list
-        if last_id is not None:
-            obj_list.append(
-                [obj._schema_path, last_id, d])
+            return
 
-        # result is always a tuple ( last schema path, last _id, list of objects to save )
-        return (schema_path, last_id, d, obj_list, indexed_attrs)
+        array = value
+        tracked = array._changes
+
+        # deleted items shift the indexes and dicts can be changed in place,
+        # so the whole array is written
+        if tracked is None or tracked[0] < 0 or dict in array._items.py_types:
+            changes.append(("set", path, DatabaseLayer._extract_value(
+                array, obj_list, indexed_attrs, objects)))
+            return
+
+        saved, changed = tracked
+        length = len(array)
+
+        for index in range(min(saved, length)):
+
+            if index in changed:
+                changes.append(("set", path + (index,), DatabaseLayer._extract_value(
+                    array[index], obj_list, indexed_attrs, objects)))
+
+            # typed storages have no objects
+            elif type(array.__array__) is list:
+
+                item = array[index]
+                if isinstance(item, JSONSchemaObject):
+                    DatabaseLayer._extract_nested_changes(
+                        item, path + (index,), changes, obj_list, indexed_attrs, objects)
 
-    def __init__(self, drv: DatabaseDriver = NullDriver()):
+        if length > saved:
+            changes.append(("append", path, [
+                DatabaseLayer._extract_value(array[index], obj_list, indexed_attrs, objects)
+                for index in range(saved, length)]))
+
+    def __init__(self, drv: DatabaseDriver = NullDriver(), cache: DatabaseCache = None):
         self._driver = drv
+        self._cache = cache
 
-    def store(self, obj: JSONSchemaObject, ref: str = ""):
+    @staticmethod
+    def _invalidate(cache: DatabaseCache, obj_list: list):
 
-        relations = DatabaseLayer._extract_relations(obj)
+        # the written documents are no longer cached
+        if cache is not None:
+            cache.invalidate(["{}:{}".format(obj[0], obj[1]) for obj in obj_list])
+
+    def session(self):
+        return DatabaseSession(self)
+
+    @staticmethod
+    def _extract(obj: JSONSchemaObject, ref: str = "", full: bool = False):
+
+        # in deferred mode the whole object is validated before storing it
+        if JSONSchemaObject._validation_mode == "deferred":
+            obj.validate()
+
+        relations = DatabaseLayer._extract_relations(obj, full)
 
         # we get the last inserted id
         last_id = relations[1]
         obj_list = relations[3]
         indexed_attrs = relations[4]
+        objects = relations[5]
 
         if last_id is None:
 
@@ -197,8 +422,131 @@ class DatabaseLayer(object):
             # right format [ schema path, id, json]
             json = relations[2]
             obj_list.append([obj._schema_path, ref, json])
+            last_id = ref
+
+        return obj_list, indexed_attrs, objects, last_id
+
+    def store(self, obj: JSONSchemaObject, ref: str = "", identity_map: dict = None):
+
+        obj_list, indexed_attrs, objects, _ = DatabaseLayer._extract(
+            obj, ref, not self._driver.partial_writes)
+        try:
+            ids = self._driver.save(obj_list, indexed_attrs)
+        finally:
+            DatabaseLayer._invalidate(self._cache, obj_list)
+
+        # every stored object with _id is the object of its ref, the first
+        # one when several objects have the same ref
+        if identity_map is not None:
+            identity_map.update(reversed(objects))
+
+        # from now on only the changes are written
+        JSONSchemaObject._track(obj)
+
+        return ids
+
+    def store_many(self, objects, batch_size: int = 1000):
+
+        # Stores the objects in batches, every batch is a single save of the
+        # driver with the objects shared by the batch written once. Returns
+        # in order the ids of every object or the exception that prevented
+        # storing it, a failed object doesn't abort the others
+        #
+        # The relations are extracted in this process, extracting them sets
+        # the missing _id and _version of the objects and reads their changes
+        results = []
+        objects = iter(objects)
+        batch = list(islice(objects, batch_size))
+        while batch:
+            results += self._store_batch(batch)
+            batch = list(islice(objects, batch_size))
+
+        return results
+
+    def _store_batch(self, batch: list):
+
+        results = [None] * len(batch)
+        extracted = []
+        owners = {}
+        entries = {}
+        indexes = {}
+
+        for position, obj in enumerate(batch):
+            try:
+                obj_list, indexed_attrs, _, last_id = DatabaseLayer._extract(
+                    obj, full=not self._driver.partial_writes)
+                DatabaseLayer._claim_indexes(indexed_attrs, owners)
+            except (Exception, JSONSchemaException) as e:
+                results[position] = e
+                continue
+
+            # shared objects are written once, a full json replaces the
+            # entries before it and the different changes are kept in order
+            for entry in obj_list:
+                key = (entry[0], entry[1])
+                previous = entries.get(key)
+                if previous is None or len(entry) <= 3:
+                    entries[key] = [entry]
+                elif entry not in previous:
+                    previous.append(entry)
+
+            for entry in indexed_attrs:
+                indexes[(entry[0], entry[1], str(entry[2]), entry[3])] = entry
+
+            # the id of the object itself is reported even when it is unchanged
+            ids = [entry[1] for entry in obj_list]
+            if last_id not in ids:
+                ids.append(last_id)
+            results[position] = ids
+            extracted.append((position, obj, obj_list, indexed_attrs))
+
+        if not extracted:
+            return results
+
+        obj_list = [entry for key in entries for entry in entries[key]]
+        try:
+            self._driver.save(obj_list, list(indexes.values()))
+        except (Exception, JSONSchemaException):
+
+            # the failed batch is saved object by object to know which
+            # of them can't be stored
+            for position, obj, entry_list, indexed_attrs in extracted:
+                try:
+                    self._driver.save(entry_list, indexed_attrs)
+                except (Exception, JSONSchemaException) as e:
+                    results[position] = e
+                    continue
+                JSONSchemaObject._track(obj)
+
+            return results
+        finally:
+            DatabaseLayer._invalidate(self._cache, obj_list)
+
+        # from now on only the changes are written
+        for position, obj, _, _ in extracted:
+            JSONSchemaObject._track(obj)
+
+        return results
+
+    @staticmethod
+    def _claim_indexes(indexed_attrs: list, owners: dict):
+
+        # the unique indexes of a batch must belong to a single _id, as the
+        # drivers check against the stored objects
+        claims = []
+        for schema_path, attr_name, value, last_id in indexed_attrs:
 
-        return self._driver.save(obj_list, indexed_attrs)
+            if attr_name == "_id" or attr_name == "_version" or value is None or value == "":
+                continue
+
+            key = (schema_path, attr_name, str(value))
+            owner = str(last_id).split(":")[0]
+            if owners.get(key, owner) != owner:
+                raise ValueError("{}:{} not unique, another object already have that value".format(attr_name, value))
+
+            claims.append((key, owner))
+
+        owners.update(claims)
 
     def find_by_ref(self, schema_name:str, ref:str):
 
@@ -209,36 +557,146 @@ class DatabaseLayer(object):
             return None
 
         ref = "{}:{}".format(schema_name,ref)
-        
-        return self._driver.find_by_ref(ref)
+        if self._cache is None:
+            return self._driver.find_by_ref(ref)
 
+        json = self._cache.get_many([ref]).get(ref)
+        if json is None:
+            generation = self._cache.generation
+            json = self._driver.find_by_ref(ref)
+            self._cache.put_many([ref], [json], generation)
+            json = JSONSchemaQuery._plain(json)
 
-    def find_all_by(self, schema_name:str, idx:str, value:str, version:str="all"):
+        return json
 
-        def _search_references(json:dict):
 
-            for attr,value in json.items():
+    @staticmethod
+    def _collect_refs(json: object, ancestors: frozenset, pending: list):
+
+        # appends to pending the (container, key, ref, ancestors) of every
+        # "ref:" string in json, refs to one of the ancestors are cycles
+        # and they are not resolved
+        if isinstance(json, (dict, JSONSchemaRecord)):
+            keys = json.items()
+        elif isinstance(json, list):
+            keys = enumerate(json)
+        else:
+            return
+
+        for key, value in keys:
+            if isinstance(value, (dict, list)):
+                DatabaseLayer._collect_refs(value, ancestors, pending)
+            elif isinstance(value, str) and value.startswith("ref:"):
+                ref = value[4:] # we remove the ref: part
+                if ref not in ancestors:
+                    pending.append((json, key, ref, ancestors))
 
-                if isinstance(value,list):
-                    
-                    result = []
-                    for e in value:
-                        if not isinstance(e,dict):
-                            result.append(e)
-                            continue
-                        result.append(_search_references(e))
+    @staticmethod
+    def _resolve_references(schema_name: str, refs: list, identity_map: dict = None,
+                            cache: DatabaseCache = None):
+
+        # Resolves the references of the documents of refs breadth first,
+        # every level of the documents is fetched at once and every ref
+        # only once. It yields the refs to fetch and is sent their json, so
+        # the sync and asyncio layers share it, and returns the objects.
+        #
+        # With an identity map every ref is a single object, the objects
+        # of the map are used as they are and the new ones are added
+        documents = [None] * len(refs)
+        pending = [(documents, position, ref, frozenset()) for position, ref in enumerate(refs)]
+        fetched = {}
+        placed = set()
+        created = []
+
+        while pending:
+            missing = list(dict.fromkeys(
+                ref for _, _, ref, _ in pending
+                if ref not in fetched and (identity_map is None or ref not in identity_map)))
+
+            if missing and cache is not None:
+                fetched.update(cache.get_many(missing))
+                missing = [ref for ref in missing if ref not in fetched]
+
+            if missing:
+                generation = cache.generation if cache is not None else None
+                jsons = yield missing
+                fetched.update(zip(missing, jsons))
+                if cache is not None:
+                    cache.put_many(missing, jsons, generation)
+
+            level, pending = pending, []
+            for container, key, ref, ancestors in level:
+
+                if identity_map is not None:
+                    if ref not in identity_map:
+
+                        # the attrs of the new objects keep the json of
+                        # their nested values, so their refs are resolved
+                        # in place
+                        json = fetched[ref]
+                        obj = None
+                        if json is not None:
+                            obj = DatabaseLayer._reference_object(
+                                schema_name if container is documents else None, ref, json)
+                        if obj is not None:
+                            created.append(obj)
+                            DatabaseLayer._collect_refs(obj.__attrs__, ancestors | {ref}, pending)
+                        identity_map[ref] = obj
+
+                    container[key] = identity_map[ref]
+                    continue
+
+                # every place has its own copy of the referenced json
+                json = fetched[ref]
+                if ref in placed and json is not None:
+                    json = JSONSchemaQuery._plain(json)
+                placed.add(ref)
+
+                container[key] = json
+                DatabaseLayer._collect_refs(json, ancestors | {ref}, pending)
+
+        # the changes of the loaded objects are written on store, the objects
+        # shared with the ones loaded before keep their changes
+        if identity_map is not None:
+            for obj in created:
+                JSONSchemaObject._track(obj, restart=False)
+            return [obj for obj in documents if obj is not None]
 
-                    json[attr] = result
+        obj_list = []
+        for json in documents:
 
-                elif isinstance(value,dict):
-                    json[attr] = _search_references(value)
-                elif str(value).startswith("ref:"):
-                    ref = str(value)[4:] # we remove the ref: part
-                    json[attr] = self._driver.find_by_ref(ref)
+            if json is None:
+                continue
 
-            return json
+            # our own data is trusted, it was validated when stored
+            json_object = JSONSchemaObject.from_json(schema_name,json,trusted=True)
+        
+            if json_object is None:
+                continue
 
-        # fetch the schema first
+            # the changes of the loaded objects are written on store
+            JSONSchemaObject._track(json_object)
+            obj_list.append(json_object)
+        
+        return obj_list
+
+    @staticmethod
+    def _reference_object(schema_name: str, ref: str, json: dict):
+
+        # the documents are objects of schema_name and the references objects
+        # of the model of their schema path, as converted by their parents
+        if schema_name is not None:
+            return JSONSchemaObject.from_json(schema_name, json, trusted=True)
+
+        schema_path = ref.split(":")[0]
+        return JSONSchemaObject._lazy(
+            JSONSchemaObject.compile_model(schema_path.split("/")[0], schema_path), json)
+
+    @staticmethod
+    def _index_key(schema_name: str, idx: str):
+
+        # the key of the index idx, None if the schema has no idx and ""
+        # if the objects of the schema can't be indexed
         schema = JSONSchemaObject.get_schema(schema_name)
         u_idx = "_{}".format(idx)
     
@@ -247,25 +705,33 @@ class DatabaseLayer(object):
         elif idx not in schema["properties"]:
             return None
 
-        idx = "{}:indexes:{}".format(schema_name,idx)
-        refs = self._driver.find_id_by(idx,value,version)
-        obj_list = []
+        if "_id" not in schema["properties"]:
+            return ""
 
-        for ref in refs:
-        
-            json = _search_references(self.find_by_ref(schema_name,ref))
-            json_object = JSONSchemaObject.from_json(schema_name,json)
-        
-            if json_object is None:
-                continue
-            obj_list.append(json_object)
-        
-        return obj_list
+        return "{}:indexes:{}".format(schema_name,idx)
 
+    def find_all_by(self, schema_name:str, idx:str, value:str, version:str="all",
+                    identity_map: dict = None):
 
-    def find_one_by(self, schema_name:str, idx:str, value:str, version:str="all"):
+        idx = DatabaseLayer._index_key(schema_name, idx)
+        if not idx:
+            return None if idx is None else []
+
+        refs = ["{}:{}".format(schema_name, ref) for ref in self._driver.find_id_by(idx,value,version)]
+
+        resolve = DatabaseLayer._resolve_references(schema_name, refs, identity_map, self._cache)
+        try:
+            missing = next(resolve)
+            while True:
+                missing = resolve.send(self._driver.find_by_refs(missing))
+        except StopIteration as stop:
+            return stop.value
+
+
+    def find_one_by(self, schema_name:str, idx:str, value:str, version:str="all",
+                    identity_map: dict = None):
 
-        obj_list = self.find_all_by(schema_name,idx,value,version)
+        obj_list = self.find_all_by(schema_name,idx,value,version,identity_map)
 
         if len(obj_list) > 0:
             return obj_list[0]
@@ -277,3 +743,154 @@ class DatabaseLayer(object):
 
     def delete(self, ref: list):
         pass
+
+
+class DatabaseSession(object):
+    """
+    A unit of work on a DatabaseLayer, every ref loaded or stored by the
+    session is a single object kept in its identity map
+    """
+
+    def __init__(self, layer: DatabaseLayer):
+        self._layer = layer
+        self._objects = {}
+
+    def store(self, obj: JSONSchemaObject, ref: str = ""):
+        return self._layer.store(obj, ref, self._objects)
+
+    def find_all_by(self, schema_name:str, idx:str, value:str, version:str="all"):
+        return self._layer.find_all_by(schema_name, idx, value, version, self._objects)
+
+    def find_one_by(self, schema_name:str, idx:str, value:str, version:str="all"):
+        return self._layer.find_one_by(schema_name, idx, value, version, self._objects)
+
+    def clear(self):
+        self._objects.clear()
+
+
+class AsyncDatabaseDriver(object):
+    """
+    Interface for the asyncio database driver
+    """
+
+    async def find_by_ref(self, ref:str):
+        raise NotImplementedError()
+
+    async def find_by_refs(self, refs: list):
+        # the json of every ref (or None) in the same order, drivers should
+        # fetch them at once, by default they are fetched concurrently
+        return list(await asyncio.gather(*map(self.find_by_ref, refs)))
+
+    async def find_id_by(self, idx:str, value:str, version:str):
+        raise NotImplementedError()
+
+    # see DatabaseDriver.partial_writes
+    partial_writes = True
+
+    async def save(self, obj_list: list, indexed_attrs: list):
+        # the entries are the ones of DatabaseDriver.save
+        raise NotImplementedError()
+
+
+class AsyncDatabaseLayer(object):
+    """
+    The DatabaseLayer of asyncio applications, the objects are extracted
+    and loaded the same way and only the driver calls are awaited
+    """
+
+    def __init__(self, drv: AsyncDatabaseDriver, cache: DatabaseCache = None):
+        self._driver = drv
+        self._cache = cache
+
+    def session(self):
+        return AsyncDatabaseSession(self)
+
+    async def store(self, obj: JSONSchemaObject, ref: str = "", identity_map: dict = None):
+
+        obj_list, indexed_attrs, objects, _ = DatabaseLayer._extract(
+            obj, ref, not self._driver.partial_writes)
+        try:
+            ids = await self._driver.save(obj_list, indexed_attrs)
+        finally:
+            DatabaseLayer._invalidate(self._cache, obj_list)
+
+        # see DatabaseLayer.store
+        if identity_map is not None:
+            identity_map.update(reversed(objects))
+
+        # from now on only the changes are written, like with threads the
+        # object must not be changed by other tasks while it is stored
+        JSONSchemaObject._track(obj)
+
+        return ids
+
+    async def find_by_ref(self, schema_name:str, ref:str):
+
+        # fetch the schema first
+        schema = JSONSchemaObject.get_schema(schema_name)
+    
+        if "_id" not in schema["properties"]:
+            return None
+
+        ref = "{}:{}".format(schema_name,ref)
+        if self._cache is None:
+            return await self._driver.find_by_ref(ref)
+
+        json = self._cache.get_many([ref]).get(ref)
+        if json is None:
+            generation = self._cache.generation
+            json = await self._driver.find_by_ref(ref)
+            self._cache.put_many([ref], [json], generation)
+            json = JSONSchemaQuery._plain(json)
+
+        return json
+
+    async def find_all_by(self, schema_name:str, idx:str, value:str, version:str="all",
+                          identity_map: dict = None):
+
+        idx = DatabaseLayer._index_key(schema_name, idx)
+        if not idx:
+            return None if idx is None else []
+
+        refs = ["{}:{}".format(schema_name, ref) for ref in await self._driver.find_id_by(idx,value,version)]
+
+        resolve = DatabaseLayer._resolve_references(schema_name, refs, identity_map, self._cache)
+        try:
+            missing = next(resolve)
+            while True:
+                missing = resolve.send(await self._driver.find_by_refs(missing))
+        except StopIteration as stop:
+            return stop.value
+
+    async def find_one_by(self, schema_name:str, idx:str, value:str, version:str="all",
+                          identity_map: dict = None):
+
+        obj_list = await self.find_all_by(schema_name,idx,value,version,identity_map)
+
+        if len(obj_list) > 0:
+            return obj_list[0]
+
+        return None
+
+
+class AsyncDatabaseSession(object):
+    """
+    The DatabaseSession of an AsyncDatabaseLayer, the tasks sharing a
+    session share its objects
+    """
+
+    def __init__(self, layer: AsyncDatabaseLayer):
+        self._layer = layer
+        self._objects = {}
+
+    async def store(self, obj: JSONSchemaObject, ref: str = ""):
+        return await self._layer.store(obj, ref, self._objects)
+
+    async def find_all_by(self, schema_name:str, idx:str, value:str, version:str="all"):
+        return await self._layer.find_all_by(schema_name, idx, value, version, self._objects)
+
+    async def find_one_by(self, schema_name:str, idx:str, value:str, version:str="all"):
+        return await self._layer.find_one_by(schema_name, idx, value, version, self._objects)
+
+    def clear(self):
+        self._objects.clear()
@@ -1,30 +1,98 @@
-from database import DatabaseDriver
-from schema import JSONSchemaObject
+import asyncio
+from collections import deque
+from hashlib import sha1
+from json import dumps, loads
+from database import AsyncDatabaseDriver, DatabaseDriver
+from schema import JSONSchemaCodec, JSONSchemaObject
+from redis.exceptions import ResponseError
 from rejson import Client, Path
-from jsonpath import parse
 
 class RedisDriver(DatabaseDriver):
 
     _host = "localhost"
     _port = 6379
     _client = None
+    _binary = None
+    _save_script = None
+
+    # values appended by a single JSON.ARRAPPEND of the save script
+    _append_chunk = 1000
+
+    # Checks that every index only has members of the same _id, any member
+    # is enough since they must all be equal, and then writes the indexes
+    # and runs the commands of the objects. Returns the number of the
+    # violated index or 0, nothing is written on a violation
+    _SAVE_SCRIPT = """
+local indexes = tonumber(ARGV[1])
+for i = 1, indexes do
+    local member = redis.call("SRANDMEMBER", KEYS[i])
+    if member then
+        local id = string.match(member, "^[^:]*")
+        if string.sub(ARGV[i + 1], 1, #id) ~= id then
+            return i
+        end
+    end
+end
+
+for i = 1, indexes do
+    redis.call("SADD", KEYS[i], ARGV[i + 1])
+end
+
+local arg = indexes + 2
+while arg <= #ARGV do
+    local argc = tonumber(ARGV[arg])
+    redis.call(ARGV[arg + 1], KEYS[tonumber(ARGV[arg + 2])], unpack(ARGV, arg + 3, arg + argc + 1))
+    arg = arg + argc + 2
+end
+
+return 0
+"""
     
-    def __init__(self, host:str="localhost", port:int=6379):
+    def __init__(self, host:str="localhost", port:int=6379, binary:bool=False):
         self._host = host
         self._port = port
         self._client = Client(
             host=host, port=port, decode_responses=True,
             encoder=JSONSchemaObject.JSONSchemaEncoder() )
 
+        # with binary the objects are stored in the format of JSONSchemaCodec
+        # as plain strings, the indexes are the same. The binary documents
+        # can't be changed in place so they are always written whole
+        if binary:
+            self._binary = Client(host=host, port=port)
+            self.partial_writes = False
+
     def find_by_ref(self, ref:str):
 
+        if self._binary is not None:
+            data = self._binary.get(ref)
+            if data is None:
+                return None
+            return JSONSchemaCodec.decode(data, json=True)
+
         return self._client.jsonget(ref)
+
+    def find_by_refs(self, refs: list):
+
+        if not refs:
+            return []
+
+        if self._binary is not None:
+            return [None if data is None else JSONSchemaCodec.decode(data, json=True)
+                    for data in self._binary.mget(refs)]
+
+        return self._client.jsonmget(Path.rootPath(), *refs)
         
 
     def find_id_by(self, idx:str, value:str, version:str):
+        return RedisDriver._filter_version(
+            self._client.smembers("{}:{}".format(idx,value)), version)
+
+    @staticmethod
+    def _filter_version(members, version: str):
 
         result = []
-        for member in self._client.smembers("{}:{}".format(idx,value)):
+        for member in members:
             
             if version == "all":
                 result.append(member)
@@ -41,8 +109,32 @@ class RedisDriver(DatabaseDriver):
 
     def save(self, obj_list: list, indexed_attrs: list):
 
-        # First cycle is just to verify if we do not have any
-        # index integrity violation        
+        # binary documents are encoded by the codec
+        encode = None if self._binary is not None else self._client._encode
+        keys, args, indexes = RedisDriver._save_args(obj_list, indexed_attrs, encode)
+
+        if keys:
+
+            # the script is sent once, then called by its sha
+            if self._save_script is None:
+                self._save_script = self._client.register_script(RedisDriver._SAVE_SCRIPT)
+
+            RedisDriver._check_violation(self._save_script(keys=keys, args=args), indexes)
+
+        # we return the added ids
+        return [obj[1] for obj in obj_list]
+
+    @staticmethod
+    def _save_args(obj_list: list, indexed_attrs: list, encode):
+
+        # The index checks and all the writes run in one script, atomically
+        # and in a single round trip. KEYS are the index keys followed by the
+        # object keys, ARGV the number of indexes, their members and then the
+        # commands as argc, command, key number and args. Without encode the
+        # objects are binary and must be whole
+        keys = []
+        args = [0]
+        indexes = []
         for obj in indexed_attrs:
 
             # We do not store neither _id or _version
@@ -50,44 +142,254 @@ class RedisDriver(DatabaseDriver):
                 continue
 
             if obj[2] is None or obj[2] == "":
-                raise ValueError("Indexed value {} must not be empty".format(obj[1]))            
+                raise ValueError("Indexed value {} must not be empty".format(obj[1]))
 
-            # the indexed is composed by schema path:indexes:attr_name 
-            indexed_key = store_name = "{}:indexes:{}:{}".format(obj[0], obj[1], obj[2])
-            
-            # we already have this key let's get any value and make 
-            # sure we this belongs to the same id            
-            for member in self._client.smembers(indexed_key):
-                # we only need to use one element since the _id MUST be equal
-                idxs = str(member).split(":")
-
-                # the _id is the first token of idxs, check if we recieved the same
-                # id, if not this is a index violation
-                if not str(obj[3]).startswith(idxs[0]):
-                    raise ValueError("{}:{} not unique, another object already have that value".format(obj[1], obj[2]))
-                
-                # we just need one iteration
-                break
-
-        # this cycle we just store the indexes
-        for obj in indexed_attrs:
+            # the indexed is composed by schema path:indexes:attr_name
+            keys.append("{}:indexes:{}:{}".format(obj[0], obj[1], obj[2]))
+            args.append(obj[3])
+            indexes.append(obj)
 
-            if obj[2] is None or obj[2] == "" or obj[1] == "_id" or obj[1] == "_version":
-                continue
-                  
-            # Set the store name and store data
-            store_name = "{}:indexes:{}:{}".format(obj[0], obj[1], obj[2])
-            store_data = obj[3]
-            self._client.sadd(store_name,store_data)
+        args[0] = len(indexes)
 
-        # We now store the actual objects, and return the added ids
-        ids = []
+        # We now add the writes of the actual objects
         for obj in obj_list:
 
             # Set the store name and store data
-            store_name = "{}:{}".format(obj[0], obj[1])
-            store_data = obj[2]
-            self._client.jsonset(store_name, Path.rootPath(), store_data)
-            ids.append(obj[1])
+            keys.append("{}:{}".format(obj[0], obj[1]))
+            key = len(keys)
+
+            if encode is None:
+                if len(obj) > 3:
+                    raise ValueError("{} can't be changed in place, binary documents are written whole".format(keys[-1]))
+                args += [2, "SET", key, JSONSchemaCodec.encode_json(obj[0], obj[2])]
+                continue
+
+            # objects loaded or saved before only have the changed paths
+            if len(obj) > 3:
+                for operation, path, value in obj[3]:
+                    path = RedisDriver._path(path).strPath
+                    if operation != "append":
+                        args += [3, "JSON.SET", key, path, encode(value)]
+                        continue
+
+                    # the values are unpacked into the command, long appends
+                    # are split to stay under the limits of the Lua stack
+                    for i in range(0, len(value), RedisDriver._append_chunk):
+                        chunk = [encode(v) for v in value[i:i + RedisDriver._append_chunk]]
+                        args += [len(chunk) + 2, "JSON.ARRAPPEND", key, path] + chunk
+                continue
+
+            args += [3, "JSON.SET", key, Path.rootPath(), encode(obj[2])]
+
+        return keys, args, indexes
+
+    @staticmethod
+    def _check_violation(violation: int, indexes: list):
+
+        # the script returns the number of the violated index or 0
+        if violation:
+            obj = indexes[int(violation) - 1]
+            raise ValueError("{}:{} not unique, another object already have that value".format(obj[1], obj[2]))
+
+    @staticmethod
+    def _apply_changes(json: object, changes: list):
+
+        # the json with the (operation, path, value) changes of save applied
+        for operation, path, value in changes:
+
+            if not path:
+                json = value
+                continue
+
+            container = json
+            for key in path[:-1]:
+                container = container[key]
+
+            if operation == "append":
+                container[path[-1]].extend(value)
+            else:
+                container[path[-1]] = value
+
+        return json
+
+    @staticmethod
+    def _path(path: tuple):
+
+        # the ReJSON path of a tuple of attr names and array indexes
+        result = ""
+        for key in path:
+            if isinstance(key, int):
+                result += "[{}]".format(key)
+            elif key.isidentifier():
+                result += ".{}".format(key)
+            else:
+                result += "[{}]".format(dumps(key))
+
+        return Path(result or Path.rootPath())
+
+
+class RedisConnection(object):
+    """
+    A connection speaking RESP over asyncio streams, the commands
+    are pipelined and their replies read in order
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+
+    @staticmethod
+    async def open(host: str, port: int):
+        reader, writer = await asyncio.open_connection(host, port)
+        return RedisConnection(reader, writer)
+
+    async def execute(self, *commands: tuple):
+
+        # every command is a tuple of its args, the replies are returned
+        # once all of them were read so the connection stays usable
+        data = []
+        for command in commands:
+            data.append(b"*%d\r\n" % len(command))
+            for arg in command:
+                if isinstance(arg, str):
+                    arg = arg.encode("utf-8")
+                elif not isinstance(arg, (bytes, bytearray)):
+                    arg = str(arg).encode("utf-8")
+                data.append(b"$%d\r\n" % len(arg))
+                data.append(arg)
+                data.append(b"\r\n")
+
+        self._writer.write(b"".join(data))
+        await self._writer.drain()
+
+        replies = [await self._read() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, ResponseError):
+                raise reply
+
+        return replies
+
+    async def _read(self):
+
+        line = await self._reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the server")
+
+        prefix, value = line[:1], line[1:-2]
+        if prefix == b"+":
+            return value.decode("utf-8")
+        if prefix == b"-":
+            return ResponseError(value.decode("utf-8"))
+        if prefix == b":":
+            return int(value)
+
+        length = int(value)
+        if length == -1:
+            return None
+        if prefix == b"$":
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if prefix == b"*":
+            return [await self._read() for _ in range(length)]
+
+        raise ConnectionError("Unknown reply {}".format(line))
+
+    def close(self):
+        self._writer.close()
+
+    async def wait_closed(self):
+        await self._writer.wait_closed()
+
+
+class RedisConnectionPool(object):
+    """
+    At most size connections of a Redis server shared by the tasks,
+    the connections are opened when needed and kept to be reused
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, size: int = 10):
+        self._host = host
+        self._port = port
+        self._idle = deque()
+        self._available = asyncio.Semaphore(size)
+
+    async def execute(self, *commands: tuple):
+
+        async with self._available:
+            connection = self._idle.pop() if self._idle else \
+                await RedisConnection.open(self._host, self._port)
+
+            try:
+                replies = await connection.execute(*commands)
+            except ResponseError:
+                self._idle.append(connection)
+                raise
+            except BaseException:
+                # the replies of a failed connection can't be trusted
+                connection.close()
+                raise
+
+            self._idle.append(connection)
+            return replies
+
+    async def close(self):
+        while self._idle:
+            connection = self._idle.pop()
+            connection.close()
+            await connection.wait_closed()
+
+
+class AsyncRedisDriver(AsyncDatabaseDriver):
+    """
+    The RedisDriver of AsyncDatabaseLayer, the documents, indexes and
+    the save script are the same
+    """
+
+    def __init__(self, host:str="localhost", port:int=6379, binary:bool=False, pool_size:int=10):
+        self._pool = RedisConnectionPool(host, port, pool_size)
+        self._binary = binary
+        self._encode = JSONSchemaObject.JSONSchemaEncoder().encode
+
+        # see RedisDriver, binary documents are always written whole
+        if binary:
+            self.partial_writes = False
+        self._save_sha = sha1(RedisDriver._SAVE_SCRIPT.encode("utf-8")).hexdigest()
+
+    async def find_by_ref(self, ref:str):
+        return (await self.find_by_refs([ref]))[0]
+
+    async def find_by_refs(self, refs: list):
+
+        if not refs:
+            return []
+
+        if self._binary:
+            documents, = await self._pool.execute(("MGET",) + tuple(refs))
+            return [None if data is None else JSONSchemaCodec.decode(data, json=True)
+                    for data in documents]
+
+        documents, = await self._pool.execute(("JSON.MGET",) + tuple(refs) + (Path.rootPath(),))
+        return [None if data is None else loads(data) for data in documents]
+
+    async def find_id_by(self, idx:str, value:str, version:str):
+        members, = await self._pool.execute(("SMEMBERS", "{}:{}".format(idx,value)))
+        return RedisDriver._filter_version([member.decode("utf-8") for member in members], version)
+
+    async def save(self, obj_list: list, indexed_attrs: list):
+
+        encode = None if self._binary else self._encode
+        keys, args, indexes = RedisDriver._save_args(obj_list, indexed_attrs, encode)
+
+        if keys:
+            command = (len(keys),) + tuple(keys) + tuple(args)
+            try:
+                violation, = await self._pool.execute(("EVALSHA", self._save_sha) + command)
+            except ResponseError as e:
+
+                # the script is sent once, then called by its sha
+                if not str(e).startswith("NOSCRIPT"):
+                    raise
+                violation, = await self._pool.execute(("EVAL", RedisDriver._SAVE_SCRIPT) + command)
+
+            RedisDriver._check_violation(violation, indexes)
 
-        return ids
+        return [obj[1] for obj in obj_list]
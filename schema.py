@@ -1,13 +1,38 @@
 '''
 PyLib - Datalayer Python API
 '''
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
 from datetime import datetime
+from bisect import bisect_left, insort
+from functools import lru_cache
+from hashlib import sha256
 from json import JSONDecodeError, JSONDecoder, JSONEncoder, load, loads
-from sys import modules
+from json.encoder import c_make_encoder, encode_basestring_ascii
+from math import isfinite
+from operator import ge, gt, is_, le, lt, not_
+from io import BufferedIOBase, RawIOBase
+from itertools import compress, islice, repeat
+from os import listdir, makedirs, replace
+from struct import Struct
+from sys import byteorder, intern, modules
+from time import time
 from typing import NewType
-from jsonpath import parse
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+from jsonpath import Array, Name, Root, Search, Slice, parse
+import pickle
+import re
 import uuid
 
+# numpy is optional, it is only used to validate the numbers of batches
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 """
 Defaults types interfaces used by the API
 """
@@ -18,95 +43,301 @@ class JSONSchemaException(BaseException):
     A simple schema exception
     '''
 
-class JSONSchemaArray(object):
-    """ 
-    This class represents a JSON array
+
+class JSONSchemaValidationError(ValueError):
+    '''
+    A value does not match its schema, path is the JSON pointer of the
+    value and keyword the schema keyword it does not match
+    '''
+
+    def __init__(self, keyword: str, message: str, path: str = ""):
+        super().__init__(message)
+        self.keyword = keyword
+        self.message = message
+        self.path = path
+
+    def __str__(self):
+        return "{}: {}".format(self.path or "/", self.message)
+
+class JSONSchemaArrayItems(object):
+    """
+    The items definition of an array attribute, it is resolved once
+    from the schema and shared by every array of that attribute
     For more information check:
-    https://json-schema.org/understanding-json-schema/reference/array.html  
+    https://json-schema.org/understanding-json-schema/reference/array.html#items
     """
+    _typecodes = {int: "q", float: "d", bool: "b"}
+
+    # the names of the x-key attributes, assigning them invalidates the keys indexes
+    _keys = set()
+
+    __slots__ = (
+        "attribute_name", "schema_name", "schema_path", "items", "is_tuple",
+        "arity", "refs", "py_types", "defaults", "validators", "models", "key",
+        "typecode")
+
+    def __init__(self, attribute_name: str, schema_name: str, schema_path: str):
+
+        property_info = JSONSchemaObject.get_schema(schema_path)[
+            "properties"][attribute_name]
+        items = property_info["items"]
+
+        self.attribute_name = attribute_name
+        self.schema_name = schema_name
+        self.schema_path = schema_path
+
+        # depending on the items definition we might have a tuple
+        # per value, if so the array stores N consecutive items
+        # https://json-schema.org/understanding-json-schema/reference/array.html#tuple-validation
+        self.is_tuple = type(items) is list
+        self.items = tuple(items) if self.is_tuple else (items,)
+        self.arity = len(self.items)
+
+        refs = []
+        py_types = []
+        defaults = []
+        validators = []
+        for item in self.items:
+
+            if "$ref" in item:
+
+                # a reference to another object, resolved by the registry
+                refs.append(JSONSchemaRegistry.resolve(schema_name, item["$ref"]))
+                py_types.append(JSONSchemaObject)
+                defaults.append(None)
+                validators.append(None)
+                continue
+
+            # the keywords of the items are validated in strict mode, the
+            # type is checked by validate
+            validators.append(JSONSchemaValidator.compile(
+                item, schema_name, shallow=True, typed=False))
+
+            py_type = JSONSchemaObject._get_python_type(item)
+            refs.append(None)
+            py_types.append(py_type)
+
+            if "default" in item:
+                defaults.append(item["default"])
+            elif py_type in (str, int, float, bool, None):
+                defaults.append(JSONSchemaObject._get_default_value(py_type))
+            else:
+                defaults.append(None)
 
-    @staticmethod
-    def _validate_array_value(property_info: dict, schema_name: str, value: object):
-        
-        if "$ref" in property_info:
+        self.refs = tuple(refs)
+        self.py_types = tuple(py_types)
+        self.defaults = tuple(defaults)
+        self.validators = tuple(validators)
+
+        # the models of the references are only compiled when needed
+        self.models = [None] * self.arity
+
+        # integers, numbers and booleans are stored in a typed array, tuples
+        # are only typed if all items have the same type
+        typecodes = set(
+            JSONSchemaArrayItems._typecodes.get(py_type) for py_type in self.py_types)
+        self.typecode = typecodes.pop() if len(typecodes) == 1 else None
+
+        # keyed arrays index their items by the value of the x-key attribute
+        self.key = property_info.get("x-key")
+        if self.key is not None and self.is_tuple:
+            raise JSONSchemaException(
+                "x-key not supported on tuples, attribute {}".format(attribute_name))
+        if self.key is not None:
+            JSONSchemaArrayItems._keys.add(self.key)
+
+    def new_store(self):
+        """
+        Returns the storage for the items of an array
+        """
+        if self.typecode is None:
+            return []
+        return array(self.typecode)
+
+    def to_list(self, values):
+        """
+        Returns a list of python values from a slice of the storage
+        """
+        if type(values) is list:
+            return values
+
+        if self.typecode == "b":
+            return [bool(v) for v in values]
+
+        return values.tolist()
+
+    def model(self, position: int):
+        """
+        Returns the compiled model of the referenced item
+        """
+        model = self.models[position]
+        if model is None:
+            model = JSONSchemaObject._ref_model(
+                self.schema_name, self.refs[position])
+            self.models[position] = model
+        return model
+
+    def validate_lazy(self, position: int, value: object):
+        """
+        Like validate, but objects are created lazily from dicts
+        """
+        if self.refs[position] is not None and type(value) is dict:
+            return JSONSchemaObject._lazy(self.model(position), value)
+        return self.validate(position, value, False)
 
-            # a reference to another object, normalize the reference if
-            # it is an anchor in our schema
-            ref = property_info["$ref"]
-            if str(ref).startswith("#"):
-                ref = str(ref).replace("#", schema_name)
+    def validate(self, position: int, value: object, keywords: bool = True):
+        """
+        Validates the value of the item at position, returns the value to
+        store in the array. Without keywords only the type is validated
+        """
+        ref = self.refs[position]
+        if ref is not None:
 
             # We recieved a None just create an empty object
             if value is None:
-                obj = JSONSchemaObject(
-                    schema_name=schema_name, schema_path=ref)
+                return self.model(position)()
 
             # we recieved JSONSchemaObject, check if it's of the same type
-            elif isinstance(value, JSONSchemaObject):
-                if value.schema_path != ref:
+            if isinstance(value, JSONSchemaObject):
+                if value._schema_path != ref:
                     raise ValueError(
                         "value not an JSONSchemaObject of type {}".format(ref))
-
-                obj = value
+                return value
 
             # dict can also be converted into a json object
-            elif isinstance(value, dict):
-                obj = JSONSchemaObject(
-                    schema_name=schema_name, schema_path=ref, **value)
+            if isinstance(value, dict):
+                return self.model(position)(**value)
 
-            else:
-                # we recieved a invalid type for a ref
-                raise ValueError("{} is not supported".format(type(value)))
+            # we recieved a invalid type for a ref
+            raise ValueError("{} is not supported".format(type(value)))
 
-            return obj
+        py_type = self.py_types[position]
 
-        else:
+        # Nested arrays are not supported
+        if py_type is JSONSchemaArray:
+            raise NotImplementedError("Nested arrays are not supported")
 
-            # Nested arrays are not supported
-            if property_info["type"] == "array":
-                raise NotImplementedError("Nested arrays are not supported")
-
-            # We must assure that we are sending a value of the
-            # right type
-            py_type = JSONSchemaObject._get_python_type(property_info)
-                
-            # If we just recieved a None just returns the default value
-            if value is None:
-                return JSONSchemaObject._get_default_value(py_type)
+        # If we just recieved a None just returns the default value
+        if value is None:
+            if py_type is dict:
+                return {}
+            return self.defaults[position]
 
-            # type of value must be the same type of the schema
-            if type(value) is not py_type:
-                raise ValueError("value is not of type {}".format(py_type))
+        # type of value must be the same type of the schema
+        if type(value) is not py_type:
+            raise ValueError("value is not of type {}".format(py_type))
 
-            return value
+        validator = self.validators[position]
+        if validator is not None and keywords and JSONSchemaObject._validation_mode == "strict":
+            validator(value)
+
+        return value
+
+
+class JSONSchemaArrayIterator(object):
+    """
+    Iterator over an array of tuples, every step returns the next N
+    consecutive items as a list
+    """
+    __slots__ = ("_array", "_items", "_arity", "_index")
+
+    def __init__(self, array: list, items: JSONSchemaArrayItems):
+        self._array = array
+        self._items = items
+        self._arity = items.arity
+        self._index = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = self._index
+        stop = start + self._arity
+        if stop > len(self._array):
+            raise StopIteration
+
+        self._index = stop
+        return self._items.to_list(self._array[start:stop])
+
+
+class JSONSchemaArray(object):
+    """ 
+    This class represents a JSON array
+    For more information check:
+    https://json-schema.org/understanding-json-schema/reference/array.html  
+    """
+    __slots__ = ("_items", "__array__", "_index", "_changes")
+
+    _items_cache = {}
+
+    # the number of assignments of x-key attributes, the keys indexes built
+    # before a change of keys are rebuilt on their next miss
+    _renames = 0
 
+    # the keys index is rebuilt once more deleted positions than this
+    _max_deleted = 64
+
+    @staticmethod
+    def _get_items(attribute_name: str, schema_name: str, schema_path: str):
+        """
+        Returns the items definition of an array attribute from our cache
+        """
+        key = (attribute_name, schema_name, schema_path)
+        items = JSONSchemaArray._items_cache.get(key)
+        if items is None:
+            items = JSONSchemaArrayItems(attribute_name, schema_name, schema_path)
+            JSONSchemaArray._items_cache[key] = items
+        return items
+
+    @staticmethod
+    def _new(items: JSONSchemaArrayItems, store=None):
+        """
+        Returns a new array of items, optionally with an existing storage
+        """
+        array = JSONSchemaArray.__new__(JSONSchemaArray)
+        array._items = items
+        array.__array__ = items.new_store() if store is None else store
+        array._index = None
+        array._changes = None
+        return array
 
     def __init__(self, attribute_name:str, schema_name:str, schema_path):
 
         # Initialize our attributes
-        self._attribute_name = attribute_name
-        self._schema_path = schema_path
-        self._schema_name = schema_name
-        self.__dict__['__array__'] = []
+        self._items = JSONSchemaArray._get_items(
+            attribute_name, schema_name, schema_path)
+        self.__array__ = self._items.new_store()
 
+        # the keys index of a keyed array, it is built on the first lookup.
+        # It is a list of the positions of the keys, the sorted deleted
+        # positions, the renames count when it was built and the keys of
+        # more than one item. The positions are not shifted on deletes, they
+        # are the positions at build time
+        self._index = None
+
+        # the changes since the array was loaded or saved, see _track
+        self._changes = None
+
+    def _check_index(self, key):
+        """
+        Check the bounds of key and return it as a positive index
+        """
+        length = len(self.__array__) // self._items.arity
+        if key < 0:
+            key += length
+
+        if key < 0 or key >= length:
+            raise IndexError("Index out of bounds")
+
+        return key
 
     def __len__(self):
         """
         Return the length of the array
         """
-        # Get attribute schema
-        attribute_name = self._attribute_name
-        schema = JSONSchemaObject.get_schema(self._schema_path)[
-            'properties'][attribute_name]
-
-        # Check if we are a reference to other object
-        if "$ref" in schema["items"]:
-            # a reference to another object, just try to return the len of the array
-            return len(self.__dict__["__array__"])
-        else:
-            # depending on the items definition we might have more then one
-            # per value so return the array size / num items
-            return int(len(self.__dict__["__array__"])/len(schema["items"]))
+        # depending on the items definition we might have more then one
+        # per value so return the array size / num items
+        return len(self.__array__) // self._items.arity
 
     def __delitem__(self, key):
         """
@@ -116,33 +347,30 @@ class JSONSchemaArray(object):
         if not isinstance(key, int):
             raise ValueError("Can only delete by index")
 
-        # Get attribute schema
-        attribute_name = self._attribute_name
-        schema = JSONSchemaObject.get_schema(self._schema_path)[
-            'properties'][attribute_name]
+        key = self._check_index(key)
+        items = self._items
 
-        # Check if we are a reference to a schema
-        if "$ref" in schema["items"]:
+        # the positions after key changed, the whole array must be written
+        if self._changes is not None:
+            self._changes[0] = -1
 
-            # a reference to another object, check bounds and delete object
-            if key >= len(self.__dict__["__array__"]):
-                raise IndexError("Index out of bounds")
+        if items.arity == 1:
+            position = self._unindex(key)
 
-            del self.__dict__["__array__"][key]
-
-        else:
+            # the positions after key are shifted on their lookup
+            if position is not None:
+                deleted = self._index[1]
+                if len(deleted) < JSONSchemaArray._max_deleted:
+                    insort(deleted, position)
+                else:
+                    self._index = None
 
-            # depending on the schema definition we might have a tuple
-            # per value so delete the N consecutive items
-            # for more information check:
-            # https://json-schema.org/understanding-json-schema/reference/array.html#tuple-validation
-            if key >= len(self.__dict__["__array__"])/len(schema["items"]):
-                raise IndexError("Index out of bounds")
+            del self.__array__[key]
+            return
 
-            # compose our slice limits and delete the tuple/element
-            start = key*len(schema["items"])
-            stop = start + len(schema["items"])
-            del self.__dict__["__array__"][start:stop]
+        # a tuple per value so delete the N consecutive items
+        start = key*items.arity
+        del self.__array__[start:start + items.arity]
 
     def __getitem__(self, key):
         """
@@ -152,38 +380,21 @@ class JSONSchemaArray(object):
         if not isinstance(key, int) and not isinstance(key, slice):
             raise ValueError("Key must be an integer or a slice")
 
-        # Slices aren't supported yet, altought it might be very straight forward
-        # to implement it
+        # Slices are views over our array, nothing is copied
         if isinstance(key, slice):
-            raise NotImplementedError
-
-        # Get attribute schema
-        attribute_name = self._attribute_name
-        schema = JSONSchemaObject.get_schema(self._schema_path)[
-            'properties'][attribute_name]
+            return JSONSchemaArrayView(self, range(len(self))[key])
 
-        # Check if we are a reference to other schema
-        if "$ref" in schema["items"]:
+        key = self._check_index(key)
+        items = self._items
 
-            # a reference to another object, just check bounds and
-            # return the object at the specified index
-            if key >= len(self.__dict__["__array__"]):
-                raise IndexError("Index out of bounds")
+        if not items.is_tuple:
+            if items.typecode == "b":
+                return bool(self.__array__[key])
+            return self.__array__[key]
 
-            return self.__dict__["__array__"][key]
-
-        else:
-            # depending on the schema of the attribute we might have a tuple
-            # first we check the bounds ( 0 <= key < array length / schema items length)
-            # for more information check:
-            # https://json-schema.org/understanding-json-schema/reference/array.html#tuple-validation
-            if key >= len(self.__dict__["__array__"])/len(schema["items"]):
-                raise IndexError("Index out of bounds")
-
-            # compose the slice limits and retur the tuple
-            start = key*len(schema["items"])
-            stop = start + len(schema["items"])
-            return self.__dict__["__array__"][start:stop]
+        # compose the slice limits and return the tuple
+        start = key*items.arity
+        return items.to_list(self.__array__[start:start + items.arity])
 
     def __setitem__(self, key, value):
         """
@@ -194,137 +405,378 @@ class JSONSchemaArray(object):
         if not isinstance(key, int):
             raise ValueError("Key must be an integer")
 
-        # Get attribute schema
-        attribute_name = self._attribute_name
-        schema = JSONSchemaObject.get_schema(self._schema_path)[
-            'properties'][attribute_name]
+        key = self._check_index(key)
+        items = self._items
 
         # Are we a array of tuples?
-        if type(schema["items"]) is list:
+        if items.is_tuple:
             
             # our array is a tuple
             if not isinstance(value, tuple) and not isinstance(value, list):
                 raise ValueError("Value must be of type tuple or list")
 
-            # Check bounds, we just need to check the end element, meaning
-            # key + len of items in schema >= length of our array
-            if key+len(schema["items"]) >= len(self.__dict__["__array__"]):
-                raise IndexError("Index out of bounds")
-
-            # run throught the sent list/tuple verify type and add it
-            # to our array
-            i = 0
-            for item in schema["items"]:
+            # run throught the sent list/tuple verify type, the whole
+            # tuple is validated before changing our array
+            values = []
+            for i in range(items.arity):
 
                 if i < len(value):
                     element = value[i]
                 else:
                     element = None
 
-                obj = JSONSchemaArray._validate_array_value(
-                    item, self._schema_name, element)
+                values.append(items.validate(i, element))
 
-                self.__dict__["__array__"][key+i] = obj
-                i += 1
+            start = key*items.arity
+            for i, element in enumerate(values):
+                self._set_store(start+i, element)
 
         else:
 
             # is not a tuple, validate value and set it on our array
-            self.__dict__["__array__"][key] = JSONSchemaArray._validate_array_value(
-                schema["items"],
-                self._schema_name, value)
+            value = items.validate(0, value)
+            position = self._unindex(key)
+            self._set_store(key, value)
+
+            # the key of the item might have changed
+            if position is not None:
+                self._reindex(self._item_key(value), position)
+
+        if self._changes is not None:
+            self._changes[1].add(key)
 
     def __iter__(self):
-        self.__iter_index__ = 0
-        return self
+        """
+        Returns a new iterator over the array, so the same array can be
+        iterated in nested loops
+        """
+        items = self._items
+        if not items.is_tuple:
+            if items.typecode == "b":
+                return map(bool, self.__array__)
+            return iter(self.__array__)
 
-    def __next__(self):
-        # Get attribute schema
-        attribute_name = self._attribute_name
-        schema = JSONSchemaObject.get_schema(self._schema_path)[
-            'properties'][attribute_name]
-
-        # Check if we are a reference to other object
-        if "$ref" in schema["items"]:
-            # a reference to another object, just try to return the key
-            if self.__iter_index__ >= len(self.__dict__["__array__"]):
-                raise StopIteration
-
-            obj = list(self.__dict__["__array__"])[self.__iter_index__]
-        else:
-            # depending on the items definition we might need to send more
-            # then one, so send a slice of our array
-            if self.__iter_index__ >= len(self.__dict__["__array__"])/len(schema["items"]):
-                raise StopIteration
+        return JSONSchemaArrayIterator(self.__array__, items)
 
-            start = self.__iter_index__*len(schema["items"])
-            stop = start + len(schema["items"])
-            obj = self.__dict__["__array__"][start:stop]
+    def iter_batches(self, size: int):
+        """
+        Iterate over the array in batches of up to size items, tuples are
+        returned as lists like in __getitem__
+        """
+        if size < 1:
+            raise ValueError("Batch size must be greater than 0")
 
-        self.__iter_index__ += 1
-        return obj
+        array = self.__array__
+        items = self._items
+
+        if not items.is_tuple:
+            for start in range(0, len(array), size):
+                yield items.to_list(array[start:start + size])
+            return
+
+        # each batch is a slice of size tuples, which is split into tuples
+        arity = items.arity
+        step = size*arity
+        for start in range(0, len(array) - len(array) % arity, step):
+            batch = items.to_list(array[start:start + step])
+            yield [batch[i:i + arity] for i in range(0, len(batch), arity)]
 
     def __str__(self):
-        return str(self.__dict__["__array__"])
+        return str(self._items.to_list(self.__array__))
+
+    def _set_store(self, position: int, value: object):
+        """
+        Set the value at position of our storage
+        """
+        try:
+            self.__array__[position] = value
+        except OverflowError:
+            # the integer does not fit our typed storage, fallback to a list
+            self.__array__ = self.__array__.tolist()
+            self.__array__[position] = value
+
+    def _extend_store(self, values: list):
+        """
+        Append the values to our storage
+        """
+        store = self.__array__
+        length = len(store)
+        try:
+            store.extend(values)
+        except OverflowError:
+            # the integers do not fit our typed storage, fallback to a list
+            self.__array__ = store.tolist()[:length]
+            self.__array__.extend(values)
+
+    def buffer(self):
+        """
+        Returns a memoryview of the typed storage of the array, tuples are
+        shaped (length, arity). The memory is shared, ie. numpy.asarray(
+        array.buffer()) does not copy the items, while the view is alive
+        the array can't grow or shrink.
+        """
+        if type(self.__array__) is list:
+            raise TypeError("{} is not a typed array".format(
+                self._items.attribute_name))
+
+        view = memoryview(self.__array__)
+        if not self._items.is_tuple:
+            return view
+
+        return view.cast("B").cast(
+            self.__array__.typecode, [len(self), self._items.arity])
+
+    def __buffer__(self, flags):
+        return self.buffer()
+
+    def column(self, position: int):
+        """
+        Returns the items at position of every tuple of the array, typed
+        arrays return a strided memoryview over the storage
+        """
+        items = self._items
+        if position < 0 or position >= items.arity:
+            raise IndexError("Index out of bounds")
+
+        stop = len(self.__array__) - len(self.__array__) % items.arity
+        if type(self.__array__) is list:
+            return self.__array__[position:stop:items.arity]
+
+        return memoryview(self.__array__)[position:stop:items.arity]
 
     def __contains__(self, *args, **kwargs):
         raise NotImplementedError
 
     def append(self, *args, **kwargs):
 
-        # Get attribute schema
-        attribute_name = self._attribute_name
-        schema = JSONSchemaObject.get_schema(self._schema_path)[
-            'properties'][attribute_name]
+        items = self._items
 
         # Are we a array of tuples?
-        if type(schema["items"]) is list:
+        if items.is_tuple:
             
             # run throught the sent list/tuple verify type and add it
             # to our array
-            i = 0
-            for item in schema["items"]:
+            args_list = []
+            for i in range(items.arity):
 
                 if i < len(args):
                     element = args[i]
                 else:
                     element = None
 
-                obj = JSONSchemaArray._validate_array_value(
-                    item, self._schema_name, element)
+                args_list.append(items.validate(i, element))
 
-                list.append(self.__dict__["__array__"], obj)
-                i += 1
+            self._extend_store(args_list)
+            return
+
+        # is not a tuple, validate value append it to our array
+
+        # depending on the schema we might need to validate
+        # the kwargs or args, by default we use kwargs
+        py_type = items.py_types[0]
+        if py_type is JSONSchemaObject or py_type is dict:
+
+            # a object, we can pass it as the single argument or
+            # pass the kwargs
+            if len(args) == 1 and not kwargs:
+                element = args[0]
+            elif items.attribute_name in kwargs:
+                element = kwargs[items.attribute_name]
+            else:
+                element = kwargs
 
+        elif py_type is JSONSchemaArray:
+            # Nested arrays are not supported
+            raise NotImplementedError("Nested arrays are not supported")
         else:
+            # other types we can pass the first element
+            if len(args) != 1:
+                raise ValueError("Value can't be of type list/typle")
+            element = args[0]
+
+        value = items.validate(0, element)
+        if type(self.__array__) is list:
+            self.__array__.append(value)
+        else:
+            self._extend_store((value,))
+
+        # keep the keys index up to date
+        if self._index is not None:
+            self._reindex(
+                self._item_key(self.__array__[-1]), len(self.__array__) - 1 + len(self._index[1]))
+
+    def extend(self, values: list, lazy: bool = False):
+        """
+        Append the values to the array, tuples can be passed as lists or
+        flattened like in the JSON representation of the array. With lazy
+        the objects keep the passed values until they are read
+        """
+        items = self._items
+        arity = items.arity
+
+        if items.is_tuple and len(values) > 0 and isinstance(values[0], (list, tuple)):
+            values = [v for value in values for v in value]
+
+        if len(values) % arity != 0:
+            raise ValueError("Values are not a multiple of {} items".format(arity))
+
+        validate = items.validate_lazy if lazy else items.validate
+        self._extend_store([validate(i % arity, v) for i, v in enumerate(values)])
+
+        # rebuild the keys index on the next lookup
+        self._index = None
+
+    def _item_key(self, item):
+        """
+        Returns the value of the key attribute of item
+        """
+        if isinstance(item, JSONSchemaObject):
+            return item.__attrs__.get(self._items.key)
+        return item.get(self._items.key)
+
+    def _reindex(self, item_key: object, position: int):
+        """
+        Adds the key of the item at position of the index, the first item
+        with a key wins
+        """
+        positions = self._index[0]
+        indexed = positions.get(item_key)
+        if indexed is None:
+            positions[item_key] = position
+            return
+
+        self._index[3].add(item_key)
+        if indexed > position:
+            positions[item_key] = position
+
+    def _unindex(self, position: int):
+        """
+        Removes the item at position from the keys index, returns the
+        position of the item in the index or None if there is no index
+        """
+        if self._index is None:
+            return None
+
+        positions, deleted, _, duplicates = self._index
+
+        # the position in the index is after the deleted positions before it
+        indexed = position
+        for deleted_position in deleted:
+            if deleted_position > indexed:
+                break
+            indexed += 1
+
+        # the next item with the key is only found by a rebuild
+        item_key = self._item_key(self.__array__[position])
+        if item_key in duplicates:
+            self._index = None
+            return None
+
+        if positions.get(item_key) == indexed:
+            del positions[item_key]
+        return indexed
+
+    def _key_position(self, key):
+        """
+        Returns the position of the item with key, or None
+        """
+        if self._items.key is None:
+            raise ValueError("{} is not a keyed array".format(
+                self._items.attribute_name))
+
+        index = self._index
+        if index is not None:
+            position = index[0].get(key)
+
+            # the keys not indexed are missing, unless a key was assigned
+            # since the index was built
+            if position is None:
+                if index[2] == JSONSchemaArray._renames:
+                    return None
 
-            # is not a tuple, validate value append it to our array
-
-            # depending on the schema we might need to validate
-            # the kwargs or args, by default we use kwargs
-            element = kwargs
-            if "$ref" in schema["items"]:
-                # a ref to a schema is a object, pass the kwargs
-                if self._attribute_name in kwargs:
-                     element = kwargs[self._attribute_name]
-
-            elif schema["items"]["type"] == "object":
-                # a object type pass the kwargs
-                if self._attribute_name in kwargs:
-                     element = kwargs[self._attribute_name]
-                
-            elif schema["items"]["type"] == "array":
-                # Nested arrays are not supported
-                raise NotImplementedError("Nested arrays are not supported")
             else:
-                # other types we can pass the first element
-                if len(args) != 1:
-                    raise ValueError("Value can't be of type list/typle")
-                element = args[0]
+                position -= bisect_left(index[1], position)
+
+                # the key of the item can be changed after it was indexed
+                if self._item_key(self.__array__[position]) == key:
+                    return position
+
+        # (re)build the keys index
+        positions = {}
+        duplicates = set()
+        for position, item in enumerate(self.__array__):
+            item_key = self._item_key(item)
+            if item_key in positions:
+                duplicates.add(item_key)
+            else:
+                positions[item_key] = position
+        self._index = [positions, [], JSONSchemaArray._renames, duplicates]
+
+        return positions.get(key)
+
+    def get_by_key(self, key):
+        """
+        Returns the item with key, or None if the array has no such item
+        """
+        position = self._key_position(key)
+        if position is None:
+            return None
+        return self.__array__[position]
+
+    def remove_by_key(self, key):
+        """
+        Removes the item with key from the array
+        """
+        position = self._key_position(key)
+        if position is None:
+            raise KeyError(key)
+        self.__delitem__(position)
+
+    def copy(self, indexes: range = None):
+        """
+        Returns a new array with the items of the array, or only the
+        items at indexes. The items objects are not copied
+        """
+        items = self._items
+        store = self.__array__
+        arity = items.arity
+
+        if indexes is None:
+            indexes = range(len(self))
+
+        if indexes.step == 1:
+            values = store[indexes.start*arity:indexes.stop*arity]
+        else:
+            values = items.new_store()
+            for i in indexes:
+                values.extend(store[i*arity:(i + 1)*arity])
+
+        return JSONSchemaArray._new(items, values)
+
+    def __reduce__(self):
+        """
+        Arrays are pickled with the attribute they belong to and their
+        storage, the keys index is rebuilt on the first lookup
+        """
+        items = self._items
+        return (JSONSchemaArray._restore, (
+            items.attribute_name, items.schema_name, items.schema_path, self.__array__))
+
+    @staticmethod
+    def _restore(attribute_name: str, schema_name: str, schema_path: str, store):
+        """
+        Returns an unpickled array
+        """
+        items = JSONSchemaArray._items_cache.get((attribute_name, schema_name, schema_path))
+        if items is None:
+            items = JSONSchemaArray._get_items(attribute_name, schema_name, schema_path)
 
-            list.append(self.__dict__["__array__"], JSONSchemaArray._validate_array_value(
-                schema["items"],
-                self._schema_name, element))
+        array = JSONSchemaArray.__new__(JSONSchemaArray)
+        array._items = items
+        array.__array__ = store
+        array._index = None
+        array._changes = None
+        return array
 
     def count(self):
         return self.__len__()
@@ -345,66 +797,2946 @@ class JSONSchemaArray(object):
         raise NotImplementedError
 
 
-class JSONSchemaObject(object):
-    '''
-    A general schema, the definition is stored in a json file
-    '''
-    _schemas_url = "file://schema"
-    _schemas_version = "latest"
-    _schemas_cache = {}
-    _models_cache = {}
-    __internals__ = [
-        '__dict__',
-        '__class__',
-        '_generate_from_schema',
-        '_generate_attribute',
-        '_schema_name',
-        '_schema_path',
-        'to_json',
-        'from_json'
-    ]
+class JSONSchemaArrayView(object):
+    """
+    A slice of a JSONSchemaArray, the view shares the storage of the
+    array so any change of the array is seen by the view. The items are
+    only copied when the view is materialized with copy() or when the
+    view is changed, from then on the view has its own items.
+    """
+    __slots__ = ("_array", "_range", "_detached")
+
+    def __init__(self, array: JSONSchemaArray, indexes: range):
+        self._array = array
+        self._range = indexes
+        self._detached = False
+
+    def __len__(self):
+        return len(self._range)
+
+    def __getitem__(self, key):
+        """
+        Returns a item of the view, slices return a new view
+        """
+        if isinstance(key, slice):
+            return JSONSchemaArrayView(self._array, self._range[key])
+
+        if not isinstance(key, int):
+            raise ValueError("Key must be an integer or a slice")
+
+        return self._array[self._range[key]]
+
+    def __iter__(self):
+        items = self._array._items
+        store = self._array.__array__
+
+        if not items.is_tuple:
+            if items.typecode == "b":
+                return map(bool, map(store.__getitem__, self._range))
+            return map(store.__getitem__, self._range)
+
+        arity = items.arity
+        return (items.to_list(store[i*arity:(i + 1)*arity]) for i in self._range)
+
+    def __str__(self):
+        return str(self.copy())
+
+    def copy(self):
+        """
+        Materialize the view into a new JSONSchemaArray
+        """
+        return self._array.copy(self._range)
+
+    def __reduce__(self):
+        return self.copy().__reduce__()
+
+    def _detach(self):
+        """
+        Copy the items of the view, so the view can be changed without
+        changing the array
+        """
+        if not self._detached:
+            self._array = self.copy()
+            self._range = range(len(self._array))
+            self._detached = True
+        return self._array
+
+    def __setitem__(self, key, value):
+        self._detach().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._detach().__delitem__(key)
+        self._range = range(len(self._array))
+
+    def append(self, *args, **kwargs):
+        self._detach().append(*args, **kwargs)
+        self._range = range(len(self._array))
+
+    def extend(self, values: list):
+        self._detach().extend(values)
+        self._range = range(len(self._array))
+
+
+class JSONSchemaRecord(list):
+    """
+    The attributes of an object of a compact schema, the values are kept
+    in a list and the key table is shared by the objects of the model. It
+    has the methods of a dict used by the API, like a dict iterating a
+    record returns its keys
+    """
+    __slots__ = ()
+
+    _keys = {}
+
+    @staticmethod
+    def compile(keys: list):
+        """
+        Returns the record class of a key table
+        """
+        return type("JSONSchemaRecord", (JSONSchemaRecord,), {
+            "__slots__": (),
+            "_keys": {intern(key): index for index, key in enumerate(keys)}})
+
+    def __getitem__(self, key):
+        return list.__getitem__(self, self._keys[key])
+
+    def __setitem__(self, key, value):
+        list.__setitem__(self, self._keys[key], value)
+
+    def __delitem__(self, key):
+        raise TypeError("The attributes of a compact object can't be deleted")
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, JSONSchemaRecord)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __reduce__(self):
+        # the record classes are generated at runtime, records are pickled as dicts
+        return (dict, (list(self.items()),))
+
+    def get(self, key, default=None):
+        index = self._keys.get(key)
+        if index is None:
+            return default
+        return list.__getitem__(self, index)
+
+    def keys(self):
+        return self._keys.keys()
+
+    def values(self):
+        return list.copy(self)
+
+    def items(self):
+        return zip(self._keys, list.__iter__(self))
+
+    def copy(self):
+        return type(self)(list.copy(self))
+
+    def update(self, values: dict):
+        for key, value in values.items():
+            self[key] = value
+
+
+class JSONSchemaProperty(property):
+    """
+    A typed descriptor for a schema property, generated by the schema
+    compiler. Reading the property is a plain lookup in the object
+    attributes, writing it validates the value against the schema
+    """
+
+    def __init__(self, attribute_name: str, property_info: dict, index: int = None):
+
+        # the names of the x-key attributes of the keyed arrays
+        keys = JSONSchemaArrayItems._keys
+
+        # lazy objects keep the JSON values of nested objects and arrays
+        # until they are read for the first time
+        raw_type = None
+        if "$ref" in property_info:
+            raw_type = dict
+        elif property_info.get("type") == "array":
+            raw_type = list
+
+        if index is None:
+
+            if raw_type is not None:
+
+                def fget(obj):
+                    value = obj.__attrs__[attribute_name]
+                    if type(value) is raw_type:
+                        return obj._materialize(attribute_name)
+                    return value
+
+            else:
+
+                def fget(obj):
+                    return obj.__attrs__[attribute_name]
+
+            def fset(obj, value):
+                obj.__attrs__[attribute_name] = JSONSchemaObject._coerce_value(
+                    obj, attribute_name, property_info, value)
+                if obj.__dirty__ is not None:
+                    obj.__dirty__.add(attribute_name)
+                if attribute_name in obj.__unset__:
+                    obj.__unset__ = tuple(n for n in obj.__unset__ if n != attribute_name)
+                if attribute_name in keys:
+                    JSONSchemaArray._renames += 1
+
+        else:
+
+            # the attributes of compact objects are read by their position
+            getitem = list.__getitem__
+            setitem = list.__setitem__
+
+            if raw_type is not None:
+
+                def fget(obj):
+                    value = getitem(obj.__attrs__, index)
+                    if type(value) is raw_type:
+                        return obj._materialize(attribute_name)
+                    return value
+
+            else:
+
+                def fget(obj):
+                    return getitem(obj.__attrs__, index)
+
+            def fset(obj, value):
+                setitem(obj.__attrs__, index, JSONSchemaObject._coerce_value(
+                    obj, attribute_name, property_info, value))
+                if obj.__dirty__ is not None:
+                    obj.__dirty__.add(attribute_name)
+                if attribute_name in obj.__unset__:
+                    obj.__unset__ = tuple(n for n in obj.__unset__ if n != attribute_name)
+                if attribute_name in keys:
+                    JSONSchemaArray._renames += 1
+
+        super().__init__(fget, fset, None, property_info.get("description"))
+        self.attribute_name = attribute_name
+        self.property_info = property_info
+
+
+class JSONSchemaPlan(object):
+    """
+    The construction plan of a compiled model, computed once from the
+    schema. It has a template with the default values of the immutable
+    attributes, which is copied for every new object, the factories of
+    the nested objects, arrays and dicts and the converters of the values
+    passed to the constructor
+    """
+    __slots__ = (
+        "template", "factories", "converters", "checks", "validators", "lazy",
+        "relations", "keys", "encoder", "required", "omitted", "unset")
+
+    @staticmethod
+    def compile(model: type):
+        """
+        Compile the construction plan of a model and store it in the model
+        """
+        plan = JSONSchemaPlan(model)
+        model._plan = plan
+        return plan
+
+    def __init__(self, model: type):
+
+        self.template = {}
+        self.factories = []
+        self.converters = {}
+
+        # the basic validation of the assigned values, and the validators of
+        # the schema keywords used in strict mode
+        self.checks = {}
+        self.validators = {}
+
+        # converters of the JSON values kept by lazy objects, and the attributes
+        # that might have objects with an _id (relations)
+        self.lazy = {}
+        self.relations = set()
+        self.keys = {}
+
+        schema = JSONSchemaObject.get_schema(model._schema_path)
+
+        # the required attributes, objects keep the ones not set or loaded yet
+        self.required = tuple(
+            name for name in schema.get("required", ()) if name in schema["properties"])
+
+        for attribute_name, property_info in schema["properties"].items():
+
+            if "$ref" in property_info:
+                # a reference to another object
+                factory, converter = JSONSchemaPlan._ref(
+                    model, attribute_name, property_info)
+
+                self.lazy[attribute_name] = (dict, JSONSchemaPlan._lazy_ref(factory))
+                if JSONSchemaPlan._has_relations(factory._schema_path, set()):
+                    self.relations.add(attribute_name)
+
+            elif property_info.get("type") == "array":
+                factory, converter = JSONSchemaPlan._typed(
+                    model, attribute_name, property_info)
+
+                items = JSONSchemaArray._get_items(
+                    attribute_name, model._schema_name, model._schema_path)
+                self.lazy[attribute_name] = (list, JSONSchemaPlan._lazy_array(items))
+                if any(ref is not None and JSONSchemaPlan._has_relations(ref, set())
+                       for ref in items.refs):
+                    self.relations.add(attribute_name)
+
+            elif "type" in property_info:
+                # it's not a reference, it is a defined type
+                factory, converter = JSONSchemaPlan._typed(
+                    model, attribute_name, property_info)
+
+            else:
+                raise JSONSchemaException(
+                    "Unhandled property {}".format(attribute_name))
+
+            # the type of the values is already checked by the converters, and
+            # the array items are validated by the array
+            self.checks[attribute_name] = JSONSchemaObject._value_check(property_info)
+            validator = JSONSchemaValidator.compile(
+                {k: v for k, v in property_info.items() if k != "items"},
+                model._schema_name, shallow=True, typed=False)
+            if validator is not None:
+                self.validators[attribute_name] = validator
+
+            # the JSON encoded key of the attribute, used by the serializer
+            self.keys[attribute_name] = "{}: ".format(
+                encode_basestring_ascii(attribute_name))
+
+            # the template keeps the order of the schema properties, the
+            # value of attributes with a factory is set per object
+            if callable(factory):
+                self.template[attribute_name] = None
+                self.factories.append((attribute_name, factory))
+            else:
+                self.template[attribute_name] = factory
+
+            self.converters[attribute_name] = converter
+
+        # the attributes whose default is not valid (ie. a string with an enum),
+        # they are not validated nor written to the JSON until they are set
+        self.omitted = frozenset(
+            attribute_name for attribute_name, validator in self.validators.items()
+            if not JSONSchemaPlan._is_valid(validator, self.template[attribute_name]))
+
+        # the attributes objects keep while they are not set or loaded
+        self.unset = self.required + tuple(self.omitted.difference(self.required))
+
+        # compact objects copy a record instead of a dict
+        if model._record is not None:
+            self.template = model._record(self.template.values())
+
+        self.encoder = JSONSchemaSerializer.compile(self, schema["properties"])
+
+    @staticmethod
+    def _is_valid(validator, value: object):
+        """
+        Check if the value is valid for the validator of an attribute
+        """
+        try:
+            validator(value)
+        except JSONSchemaValidationError:
+            return False
+        return True
+
+    @staticmethod
+    def _has_relations(schema_path: str, visited: set):
+        """
+        Check if the objects of a schema, or any nested object, have an _id
+        """
+        if schema_path in visited:
+            return False
+        visited.add(schema_path)
+
+        schema_name = schema_path.split("/")[0]
+        properties = JSONSchemaObject.get_schema(schema_path)["properties"]
+        if "_id" in properties:
+            return True
+
+        for property_info in properties.values():
+
+            items = property_info.get("items", property_info)
+            for item in items if type(items) is list else (items,):
+
+                if "$ref" not in item:
+                    continue
+
+                ref = JSONSchemaRegistry.resolve(schema_name, item["$ref"])
+                if JSONSchemaPlan._has_relations(ref, visited):
+                    return True
+
+        return False
+
+    @staticmethod
+    def _lazy_ref(ref_model: type):
+        """
+        Returns the converter of the JSON value of a lazy nested object
+        """
+        def materialize(value):
+            return JSONSchemaObject._lazy(ref_model, value)
+        return materialize
+
+    @staticmethod
+    def _lazy_array(items: JSONSchemaArrayItems):
+        """
+        Returns the converter of the JSON value of a lazy array
+        """
+        def materialize(value):
+            array = JSONSchemaArray._new(items)
+            array.extend(value, lazy=True)
+            return array
+        return materialize
+
+    @staticmethod
+    def _ref(model: type, attribute_name: str, property_info: dict):
+        """
+        Returns the factory and the converter of a reference to another
+        object
+        """
+        ref_model = JSONSchemaObject._ref_model(
+            model._schema_name, property_info["$ref"])
+
+        def convert(value):
+            if isinstance(value, JSONSchemaObject):
+                return value
+            if value is None:
+                return ref_model()
+            if isinstance(value, dict):
+                return ref_model(**value)
+
+            raise AttributeError("{} attribute {} is not type {}".format(
+                model._schema_path, attribute_name, dict))
+
+        return ref_model, convert
+
+    @staticmethod
+    def _typed(model: type, attribute_name: str, property_info: dict):
+        """
+        Returns the default value, or a factory of the default value, and
+        the converter of a typed property
+        """
+        if property_info["type"] == "array":
+
+            items = JSONSchemaArray._get_items(
+                attribute_name, model._schema_name, model._schema_path)
+            default = property_info.get("default")
+
+            def new_array():
+                array = JSONSchemaArray._new(items)
+                if default:
+                    array.extend(default)
+                return array
+
+            def convert(value):
+                # if we have a list we must convert it to a JSON array
+                if isinstance(value, list):
+                    array = JSONSchemaArray._new(items)
+                    array.extend(value)
+                    return array
+                if isinstance(value, JSONSchemaArray):
+                    return value
+
+                raise AttributeError("{} attribute {} is not type {}".format(
+                    model._schema_path, attribute_name, JSONSchemaArray))
+
+            return new_array, convert
+
+        if property_info["type"] == "object":
+
+            # objects declared inline are handled as plain dicts
+            default = property_info.get("default")
+
+            def new_dict():
+                if default is None:
+                    return {}
+                return deepcopy(default)
+
+            def convert(value):
+                if isinstance(value, dict):
+                    return value
+
+                raise AttributeError("{} attribute {} is not type {}".format(
+                    model._schema_path, attribute_name, dict))
+
+            return new_dict, convert
+
+        # Get the Python type and the default value of this property
+        py_type = JSONSchemaObject._get_python_type(property_info)
+        if "default" in property_info and py_type is not None:
+            default = py_type(property_info["default"])
+        else:
+            default = JSONSchemaObject._get_default_value(py_type)
+
+        def convert(value):
+            # check if the value is a valid type
+            if py_type is None and value is None or \
+                    py_type is not None and isinstance(value, py_type):
+                return value
+
+            raise AttributeError("{} attribute {} is not type {}".format(
+                model._schema_path, attribute_name, py_type))
+
+        return default, convert
+
+
+class JSONSchemaSerializer(object):
+    """
+    JSON serializer of JSONSchemaObject and JSONSchemaArray, every model
+    has its own encoder compiled from the schema which writes the
+    attributes in the schema order and the strings directly. The output
+    is the same as the output of JSONSchemaEncoder
+    """
+
+    _floats = {
+        float("inf"): "Infinity",
+        -float("inf"): "-Infinity"
+    }
+
+    _booleans = ("false", "true")
+
+    @staticmethod
+    def _float(value: float):
+        """
+        Encode a float like the json module does
+        """
+        if value != value:
+            return "NaN"
+        return JSONSchemaSerializer._floats.get(value) or float.__repr__(value)
+
+    @staticmethod
+    def encode(value: object):
+        """
+        Encode any value to JSON
+        """
+        value_type = type(value)
+
+        if value_type is str:
+            return encode_basestring_ascii(value)
+        if value is None:
+            return "null"
+        if value is True:
+            return "true"
+        if value is False:
+            return "false"
+        if value_type is int:
+            return int.__repr__(value)
+        if value_type is float:
+            return JSONSchemaSerializer._float(value)
+        if isinstance(value, JSONSchemaObject):
+            return JSONSchemaSerializer.encode_object(value)
+        if isinstance(value, JSONSchemaArray):
+            return JSONSchemaSerializer.encode_array(value)
+
+        # dicts, lists and anything else are handled by the json module
+        return JSONSchemaSerializer._encode_json(value)
+
+    @staticmethod
+    def _encode_json(value: object):
+        """
+        Encode a value with the json module, the C encoder is made on every
+        call as its markers of circular references can't be shared by threads
+        """
+        if c_make_encoder is None:
+            return JSONEncoder.encode(JSONSchemaSerializer._encoder, value)
+        return "".join(c_make_encoder({}, *JSONSchemaSerializer._c_encoder_args)(value, 0))
+
+    @staticmethod
+    def encode_dict(value: dict):
+        """
+        Encode a dict with the json module
+        """
+        if type(value) is not dict:
+            raise TypeError("{} is not a dict".format(type(value)))
+
+        return JSONSchemaSerializer._encode_json(value)
+
+    @staticmethod
+    def compile(plan: JSONSchemaPlan, properties: dict):
+        """
+        Compile the encoder of the objects of a construction plan, the
+        encoder formats all the attributes at once
+        """
+        if not plan.keys:
+            return lambda attrs: "{}"
+
+        # the values of records are copied to a list and read by position
+        compact = isinstance(plan.template, JSONSchemaRecord)
+
+        template = []
+        values = []
+        for index, (attribute_name, key) in enumerate(plan.keys.items()):
+
+            template.append(key.replace("%", "%%") + "%s")
+
+            # the values are passed directly to the encoder of their type,
+            # other values (ie. the json kept by lazy objects or None) are
+            # encoded by encode
+            property_info = properties[attribute_name]
+            value = "a[{!r}]".format(index if compact else attribute_name)
+            if "$ref" in property_info:
+                values.append("O({})".format(value))
+            elif property_info.get("type") == "string":
+                values.append("S({0}) if type({0}) is str else E({0})".format(value))
+            elif property_info.get("type") == "array":
+                values.append("A({0}) if type({0}) is Array else E({0})".format(value))
+            elif property_info.get("type") == "object":
+                values.append("D({0}) if type({0}) is dict else E({0})".format(value))
+            else:
+                values.append("E({})".format(value))
+
+        source = "def encoder(a):\n    {}return {!r} % ({},)\n".format(
+            "a = L(a)\n    " if compact else "",
+            "{" + ", ".join(template) + "}", ", ".join(values))
+
+        namespace = {
+            "L": list.copy,
+            "S": encode_basestring_ascii,
+            "O": JSONSchemaSerializer.encode_object,
+            "A": JSONSchemaSerializer.encode_array,
+            "D": JSONSchemaSerializer.encode_dict,
+            "E": JSONSchemaSerializer.encode,
+            "Array": JSONSchemaArray
+        }
+        exec(compile(source, "<encoder>", "exec"), namespace)
+        return namespace["encoder"]
+
+    @staticmethod
+    def encode_object(obj: object):
+        """
+        Encode a JSONSchemaObject
+        """
+        # the json kept by lazy objects or None
+        if not isinstance(obj, JSONSchemaObject):
+            return JSONSchemaSerializer.encode(obj)
+
+        attrs = JSONSchemaObject._json_attrs(obj) if obj.__unset__ else obj.__attrs__
+        plan = obj._plan
+        if plan is None:
+            plan = JSONSchemaPlan.compile(type(obj))
+
+        # our encoder expects the attributes of the template
+        if len(attrs) == len(plan.keys):
+            return plan.encoder(attrs)
+
+        return JSONSchemaSerializer.encode_attrs(attrs)
+
+    @staticmethod
+    def encode_attrs(attrs: dict):
+        """
+        Encode the attributes of an object one by one
+        """
+        encode = JSONSchemaSerializer.encode
+        return "{" + ", ".join(
+            "{}: {}".format(encode_basestring_ascii(attribute_name), encode(value))
+            for attribute_name, value in attrs.items()) + "}"
+
+    @staticmethod
+    def encode_array(array: object):
+        """
+        Encode a JSONSchemaArray
+        """
+        store = array.__array__
+        items = array._items
+
+        if type(store) is list:
+            if not items.is_tuple and items.refs[0] is not None:
+                values = map(JSONSchemaSerializer.encode_object, store)
+            elif not items.is_tuple and items.py_types[0] is str:
+                values = map(encode_basestring_ascii, store)
+            else:
+                values = map(JSONSchemaSerializer.encode, store)
+
+        elif items.typecode == "q":
+            values = map(int.__repr__, store)
+        elif items.typecode == "d":
+            values = map(JSONSchemaSerializer._float, store)
+        else:
+            values = map(JSONSchemaSerializer._booleans.__getitem__, store)
+
+        return "[" + ", ".join(values) + "]"
+
+    @staticmethod
+    def dump(obj: object, fp, buffer_size: int = 65536):
+        """
+        Serialize obj to a file like object, text or binary. The attributes
+        of obj and the items of its arrays are encoded one by one and
+        written in chunks of about buffer_size characters
+        """
+        binary = isinstance(fp, (BufferedIOBase, RawIOBase)) or "b" in getattr(fp, "mode", "")
+        encode = JSONSchemaSerializer.encode
+        chunks = []
+        size = 0
+
+        def write(chunk):
+            nonlocal size
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                flush()
+
+        def flush():
+            nonlocal size
+            data = "".join(chunks)
+            fp.write(data.encode("ascii") if binary else data)
+            chunks.clear()
+            size = 0
+
+        def write_array(array):
+            separator = "["
+            for value in array.__array__:
+                write(separator)
+                write(encode(value))
+                separator = ", "
+            write("]" if separator == ", " else "[]")
+
+        if isinstance(obj, JSONSchemaArray) and obj._items.typecode is None:
+            write_array(obj)
+
+        elif isinstance(obj, JSONSchemaObject) and obj.__attrs__:
+            separator = "{"
+            for attribute_name, value in JSONSchemaObject._json_attrs(obj).items():
+                write(separator)
+                write("{}: ".format(encode_basestring_ascii(attribute_name)))
+                if isinstance(value, JSONSchemaArray) and value._items.typecode is None:
+                    write_array(value)
+                else:
+                    write(encode(value))
+                separator = ", "
+            write("}")
+
+        else:
+            write(encode(obj))
+
+        flush()
+
+
+class JSONSchemaCodec(object):
+    """
+    A compact binary format for objects. Every value starts with a tag
+    byte, integers are zigzag varints, numbers are little endian doubles
+    and typed arrays are written as their raw storage. The attributes of
+    objects are written as field ids instead of names, the id is the
+    position of the property in the schema (or its x-field-id), so new
+    properties must be added at the end of the schema. Documents start
+    with the format version and their schema path
+    """
+    VERSION = 1
+
+    NULL, FALSE, TRUE, INT, DOUBLE, STRING, LIST, DICT, OBJECT, TYPED, REF, SCHEMA_OBJECT = range(12)
+
+    _double = Struct("<d")
+
+    # the field ids and the kind of value (the model of a reference or the
+    # items of an array) of the attributes of the compiled models, and the
+    # kinds of the items of the arrays
+    _fields = {}
+    _kinds = {}
+
+    @staticmethod
+    def fields(model: type):
+        """
+        Returns the fields of a compiled model, as dicts of attribute name
+        to (id, kind) and id to (attribute name, kind)
+        """
+        fields = JSONSchemaCodec._fields.get(model)
+        if fields is not None:
+            return fields
+
+        by_name = {}
+        by_id = {}
+        properties = JSONSchemaObject.get_schema(model._schema_path)["properties"]
+        for position, (attribute_name, property_info) in enumerate(properties.items()):
+
+            if "$ref" in property_info:
+                kind = JSONSchemaObject._ref_model(model._schema_name, property_info["$ref"])
+            elif property_info.get("type") == "array":
+                kind = JSONSchemaArray._get_items(
+                    attribute_name, model._schema_name, model._schema_path)
+            else:
+                kind = None
+
+            field_id = property_info.get("x-field-id", position)
+            if field_id in by_id:
+                raise JSONSchemaException("Duplicated field id {} of {}".format(
+                    field_id, attribute_name))
+
+            by_name[attribute_name] = (field_id, kind)
+            by_id[field_id] = (attribute_name, kind)
+
+        fields = (by_name, by_id)
+        JSONSchemaCodec._fields[model] = fields
+        return fields
+
+    @staticmethod
+    def kinds(items: JSONSchemaArrayItems):
+        """
+        Returns the kind of value of every position of the items of an array
+        """
+        kinds = JSONSchemaCodec._kinds.get(items)
+        if kinds is None:
+            kinds = tuple(items.model(position) if ref is not None else None
+                          for position, ref in enumerate(items.refs))
+            JSONSchemaCodec._kinds[items] = kinds
+        return kinds
+
+    @staticmethod
+    def _model(schema_path: str):
+        """
+        Returns the compiled model of a schema path
+        """
+        schema_name = schema_path.split("/")[0]
+        base = JSONSchemaObject._models_cache.get(schema_name, JSONSchemaObject)
+        return JSONSchemaObject.compile_model(schema_name, schema_path, base)
+
+    @staticmethod
+    def encode(obj: object):
+        """
+        Returns the binary document of an object
+        """
+        return JSONSchemaCodec.encode_json(
+            type(obj)._schema_path, JSONSchemaObject._json_attrs(obj), type(obj))
+
+    @staticmethod
+    def encode_json(schema_path: str, json: dict, model: type = None):
+        """
+        Returns the binary document of the json of an object, the "ref:"
+        strings of the database references are written as tuples
+        """
+        if model is None:
+            model = JSONSchemaCodec._model(schema_path)
+
+        out = bytearray((JSONSchemaCodec.VERSION,))
+        JSONSchemaCodec._string(out, schema_path)
+        JSONSchemaCodec._encode_object(out, model, json)
+        return bytes(out)
+
+    @staticmethod
+    def _varint(out: bytearray, n: int):
+        while n > 0x7f:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    @staticmethod
+    def _string(out: bytearray, value: str):
+        data = value.encode("utf-8")
+        JSONSchemaCodec._varint(out, len(data))
+        out += data
+
+    @staticmethod
+    def _encode_object(out: bytearray, model: type, attrs: dict):
+        """
+        Writes the (field id + 1, value) pairs of the attributes, ended by 0
+        """
+        fields = JSONSchemaCodec._fields.get(model) or JSONSchemaCodec.fields(model)
+        by_name = fields[0]
+        varint = JSONSchemaCodec._varint
+        encode = JSONSchemaCodec._encode_value
+
+        for attribute_name, value in attrs.items():
+            field = by_name.get(attribute_name)
+            if field is None:
+                continue
+            if field[0] < 0x7f:
+                out.append(field[0] + 1)
+            else:
+                varint(out, field[0] + 1)
+            encode(out, value, field[1])
+
+        out.append(0)
+
+    @staticmethod
+    def _encode_value(out: bytearray, value: object, kind: object):
+        """
+        Writes a tagged value, kind is the model of references or the items
+        of arrays
+        """
+        codec = JSONSchemaCodec
+        value_type = type(value)
+
+        if value_type is str:
+            # references to other objects stored in the database
+            if kind is not None and value.startswith("ref:") and isinstance(kind, type):
+                schema_path, _, last_id = value[4:].partition(":")
+                out.append(codec.REF)
+                codec._string(out, schema_path)
+                codec._string(out, last_id)
+                return
+
+            data = value.encode("utf-8")
+            if len(data) < 0x80:
+                out += bytes((codec.STRING, len(data)))
+            else:
+                out.append(codec.STRING)
+                codec._varint(out, len(data))
+            out += data
+
+        elif value is None:
+            out.append(codec.NULL)
+
+        elif value_type is bool:
+            out.append(codec.TRUE if value else codec.FALSE)
+
+        elif value_type is int:
+            value = value << 1 if value >= 0 else (-value << 1) - 1
+            if value < 0x80:
+                out += bytes((codec.INT, value))
+            else:
+                out.append(codec.INT)
+                codec._varint(out, value)
+
+        elif value_type is float:
+            out.append(codec.DOUBLE)
+            out += codec._double.pack(value)
+
+        elif isinstance(value, JSONSchemaObject):
+            if type(value) is kind:
+                out.append(codec.OBJECT)
+            else:
+                out.append(codec.SCHEMA_OBJECT)
+                codec._string(out, value._schema_path)
+            codec._encode_object(out, type(value), JSONSchemaObject._json_attrs(value))
+
+        elif value_type is dict:
+            # the json of lazy objects is written as the object
+            if isinstance(kind, type):
+                out.append(codec.OBJECT)
+                codec._encode_object(out, kind, value)
+            else:
+                out.append(codec.DICT)
+                codec._varint(out, len(value))
+                for key, item in value.items():
+                    codec._string(out, key)
+                    codec._encode_value(out, item, None)
+
+        elif isinstance(value, JSONSchemaArray):
+            codec._encode_store(out, value.__array__, value._items)
+
+        elif value_type is list:
+            # the json of lazy arrays, tuples might be lists of lists
+            if type(kind) is JSONSchemaArrayItems:
+                if kind.typecode is not None:
+                    try:
+                        codec._encode_store(out, array(kind.typecode, value), kind)
+                        return
+                    except (TypeError, OverflowError):
+                        pass
+                if not kind.is_tuple or not value or type(value[0]) is not list:
+                    codec._encode_store(out, value, kind)
+                    return
+
+            out.append(codec.LIST)
+            codec._varint(out, len(value))
+            for item in value:
+                codec._encode_value(out, item, None)
+
+        elif isinstance(value, JSONSchemaArrayView):
+            array_value = value.copy()
+            codec._encode_store(out, array_value.__array__, array_value._items)
+
+        else:
+            raise TypeError("Object of type {} is not serializable".format(
+                value_type.__name__))
+
+    @staticmethod
+    def _encode_store(out: bytearray, store: object, items: JSONSchemaArrayItems):
+        """
+        Writes the storage of an array, typed storages are copied as bytes
+        """
+        codec = JSONSchemaCodec
+
+        if type(store) is array:
+            out.append(codec.TYPED)
+            out.append(ord(store.typecode))
+            codec._varint(out, len(store))
+            if byteorder == "big":
+                store = array(store.typecode, store)
+                store.byteswap()
+            out += store.tobytes()
+            return
+
+        out.append(codec.LIST)
+        codec._varint(out, len(store))
+
+        kinds = codec.kinds(items)
+        encode = codec._encode_value
+        if len(kinds) == 1:
+            kind = kinds[0]
+            for item in store:
+                encode(out, item, kind)
+        else:
+            arity = len(kinds)
+            for i, item in enumerate(store):
+                encode(out, item, kinds[i % arity])
+
+    @staticmethod
+    def decode(data: bytes, json: bool = False):
+        """
+        Returns the object of a binary document, or its json with json.
+        The objects are not validated (ie. loaded from our database)
+        """
+        data = bytes(data)
+        if not data or data[0] != JSONSchemaCodec.VERSION:
+            raise ValueError("Unsupported binary format")
+
+        schema_path, pos = JSONSchemaCodec._decode_string(data, 1)
+        model = JSONSchemaCodec._model(schema_path)
+        return JSONSchemaCodec._decode_object(data, pos, model, json)[0]
+
+    @staticmethod
+    def _decode_varint(data: bytes, pos: int):
+        n = data[pos]
+        pos += 1
+        if n < 0x80:
+            return n, pos
+
+        n &= 0x7f
+        shift = 7
+        while True:
+            byte = data[pos]
+            pos += 1
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n, pos
+            shift += 7
+
+    @staticmethod
+    def _decode_string(data: bytes, pos: int):
+        length, pos = JSONSchemaCodec._decode_varint(data, pos)
+        end = pos + length
+        return data[pos:end].decode("utf-8"), end
+
+    @staticmethod
+    def _decode_object(data: bytes, pos: int, model: type, json: bool):
+        """
+        Reads the attributes of an object of model, the fields unknown to
+        the model (or without model) are skipped
+        """
+        by_id = {}
+        if model is not None:
+            fields = JSONSchemaCodec._fields.get(model) or JSONSchemaCodec.fields(model)
+            by_id = fields[1]
+        decode_varint = JSONSchemaCodec._decode_varint
+        decode = JSONSchemaCodec._decode_value
+
+        attrs = {}
+        while True:
+            field_id = data[pos]
+            if field_id < 0x80:
+                pos += 1
+            else:
+                field_id, pos = decode_varint(data, pos)
+            if field_id == 0:
+                break
+
+            attribute_name, kind = by_id.get(field_id - 1, (None, None))
+            value, pos = decode(data, pos, kind, json)
+            if attribute_name is not None:
+                attrs[attribute_name] = value
+
+        if json or model is None:
+            return attrs, pos
+
+        plan = model._plan
+        if plan is None:
+            plan = JSONSchemaPlan.compile(model)
+
+        # the attributes missing in the document get their default value
+        values = attrs
+        attrs = plan.template.copy()
+        for attribute_name, factory in plan.factories:
+            if attribute_name not in values:
+                attrs[attribute_name] = factory()
+        attrs.update(values)
+
+        obj = model.__new__(model)
+        obj.__attrs__ = attrs
+        obj.__dirty__ = None
+        obj.__unset__ = JSONSchemaObject._unset(plan, values)
+        return obj, pos
+
+    @staticmethod
+    def _decode_value(data: bytes, pos: int, kind: object, json: bool):
+        """
+        Reads a tagged value, returns the value and the next position
+        """
+        codec = JSONSchemaCodec
+        tag = data[pos]
+        pos += 1
+
+        if tag == codec.STRING:
+            length = data[pos]
+            if length < 0x80:
+                end = pos + 1 + length
+                return data[pos + 1:end].decode("utf-8"), end
+            return codec._decode_string(data, pos)
+
+        if tag == codec.INT:
+            n = data[pos]
+            if n < 0x80:
+                return (n >> 1) ^ -(n & 1), pos + 1
+            n, pos = codec._decode_varint(data, pos)
+            return (n >> 1) ^ -(n & 1), pos
+
+        if tag == codec.DOUBLE:
+            return codec._double.unpack_from(data, pos)[0], pos + 8
+
+        if tag <= codec.TRUE:
+            return (None, False, True)[tag], pos
+
+        if tag == codec.OBJECT:
+            return codec._decode_object(data, pos, kind if isinstance(kind, type) else None, json)
+
+        if tag == codec.SCHEMA_OBJECT:
+            schema_path, pos = codec._decode_string(data, pos)
+            return codec._decode_object(data, pos, codec._model(schema_path), json)
+
+        if tag == codec.REF:
+            schema_path, pos = codec._decode_string(data, pos)
+            last_id, pos = codec._decode_string(data, pos)
+            return "ref:{}:{}".format(schema_path, last_id), pos
+
+        items = kind if type(kind) is JSONSchemaArrayItems else None
+
+        if tag == codec.TYPED:
+            typecode = chr(data[pos])
+            length, pos = codec._decode_varint(data, pos + 1)
+            store = array(typecode)
+            end = pos + length*store.itemsize
+            store.frombytes(data[pos:end])
+            if byteorder == "big":
+                store.byteswap()
+
+            if items is None:
+                return store.tolist(), end
+            if json:
+                return items.to_list(store), end
+            return JSONSchemaArray._new(items, store), end
+
+        if tag == codec.LIST:
+            length, pos = codec._decode_varint(data, pos)
+
+            kinds = (None,) if items is None else codec.kinds(items)
+            arity = len(kinds)
+            decode = codec._decode_value
+
+            store = []
+            for i in range(length):
+                value, pos = decode(data, pos, kinds[i % arity], json)
+                store.append(value)
+
+            if items is None or json:
+                return store, pos
+            return JSONSchemaArray._new(items, store), pos
+
+        if tag == codec.DICT:
+            length, pos = codec._decode_varint(data, pos)
+            value = {}
+            for _ in range(length):
+                key, pos = codec._decode_string(data, pos)
+                value[key], pos = codec._decode_value(data, pos, None, json)
+            return value, pos
+
+        raise ValueError("Invalid binary tag {}".format(tag))
+
+
+class JSONSchemaQuery(object):
+    """
+    A compiled JSONPath expression. The names, indexes, wildcards, slices
+    and recursive searches of names (ie. $..name) are evaluated directly
+    on the JSONSchemaObject and JSONSchemaArray trees, other expressions
+    are evaluated by jsonpath on a plain copy of the tree
+    """
+    __slots__ = ("expression", "steps")
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def compile(jpath: str):
+        """
+        Returns the compiled expression of jpath, the most recently used
+        expressions are cached
+        """
+        return JSONSchemaQuery(jpath)
+
+    @staticmethod
+    def set_cache_size(size: int):
+        """
+        Set the number of compiled expressions cached
+        """
+        JSONSchemaQuery.compile = staticmethod(
+            lru_cache(maxsize=size)(JSONSchemaQuery.compile.__wrapped__))
+
+    def __init__(self, jpath: str):
+
+        self.expression = parse(jpath)
+
+        steps = []
+        expr = self.expression.get_begin()
+        while expr is not None and steps is not None:
+            steps.append(JSONSchemaQuery._step(expr))
+            if None in steps:
+                steps = None
+            expr = expr.get_next()
+
+        self.steps = None if steps is None else tuple(steps)
+
+    @staticmethod
+    def _step(expr: object):
+        """
+        Returns the function evaluating a part of the expression on a
+        list of values, or None if not supported
+        """
+        expr_type = type(expr)
+
+        if expr_type is Root:
+            return lambda values: values
+
+        if expr_type is Name:
+            if expr.name is None:
+                return lambda values: [
+                    v for value in values for v in JSONSchemaQuery._children(value, False)]
+
+            name = str(expr.name)
+            return lambda values: [
+                v for value in values for v in JSONSchemaQuery._name(value, name)]
+
+        if expr_type is Array:
+            index = expr.idx
+            if index is None:
+                return lambda values: [
+                    v for value in values for v in JSONSchemaQuery._children(value, True)]
+
+            if type(index) is Slice:
+                if not all(type(i) in (int, type(None)) for i in (index.start, index.end, index.step)):
+                    return None
+                index = slice(index.start, index.end, index.step)
+
+            return lambda values: [
+                v for value in values for v in JSONSchemaQuery._index(value, index)]
+
+        if expr_type is Search:
+            search = expr._expr
+            if search.get_begin() is not search or search.get_next() is not None:
+                return None
+
+            step = JSONSchemaQuery._step(search)
+            if step is None or type(search) is Root:
+                return None
+
+            def find(values):
+                result = []
+                for value in values:
+                    JSONSchemaQuery._search(step, value, result)
+                return result
+            return find
+
+        return None
+
+    @staticmethod
+    def _name(value: object, name: str):
+        """
+        Returns the value of an attribute as a list, empty if not available
+        """
+        if isinstance(value, JSONSchemaObject):
+            if name in value.__attrs__:
+                return (value._materialize(name),)
+        elif type(value) is dict and name in value:
+            return (value[name],)
+        return ()
+
+    @staticmethod
+    def _items(value: object):
+        """
+        Returns the items of an array in the layout of its JSON, the values
+        of tuples are flat
+        """
+        if isinstance(value, JSONSchemaArrayView):
+            if not value._array._items.is_tuple:
+                return value
+            value = value.copy()
+
+        if isinstance(value, JSONSchemaArray) and value._items.is_tuple:
+            return value._items.to_list(value.__array__)
+
+        return value
+
+    @staticmethod
+    def _index(value: object, index: object):
+        """
+        Returns the items of an array at an index or slice
+        """
+        if not isinstance(value, (JSONSchemaArray, JSONSchemaArrayView, list)):
+            return ()
+        value = JSONSchemaQuery._items(value)
+        if type(index) is slice:
+            return list(value[index])
+        if -len(value) <= index < len(value):
+            return (value[index],)
+        return ()
+
+    @staticmethod
+    def _children(value: object, items: bool):
+        """
+        Returns the items of an array, or the attributes of an object
+        """
+        if isinstance(value, (JSONSchemaArray, JSONSchemaArrayView, list)):
+            return JSONSchemaQuery._items(value) if items else ()
+        if items:
+            return ()
+        if isinstance(value, JSONSchemaObject):
+            return [value._materialize(name) for name in value.__attrs__]
+        if type(value) is dict:
+            return value.values()
+        return ()
+
+    @staticmethod
+    def _search(step, value: object, result: list):
+        """
+        Evaluate step on value and all its descendants
+        """
+        result.extend(step((value,)))
+
+        if isinstance(value, (JSONSchemaArray, JSONSchemaArrayView, list)):
+            children = JSONSchemaQuery._items(value)
+        elif isinstance(value, (JSONSchemaObject, dict)):
+            children = JSONSchemaQuery._children(value, False)
+        else:
+            return
+
+        for child in children:
+            JSONSchemaQuery._search(step, child, result)
+
+    @staticmethod
+    def _plain(value: object):
+        """
+        Returns a copy of a tree made of dicts and lists
+        """
+        if isinstance(value, JSONSchemaObject):
+            return {k: JSONSchemaQuery._plain(v)
+                    for k, v in JSONSchemaObject._json_attrs(value).items()}
+        elif isinstance(value, (JSONSchemaArray, JSONSchemaArrayView)):
+            value = list(JSONSchemaQuery._items(value))
+
+        if type(value) is dict:
+            return {k: JSONSchemaQuery._plain(v) for k, v in value.items()}
+        if type(value) is list:
+            return [JSONSchemaQuery._plain(v) for v in value]
+        return value
+
+    def find(self, value: object):
+        """
+        Returns all the values matching the expression
+        """
+        if self.steps is None:
+            return self.expression.find(JSONSchemaQuery._plain(value))
+
+        values = [value]
+        for step in self.steps:
+            values = step(values)
+        return values
+
+
+class JSONSchemaPatch(object):
+    """
+    JSON Patch (RFC 6902) between two objects of the same schema. The
+    operations refer to the json of the objects (the values of tuples
+    are flat), the items of arrays with a x-key are compared by their
+    key instead of their position
+    """
+
+    @staticmethod
+    def diff(a: object, b: object):
+        """
+        Returns the patch which transforms a into b
+        """
+        patch = []
+        JSONSchemaPatch._diff(a, b, "", patch)
+        return patch
+
+    @staticmethod
+    def _pointer(path: str, key: object):
+        """
+        Returns the JSON pointer (RFC 6901) of key in path
+        """
+        return "{}/{}".format(path, str(key).replace("~", "~0").replace("/", "~1"))
+
+    @staticmethod
+    def _diff(a: object, b: object, path: str, patch: list):
+        """
+        Appends the operations which transform the value a into b
+        """
+        if a is b:
+            return
+
+        # objects of a schema might have different models, ie. compact ones
+        if isinstance(a, JSONSchemaObject) and isinstance(b, JSONSchemaObject) and \
+                a._schema_path == b._schema_path:
+            JSONSchemaPatch._diff_object(a, b, path, patch)
+
+        elif isinstance(a, JSONSchemaArray) and isinstance(b, JSONSchemaArray) and \
+                a._items.schema_path == b._items.schema_path and \
+                a._items.attribute_name == b._items.attribute_name:
+
+            # typed storages are compared in C
+            if type(a.__array__) is not list and a.__array__ == b.__array__:
+                return
+
+            if a._items.key is not None and not a._items.is_tuple:
+                JSONSchemaPatch._diff_keyed(a, b, path, patch)
+            else:
+                JSONSchemaPatch._diff_list(
+                    list(JSONSchemaQuery._items(a)), list(JSONSchemaQuery._items(b)), path, patch)
+
+        elif type(a) is dict and type(b) is dict:
+            JSONSchemaPatch._diff_dict(a, b, path, patch)
+
+        elif type(a) is list and type(b) is list:
+            JSONSchemaPatch._diff_list(a, b, path, patch)
+
+        elif JSONSchemaValidator._canonical(a) != JSONSchemaValidator._canonical(b):
+            patch.append({"op": "replace", "path": path, "value": JSONSchemaQuery._plain(b)})
+
+    @staticmethod
+    def _diff_object(a: object, b: object, path: str, patch: list):
+        """
+        Appends the operations of the attributes of two objects of a model
+        """
+        plan = a._plan
+        if plan is None:
+            plan = JSONSchemaPlan.compile(type(a))
+
+        attrs = JSONSchemaObject._json_attrs(b)
+        a_attrs = JSONSchemaObject._json_attrs(a)
+        for name, value in a_attrs.items():
+
+            pointer = JSONSchemaPatch._pointer(path, name)
+            if name not in attrs:
+                patch.append({"op": "remove", "path": pointer})
+                continue
+
+            other = attrs[name]
+            if value is other:
+                continue
+
+            # lazy attributes are only converted if their json differ
+            if name in plan.lazy:
+                raw_type = plan.lazy[name][0]
+                if type(value) is raw_type and type(other) is raw_type and \
+                        JSONSchemaValidator._canonical(value) == JSONSchemaValidator._canonical(other):
+                    continue
+                if type(value) is raw_type:
+                    value = a._materialize(name)
+                if type(other) is raw_type:
+                    other = b._materialize(name)
+
+            JSONSchemaPatch._diff(value, other, pointer, patch)
+
+        for name, value in attrs.items():
+            if name not in a_attrs:
+                patch.append({
+                    "op": "add", "path": JSONSchemaPatch._pointer(path, name),
+                    "value": JSONSchemaQuery._plain(value)})
+
+    @staticmethod
+    def _diff_dict(a: dict, b: dict, path: str, patch: list):
+        """
+        Appends the operations of the keys of two dicts
+        """
+        for key, value in a.items():
+            pointer = JSONSchemaPatch._pointer(path, key)
+            if key in b:
+                JSONSchemaPatch._diff(value, b[key], pointer, patch)
+            else:
+                patch.append({"op": "remove", "path": pointer})
+
+        for key, value in b.items():
+            if key not in a:
+                patch.append({
+                    "op": "add", "path": JSONSchemaPatch._pointer(path, key),
+                    "value": JSONSchemaQuery._plain(value)})
+
+    @staticmethod
+    def _diff_list(a: list, b: list, path: str, patch: list):
+        """
+        Appends the operations of the items of two lists by position
+        """
+        common = min(len(a), len(b))
+        for i in range(common):
+            JSONSchemaPatch._diff(a[i], b[i], JSONSchemaPatch._pointer(path, i), patch)
+
+        for i in range(common, len(b)):
+            patch.append({
+                "op": "add", "path": JSONSchemaPatch._pointer(path, i),
+                "value": JSONSchemaQuery._plain(b[i])})
+
+        # the last items are removed first so the indexes are still valid
+        for i in reversed(range(common, len(a))):
+            patch.append({"op": "remove", "path": JSONSchemaPatch._pointer(path, i)})
+
+    @staticmethod
+    def _diff_keyed(a: JSONSchemaArray, b: JSONSchemaArray, path: str, patch: list):
+        """
+        Appends the operations of the items of two keyed arrays, the items
+        are removed, moved and added by key and then compared
+        """
+        items_a = list(a)
+        items_b = list(b)
+        keys_a = [a._item_key(item) for item in items_a]
+        keys_b = [b._item_key(item) for item in items_b]
+
+        # without unique keys the items can only be compared by position
+        if len(set(keys_a)) != len(keys_a) or len(set(keys_b)) != len(keys_b):
+            JSONSchemaPatch._diff_list(items_a, items_b, path, patch)
+            return
+
+        by_key = dict(zip(keys_a, items_a))
+        current = keys_a
+
+        # remove the items without key in b, the last ones first
+        keys = set(keys_b)
+        for i in reversed(range(len(current))):
+            if current[i] not in keys:
+                patch.append({"op": "remove", "path": JSONSchemaPatch._pointer(path, i)})
+                del current[i]
+
+        for i, key in enumerate(keys_b):
+            pointer = JSONSchemaPatch._pointer(path, i)
+
+            if i < len(current) and current[i] == key:
+                JSONSchemaPatch._diff(by_key[key], items_b[i], pointer, patch)
+
+            elif key in by_key:
+                j = current.index(key, i)
+                patch.append({
+                    "op": "move", "from": JSONSchemaPatch._pointer(path, j), "path": pointer})
+                current.insert(i, current.pop(j))
+                JSONSchemaPatch._diff(by_key[key], items_b[i], pointer, patch)
+
+            else:
+                patch.append({
+                    "op": "add", "path": pointer, "value": JSONSchemaQuery._plain(items_b[i])})
+                current.insert(i, key)
+
+    @staticmethod
+    def apply(document: object, patch: list):
+        """
+        Applies a patch to a tree of dicts and lists, the document is
+        changed in place. Returns the patched document, which is a new
+        value if the whole document was replaced
+        """
+        for operation in patch:
+
+            op = operation.get("op")
+            path = operation.get("path")
+            if path is None:
+                raise ValueError("Patch operation without path")
+
+            if op == "add":
+                document = JSONSchemaPatch._add(
+                    document, path, JSONSchemaQuery._plain(operation["value"]))
+
+            elif op == "remove":
+                JSONSchemaPatch._remove(document, path)
+
+            elif op == "replace":
+                if path != "":
+                    JSONSchemaPatch._remove(document, path)
+                document = JSONSchemaPatch._add(
+                    document, path, JSONSchemaQuery._plain(operation["value"]))
+
+            elif op == "move":
+                if path.startswith(operation["from"] + "/"):
+                    raise ValueError("Can't move {} into itself".format(operation["from"]))
+                value = JSONSchemaPatch._get(document, operation["from"])
+                if operation["from"] != "":
+                    JSONSchemaPatch._remove(document, operation["from"])
+                document = JSONSchemaPatch._add(document, path, value)
+
+            elif op == "copy":
+                value = JSONSchemaPatch._get(document, operation["from"])
+                document = JSONSchemaPatch._add(document, path, JSONSchemaQuery._plain(value))
+
+            elif op == "test":
+                if JSONSchemaValidator._canonical(JSONSchemaPatch._get(document, path)) != \
+                        JSONSchemaValidator._canonical(operation["value"]):
+                    raise ValueError("Test of {} failed".format(path or "/"))
+
+            else:
+                raise ValueError("Unknown patch operation {}".format(op))
+
+        return document
+
+    @staticmethod
+    def _tokens(path: str):
+        """
+        Returns the reference tokens of a JSON pointer
+        """
+        if path == "":
+            return []
+        if not path.startswith("/"):
+            raise ValueError("Invalid JSON pointer {}".format(path))
+        return [token.replace("~1", "/").replace("~0", "~") for token in path[1:].split("/")]
+
+    @staticmethod
+    def _index(container: list, token: str, path: str, append: bool = False):
+        """
+        Returns the list index of a token, with append "-" and the length
+        of the list are valid
+        """
+        if append and token == "-":
+            return len(container)
+
+        if not token.isdigit() or (token != "0" and token.startswith("0")):
+            raise ValueError("Invalid index in {}".format(path))
+
+        index = int(token)
+        if index > len(container) or (index == len(container) and not append):
+            raise ValueError("Index out of bounds in {}".format(path))
+        return index
+
+    @staticmethod
+    def _parent(document: object, path: str):
+        """
+        Returns the container of the value at path and its token
+        """
+        tokens = JSONSchemaPatch._tokens(path)
+        value = document
+        for token in tokens[:-1]:
+            if type(value) is dict and token in value:
+                value = value[token]
+            elif type(value) is list:
+                value = value[JSONSchemaPatch._index(value, token, path)]
+            else:
+                raise ValueError("{} does not exist".format(path))
+        return value, tokens[-1]
+
+    @staticmethod
+    def _get(document: object, path: str):
+        """
+        Returns the value at path
+        """
+        if path == "":
+            return document
+
+        container, token = JSONSchemaPatch._parent(document, path)
+        if type(container) is dict and token in container:
+            return container[token]
+        if type(container) is list:
+            return container[JSONSchemaPatch._index(container, token, path)]
+        raise ValueError("{} does not exist".format(path))
+
+    @staticmethod
+    def _add(document: object, path: str, value: object):
+        """
+        Adds a value at path, returns the document
+        """
+        if path == "":
+            return value
+
+        container, token = JSONSchemaPatch._parent(document, path)
+        if type(container) is dict:
+            container[token] = value
+        elif type(container) is list:
+            container.insert(JSONSchemaPatch._index(container, token, path, True), value)
+        else:
+            raise ValueError("{} does not exist".format(path))
+        return document
+
+    @staticmethod
+    def _remove(document: object, path: str):
+        """
+        Removes the value at path
+        """
+        if path == "":
+            raise ValueError("Can't remove the whole document")
+
+        container, token = JSONSchemaPatch._parent(document, path)
+        if type(container) is dict and token in container:
+            del container[token]
+        elif type(container) is list:
+            del container[JSONSchemaPatch._index(container, token, path)]
+        else:
+            raise ValueError("{} does not exist".format(path))
+
+
+class JSONSchemaValidator(object):
+    """
+    Draft-07 validator compiled from a schema. Every keyword is compiled
+    once into a closure raising JSONSchemaValidationError, the closures
+    of a schema are chained into a single validator. The validators accept
+    JSONSchemaObject and JSONSchemaArray as well as plain JSON values
+    For more information check:
+    https://json-schema.org/draft-07/json-schema-validation.html
+    """
+
+    # canonical path -> validator of the schema, None if nothing to check
+    _validators = {}
+
+    # canonical path -> columns checked by validate_many, None if the
+    # documents must be validated one by one
+    _batch_plans = {}
+
+    # the keywords validate_many checks column by column
+    _column_keywords = frozenset((
+        "type", "enum", "minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum", "multipleOf"))
+    _column_types = {
+        "string": (str,),
+        "integer": (int, float),
+        "number": (int, float),
+        "boolean": (bool,),
+        "null": (type(None),),
+        "array": (list,),
+        "object": (dict,)
+    }
+
+    # the keywords of the schema which can be validated by columns
+    _batch_keywords = frozenset((
+        "$schema", "$id", "$comment", "title", "description", "definitions", "default",
+        "type", "properties", "required"))
+
+    _number_types = frozenset((int, float))
+    _canonical_types = frozenset((bool, list, dict))
+
+    _types = {
+        "string": lambda v: type(v) is str,
+        "integer": lambda v: type(v) is int or type(v) is float and v.is_integer(),
+        "number": lambda v: type(v) is int or type(v) is float,
+        "boolean": lambda v: type(v) is bool,
+        "null": lambda v: v is None,
+        "array": lambda v: isinstance(v, (list, tuple, JSONSchemaArray, JSONSchemaArrayView)),
+        "object": lambda v: isinstance(v, (dict, JSONSchemaObject))
+    }
+
+    _formats = {
+        "date-time": re.compile(
+            r"^\d{4}-\d\d-\d\d[Tt ]\d\d:\d\d:\d\d(\.\d+)?([Zz]|[+-]\d\d:\d\d)$").match,
+        "date": re.compile(r"^\d{4}-\d\d-\d\d$").match,
+        "time": re.compile(r"^\d\d:\d\d:\d\d(\.\d+)?([Zz]|[+-]\d\d:\d\d)?$").match,
+        "email": re.compile(r"^[^@\s]+@[^@\s]+$").match,
+        "hostname": re.compile(
+            r"^(?=.{1,253}$)[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?"
+            r"(\.[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?)*$").match,
+        "ipv4": re.compile(
+            r"^((25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)$").match,
+        "uri": re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*:\S*$").match,
+        "uuid": re.compile(
+            r"^[0-9a-fA-F]{8}-([0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12}$").match
+    }
+
+    @staticmethod
+    def get(schema_path: str):
+        """
+        Returns the validator of a schema or definition, None if the schema
+        has nothing to check
+        """
+        try:
+            return JSONSchemaValidator._validators[schema_path]
+        except KeyError:
+            pass
+
+        schema_path = JSONSchemaRegistry.resolve(schema_path, schema_path)
+        validator = JSONSchemaValidator.compile(
+            JSONSchemaObject.get_schema(schema_path), schema_path.split("/")[0])
+        JSONSchemaValidator._validators[schema_path] = validator
+        return validator
+
+    @staticmethod
+    def validate_many(schema_name: str, documents, use_numpy: bool = False):
+        """
+        Validates a batch of documents (dicts or JSON strings) of a schema,
+        the properties are checked column by column. Returns a bitmap with
+        the bit i (bitmap[i >> 3] >> (i & 7) & 1) set if the document i is
+        not valid. With use_numpy the bounds of the float columns are
+        checked with numpy
+        """
+        decode = JSONSchemaObject._decoder.decode
+        documents = [decode(d) if type(d) is str else d for d in documents]
+
+        count = len(documents)
+        bitmap = bytearray((count + 7) // 8)
+
+        def mark(indexes):
+            for i in indexes:
+                bitmap[i >> 3] |= 1 << (i & 7)
+
+        schema_path = JSONSchemaRegistry.resolve(schema_name, schema_name)
+        plan = JSONSchemaValidator._batch_plan(schema_path)
+
+        # schemas with keywords for the whole document are validated one
+        # document at a time
+        if plan is None:
+            validator = JSONSchemaValidator.get(schema_path)
+            for i, document in enumerate(documents):
+                try:
+                    if validator is not None:
+                        validator(document)
+                except JSONSchemaValidationError:
+                    mark((i,))
+            return bitmap
+
+        if not {dict}.issuperset(map(type, documents)):
+            mark(i for i, document in enumerate(documents) if type(document) is not dict)
+            documents = [document if type(document) is dict else {} for document in documents]
+
+        if use_numpy and numpy is None:
+            raise JSONSchemaException("numpy is not available")
+
+        # the columns are scanned by the iterators of the standard library,
+        # only the invalid values are handled in python. The missing values
+        # have the type object
+        missing = object()
+        indexes = range(count)
+
+        for name, required, types, integer, enum, bounds, validator in plan:
+
+            column = list(map(dict.get, documents, repeat(name, count), repeat(missing, count)))
+
+            if required:
+                mark(compress(indexes, map(is_, column, repeat(missing, count))))
+
+            if types is not None:
+                value_types = list(map(type, column))
+                invalid = set(value_types).difference(types)
+                if invalid:
+                    mark(compress(indexes, map(invalid.__contains__, value_types)))
+
+                if integer and float in value_types:
+                    floats = list(compress(indexes, map(is_, value_types, repeat(float, count))))
+                    mark(i for i in floats if not column[i].is_integer())
+
+            if enum is not None:
+                # booleans are equal to 0 and 1 but are not valid numbers,
+                # they are compared with the canonical values as lists and dicts
+                if JSONSchemaValidator._canonical_types.isdisjoint(map(type, column)):
+                    invalid = set(column).difference(enum)
+                    invalid.discard(missing)
+                    if invalid:
+                        mark(compress(indexes, map(invalid.__contains__, column)))
+                else:
+                    canonical = JSONSchemaValidator._canonical
+                    mark(i for i, value in enumerate(column)
+                         if value is not missing and canonical(value) not in enum)
+
+            if bounds:
+                is_number = list(map(
+                    JSONSchemaValidator._number_types.__contains__, map(type, column)))
+                number_indexes = list(compress(indexes, is_number))
+                numbers = list(compress(column, is_number))
+
+                # the integers are compared in python, as float64 loses
+                # precision above 2**53
+                if use_numpy and int not in set(map(type, numbers)):
+                    mark(JSONSchemaValidator._numpy_bounds(number_indexes, numbers, bounds))
+                else:
+                    for keyword, bound, compare in bounds:
+                        mark(compress(number_indexes, map(
+                            not_, map(compare, numbers, repeat(bound, len(numbers))))))
+
+            if validator is not None:
+                for i, value in enumerate(column):
+                    if value is missing:
+                        continue
+                    try:
+                        validator(value)
+                    except JSONSchemaValidationError:
+                        mark((i,))
+
+        return bitmap
+
+    @staticmethod
+    def _numpy_bounds(indexes: list, numbers: list, bounds: tuple):
+        """
+        Returns the indexes of the floats out of bounds, the quotients of
+        multipleOf are rounded like in _multiple_of
+        """
+        indexes = numpy.array(indexes, dtype=numpy.int64)
+        values = numpy.array(numbers, dtype=numpy.float64)
+
+        invalid = numpy.zeros(len(numbers), dtype=bool)
+        for keyword, bound, compare in bounds:
+            if keyword == "multipleOf":
+                quotient = values / bound
+                invalid |= ~numpy.isfinite(quotient) | (numpy.abs(quotient - numpy.round(quotient)) >
+                                                        1e-9 * numpy.maximum(1.0, numpy.abs(quotient)))
+            else:
+                invalid |= ~compare(values, bound)
+
+        return indexes[invalid].tolist()
+
+    @staticmethod
+    def invalid(bitmap: bytearray):
+        """
+        Returns the indexes of the invalid documents of a bitmap
+        """
+        return [i for i in range(len(bitmap) * 8) if bitmap[i >> 3] >> (i & 7) & 1]
+
+    @staticmethod
+    def _batch_plan(schema_path: str):
+        """
+        Returns the columns of a schema checked by validate_many, every
+        column has the property name, if it is required, the python types,
+        if it is an integer, the enum, the numeric bounds and the validator
+        of the other keywords
+        """
+        if schema_path in JSONSchemaValidator._batch_plans:
+            return JSONSchemaValidator._batch_plans[schema_path]
+
+        schema = JSONSchemaObject.get_schema(schema_path)
+        schema_name = schema_path.split("/")[0]
+
+        plan = None
+        if JSONSchemaValidator._batch_keywords.issuperset(schema):
+
+            required = schema.get("required", ())
+            properties = schema.get("properties", {})
+            plan = []
+
+            for name, property_info in properties.items():
+
+                # references are validated by the validator of their schema
+                if "$ref" in property_info:
+                    plan.append((name, name in required, None, False, None, (),
+                                 JSONSchemaValidator.compile(property_info, schema_name)))
+                    continue
+
+                types = None
+                integer = False
+                if "type" in property_info:
+                    type_names = property_info["type"]
+                    if not isinstance(type_names, list):
+                        type_names = [type_names]
+                    try:
+                        types = frozenset(
+                            py_type for type_name in type_names
+                            for py_type in JSONSchemaValidator._column_types[type_name])
+                    except KeyError as e:
+                        raise JSONSchemaException("Unknown data type {}".format(e.args[0]))
+                    types |= {object}
+                    integer = "integer" in type_names and "number" not in type_names
+
+                enum = None
+                if "enum" in property_info:
+                    enum = frozenset(JSONSchemaValidator._canonical(v) for v in property_info["enum"])
+
+                # the same comparisons work for python and numpy numbers
+                bounds = tuple(
+                    (keyword, property_info[keyword], compare) for keyword, compare in (
+                        ("minimum", ge),
+                        ("maximum", le),
+                        ("exclusiveMinimum", gt),
+                        ("exclusiveMaximum", lt),
+                        ("multipleOf", JSONSchemaValidator._multiple_of))
+                    if keyword in property_info)
+
+                validator = JSONSchemaValidator.compile(
+                    {k: v for k, v in property_info.items()
+                     if k not in JSONSchemaValidator._column_keywords}, schema_name)
+
+                plan.append((name, name in required, types, integer, enum, bounds, validator))
+
+            # required attributes not declared in the properties
+            for name in required:
+                if name not in properties:
+                    plan.append((name, True, None, False, None, (), None))
+
+            plan = tuple(plan)
+
+        JSONSchemaValidator._batch_plans[schema_path] = plan
+        return plan
+
+    @staticmethod
+    def compile(schema: dict, schema_name: str, shallow: bool = False, typed: bool = True):
+        """
+        Compile a schema into a validator, None if there is nothing to check.
+        With shallow the references are only checked to be objects, they are
+        validated when the object is created, and without typed the type of
+        the value is not checked
+        """
+        if schema is True or schema == {}:
+            return None
+        if schema is False:
+            return JSONSchemaValidator._fail("false", "no value is allowed")
+
+        checks = []
+
+        # the other keywords of a reference are ignored
+        if "$ref" in schema:
+            if shallow:
+                if typed:
+                    checks.append(JSONSchemaValidator._type(["object"]))
+            else:
+                checks.append(JSONSchemaValidator._ref(
+                    JSONSchemaRegistry.resolve(schema_name, schema["$ref"])))
+            return JSONSchemaValidator._chain(checks)
+
+        if typed and "type" in schema:
+            checks.append(JSONSchemaValidator._type(schema["type"]))
+
+        for keywords, compile_keywords in JSONSchemaValidator._keywords:
+            if not keywords.isdisjoint(schema):
+                checks.append(compile_keywords(schema, schema_name, shallow))
+
+        return JSONSchemaValidator._chain(checks)
+
+    @staticmethod
+    def _chain(checks: list):
+        """
+        Returns a validator running all the checks
+        """
+        if not checks:
+            return None
+        if len(checks) == 1:
+            return checks[0]
+
+        checks = tuple(checks)
+
+        def validate(value):
+            for check in checks:
+                check(value)
+        return validate
+
+    @staticmethod
+    def _fail(keyword: str, message: str):
+        def validate(value):
+            raise JSONSchemaValidationError(keyword, message)
+        return validate
+
+    @staticmethod
+    def _canonical(value: object):
+        """
+        Returns a hashable value equal for the same JSON values, booleans
+        are not equal to numbers
+        """
+        if type(value) is bool:
+            return (bool, value)
+        if isinstance(value, JSONSchemaObject):
+            value = value.__attrs__
+        elif isinstance(value, (JSONSchemaArray, JSONSchemaArrayView)):
+            value = list(value)
+
+        if isinstance(value, (dict, JSONSchemaRecord)):
+            return (dict, frozenset((k, JSONSchemaValidator._canonical(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return (list, tuple(JSONSchemaValidator._canonical(v) for v in value))
+        return value
+
+    @staticmethod
+    def _items(value: object):
+        """
+        Returns the items of an array as in its JSON representation
+        """
+        if isinstance(value, JSONSchemaArrayView):
+            value = value.copy()
+        if isinstance(value, JSONSchemaArray):
+            if value._items.typecode == "b":
+                return [bool(v) for v in value.__array__]
+            return value.__array__
+        return value
+
+    @staticmethod
+    def _attrs(value: object):
+        """
+        Returns the attributes of an object as a dict
+        """
+        if isinstance(value, JSONSchemaObject):
+            return value.__attrs__
+        return value
+
+    @staticmethod
+    def _nested(validate, value: object, key: object):
+        """
+        Validates a nested value, the key is added to the path of the error
+        """
+        try:
+            validate(value)
+        except JSONSchemaValidationError as e:
+            e.path = "/{}{}".format(key, e.path)
+            raise
+
+    @staticmethod
+    def _ref(path: str):
+        # the validator is only compiled when used, so schemas can
+        # reference themselves
+        def validate(value):
+            validator = JSONSchemaValidator.get(path)
+            if validator is not None:
+                validator(value)
+        return validate
+
+    @staticmethod
+    def _type(types: list):
+        if not isinstance(types, list):
+            types = [types]
+
+        for name in types:
+            if name not in JSONSchemaValidator._types:
+                raise JSONSchemaException("Unknown data type {}".format(name))
+
+        checks = tuple(JSONSchemaValidator._types[name] for name in types)
+        message = "value is not of type {}".format(" or ".join(types))
+
+        def validate(value):
+            for check in checks:
+                if check(value):
+                    return
+            raise JSONSchemaValidationError("type", message)
+        return validate
+
+    @staticmethod
+    def _compile_enum(schema: dict, schema_name: str, shallow: bool):
+        canonical = JSONSchemaValidator._canonical
+        values = frozenset(canonical(v) for v in schema["enum"])
+        message = "value is not one of {}".format(schema["enum"])
+
+        def validate(value):
+            if canonical(value) not in values:
+                raise JSONSchemaValidationError("enum", message)
+        return validate
+
+    @staticmethod
+    def _compile_const(schema: dict, schema_name: str, shallow: bool):
+        canonical = JSONSchemaValidator._canonical
+        const = canonical(schema["const"])
+        message = "value is not {}".format(schema["const"])
+
+        def validate(value):
+            if canonical(value) != const:
+                raise JSONSchemaValidationError("const", message)
+        return validate
+
+    @staticmethod
+    def _multiple_of(value: object, bound: object):
+        """
+        Check if value is a multiple of bound, the quotient of floats is
+        rounded (ie. 0.3 / 0.1 is 2.9999999999999996)
+        """
+        if type(value) is int and type(bound) is int:
+            return value % bound == 0
+
+        quotient = value / bound
+        if not isfinite(quotient):
+            return False
+        return abs(quotient - round(quotient)) <= 1e-9 * max(1.0, abs(quotient))
+
+    @staticmethod
+    def _compile_number(schema: dict, schema_name: str, shallow: bool):
+        bounds = []
+        for keyword, compare in (
+                ("minimum", lambda v, b: v >= b),
+                ("maximum", lambda v, b: v <= b),
+                ("exclusiveMinimum", lambda v, b: v > b),
+                ("exclusiveMaximum", lambda v, b: v < b),
+                ("multipleOf", JSONSchemaValidator._multiple_of)):
+            if keyword in schema:
+                bounds.append((keyword, schema[keyword], compare))
+
+        def validate(value):
+            if type(value) is not int and type(value) is not float:
+                return
+            for keyword, bound, compare in bounds:
+                if not compare(value, bound):
+                    raise JSONSchemaValidationError(
+                        keyword, "value {} does not match {} {}".format(value, keyword, bound))
+        return validate
+
+    @staticmethod
+    def _compile_string(schema: dict, schema_name: str, shallow: bool):
+        min_length = schema.get("minLength", 0)
+        max_length = schema.get("maxLength")
+        pattern = re.compile(schema["pattern"]) if "pattern" in schema else None
+        format_match = JSONSchemaValidator._formats.get(schema.get("format"))
+
+        def validate(value):
+            if type(value) is not str:
+                return
+            if len(value) < min_length:
+                raise JSONSchemaValidationError("minLength", "value is shorter than {}".format(min_length))
+            if max_length is not None and len(value) > max_length:
+                raise JSONSchemaValidationError("maxLength", "value is longer than {}".format(max_length))
+            if pattern is not None and pattern.search(value) is None:
+                raise JSONSchemaValidationError(
+                    "pattern", "value does not match {}".format(pattern.pattern))
+            if format_match is not None and format_match(value) is None:
+                raise JSONSchemaValidationError(
+                    "format", "value is not a valid {}".format(schema["format"]))
+        return validate
+
+    @staticmethod
+    def _compile_array(schema: dict, schema_name: str, shallow: bool):
+        min_items = schema.get("minItems", 0)
+        max_items = schema.get("maxItems")
+        unique = schema.get("uniqueItems", False)
+        contains = None
+        if "contains" in schema:
+            contains = JSONSchemaValidator.compile(schema["contains"], schema_name, shallow)
+
+        # like the arrays of our models, tuples are repeated N items
+        items = schema.get("items", {})
+        if isinstance(items, list):
+            items = [JSONSchemaValidator.compile(item, schema_name, shallow) for item in items]
+            if not any(items):
+                items = None
+        else:
+            items = JSONSchemaValidator.compile(items, schema_name, shallow)
+            items = None if items is None else [items]
+
+        nested = JSONSchemaValidator._nested
+        canonical = JSONSchemaValidator._canonical
+
+        def validate(value):
+            if not JSONSchemaValidator._types["array"](value):
+                return
+            values = JSONSchemaValidator._items(value)
+
+            if len(values) < min_items:
+                raise JSONSchemaValidationError("minItems", "array has less than {} items".format(min_items))
+            if max_items is not None and len(values) > max_items:
+                raise JSONSchemaValidationError("maxItems", "array has more than {} items".format(max_items))
+            if unique and len(set(map(canonical, values))) != len(values):
+                raise JSONSchemaValidationError("uniqueItems", "array items are not unique")
+
+            if items is not None:
+                arity = len(items)
+                for i, item in enumerate(values):
+                    validate_item = items[i % arity]
+                    if validate_item is not None:
+                        nested(validate_item, item, i)
+
+            if contains is not None:
+                for item in values:
+                    try:
+                        contains(item)
+                        break
+                    except JSONSchemaValidationError:
+                        pass
+                else:
+                    raise JSONSchemaValidationError("contains", "no array item matches contains")
+        return validate
+
+    @staticmethod
+    def _compile_object(schema: dict, schema_name: str, shallow: bool):
+        compile_schema = JSONSchemaValidator.compile
+
+        required = tuple(schema.get("required", ()))
+        min_properties = schema.get("minProperties", 0)
+        max_properties = schema.get("maxProperties")
+
+        properties = {}
+        for name, property_info in schema.get("properties", {}).items():
+            validator = compile_schema(property_info, schema_name, shallow)
+            if validator is not None:
+                properties[name] = validator
+
+        patterns = tuple(
+            (re.compile(pattern), compile_schema(property_info, schema_name, shallow))
+            for pattern, property_info in schema.get("patternProperties", {}).items())
+
+        additional = schema.get("additionalProperties", True)
+        if additional is not True:
+            additional = compile_schema(additional, schema_name, shallow)
+        else:
+            additional = None
+        known = frozenset(schema.get("properties", ()))
+
+        names = None
+        if "propertyNames" in schema:
+            names = compile_schema(schema["propertyNames"], schema_name, shallow)
+
+        dependencies = []
+        for name, dependency in schema.get("dependencies", {}).items():
+            if isinstance(dependency, list):
+                dependencies.append((name, tuple(dependency), None))
+            else:
+                dependencies.append((name, (), compile_schema(dependency, schema_name, shallow)))
+
+        nested = JSONSchemaValidator._nested
+
+        def validate(value):
+            if not isinstance(value, (dict, JSONSchemaObject)):
+                return
+            attrs = JSONSchemaValidator._attrs(value)
+
+            # objects have all the attributes of their schema, the required
+            # ones must be set or loaded and the ones not set are not validated
+            unset = ()
+            if isinstance(value, JSONSchemaObject):
+                unset = value.__unset__
+
+            for name in required:
+                if name not in attrs or name in unset:
+                    raise JSONSchemaValidationError("required", "{} is required".format(name))
+            if len(attrs) < min_properties:
+                raise JSONSchemaValidationError(
+                    "minProperties", "object has less than {} properties".format(min_properties))
+            if max_properties is not None and len(attrs) > max_properties:
+                raise JSONSchemaValidationError(
+                    "maxProperties", "object has more than {} properties".format(max_properties))
+
+            for name, validator in properties.items():
+                if name in attrs and name not in unset:
+                    nested(validator, attrs[name], name)
+
+            if patterns or additional is not None or names is not None:
+                for name, item in attrs.items():
+                    if names is not None:
+                        nested(names, name, name)
+
+                    matched = name in known
+                    for pattern, validator in patterns:
+                        if pattern.search(name) is not None:
+                            matched = True
+                            if validator is not None:
+                                nested(validator, item, name)
+
+                    if not matched and additional is not None:
+                        nested(additional, item, name)
+
+            for name, dependency, validator in dependencies:
+                if name not in attrs:
+                    continue
+                for dependency_name in dependency:
+                    if dependency_name not in attrs:
+                        raise JSONSchemaValidationError(
+                            "dependencies", "{} requires {}".format(name, dependency_name))
+                if validator is not None:
+                    validator(value)
+        return validate
+
+    @staticmethod
+    def _compile_combinators(schema: dict, schema_name: str, shallow: bool):
+        compile_schema = JSONSchemaValidator.compile
+
+        def compile_all(keyword):
+            return tuple(
+                validator or (lambda value: None)
+                for validator in (compile_schema(s, schema_name, shallow) for s in schema.get(keyword, ())))
+
+        all_of = compile_all("allOf")
+        any_of = compile_all("anyOf")
+        one_of = compile_all("oneOf")
+        not_schema = compile_schema(schema["not"], schema_name, shallow) if "not" in schema else None
+
+        condition = None
+        if "if" in schema:
+            condition = compile_schema(schema["if"], schema_name, shallow)
+            then_schema = compile_schema(schema.get("then", True), schema_name, shallow)
+            else_schema = compile_schema(schema.get("else", True), schema_name, shallow)
+
+        def matches(validator, value):
+            try:
+                validator(value)
+                return True
+            except JSONSchemaValidationError:
+                return False
+
+        def validate(value):
+            for validator in all_of:
+                validator(value)
+            if any_of and not any(matches(v, value) for v in any_of):
+                raise JSONSchemaValidationError("anyOf", "value does not match any schema")
+            if one_of and sum(matches(v, value) for v in one_of) != 1:
+                raise JSONSchemaValidationError("oneOf", "value does not match exactly one schema")
+            if not_schema is not None and matches(not_schema, value):
+                raise JSONSchemaValidationError("not", "value matches a not schema")
+            if "if" in schema and (condition is None or matches(condition, value)):
+                if then_schema is not None:
+                    then_schema(value)
+            elif "if" in schema and else_schema is not None:
+                else_schema(value)
+        return validate
+
+
+class JSONSchemaRegistry(object):
+    """
+    The registry of the schemas. When a schema is registered its references
+    ($ref) and definitions anchors (#/definitions/...) are resolved to the
+    canonical path of the referenced schema (ie. node/definitions/port),
+    the paths are interned and every name already looked up is found with
+    a single dict lookup
+    """
+
+    # canonical path -> schema or definition
+    _schemas = {}
+
+    # any name or path already looked up -> schema or definition
+    _aliases = {}
+
+    # (schema name, $ref) -> canonical path
+    _refs = {}
+
+    # $id -> schema name
+    _ids = {}
+
+    # schema name -> names of the schemas it references
+    _dependencies = {}
+
+    @staticmethod
+    def register(name: str, schema: dict):
+        """
+        Register a schema and its definitions, and resolve its references
+        """
+        name = intern(name.lower())
+
+        # drop the definitions of a previous version of the schema
+        prefix = name + "/"
+        for path in [p for p in JSONSchemaRegistry._schemas if p == name or p.startswith(prefix)]:
+            del JSONSchemaRegistry._schemas[path]
+
+        JSONSchemaRegistry._schemas[name] = schema
+        for definition_name, definition in schema.get("definitions", {}).items():
+            path = intern("{}/definitions/{}".format(name, definition_name).lower())
+            JSONSchemaRegistry._schemas[path] = definition
+
+        if "$id" in schema:
+            JSONSchemaRegistry._ids[str(schema["$id"])] = name
+
+        # the references of the other schemas are resolved again on demand
+        JSONSchemaRegistry._aliases.clear()
+        JSONSchemaRegistry._refs.clear()
+
+        dependencies = set()
+        for ref in JSONSchemaRegistry._find_refs(schema):
+            root = JSONSchemaRegistry.resolve(name, ref).split("/")[0]
+            if root != name:
+                dependencies.add(intern(root))
+
+        JSONSchemaRegistry._dependencies[name] = frozenset(dependencies)
+
+    @staticmethod
+    def _find_refs(value: object):
+        """
+        Returns all the references of a schema
+        """
+        if isinstance(value, dict):
+            if "$ref" in value:
+                yield str(value["$ref"])
+            for item in value.values():
+                yield from JSONSchemaRegistry._find_refs(item)
+
+        elif isinstance(value, list):
+            for item in value:
+                yield from JSONSchemaRegistry._find_refs(item)
+
+    @staticmethod
+    def resolve(schema_name: str, ref: str):
+        """
+        Returns the canonical path of a reference of the schema_name schema
+        """
+        key = (schema_name, ref)
+        path = JSONSchemaRegistry._refs.get(key)
+        if path is not None:
+            return path
+
+        ref = str(ref)
+        if ref.startswith("#"):
+            # anchors are relative to our schema
+            path = schema_name + ref[1:]
+        else:
+            base, _, fragment = ref.partition("#")
+
+            # the references might be the $id of a schema or an url or
+            # file name, ie. http://test.local/role.json -> role
+            if base in JSONSchemaRegistry._ids:
+                base = JSONSchemaRegistry._ids[base]
+            elif "://" in base or base.endswith(".json"):
+                base = base.rsplit("/", 1)[-1]
+                if base.endswith(".json"):
+                    base = base[:-len(".json")]
+
+            path = base + fragment
+
+        path = intern(path.lower())
+        JSONSchemaRegistry._refs[key] = path
+        return path
+
+    @staticmethod
+    def get(name: str):
+        """
+        Returns a schema or a definition, the schema and the schemas it
+        references are retrieved if not available
+        """
+        schema = JSONSchemaRegistry._aliases.get(name)
+        if schema is not None:
+            return schema
+
+        # we always user lowercase
+        path = name.lower()
+        root = path
+        definition = None
+
+        # we are trying to get a definition
+        if path.find("definitions") > 0:
+            parts = path.split('/')
+
+            if len(parts) < 3:
+                raise JSONSchemaException("Invalid definition name")
+
+            root = parts[0]
+            definition = parts[2]
+
+        # Check if schema is already available
+        if root not in JSONSchemaRegistry._schemas:
+            JSONSchemaRegistry.load(root)
+
+        if definition is None:
+            # We want the all schema
+            schema = JSONSchemaRegistry._schemas[root]
+
+        else:
+            path = "{}/definitions/{}".format(root, definition)
+            schema = JSONSchemaRegistry._schemas.get(path)
+            if schema is None:
+
+                # Check if schema have the definitions
+                if "definitions" not in JSONSchemaRegistry._schemas[root]:
+                    raise JSONSchemaException(
+                        "Schema {} does not provide definitions".format(root))
+
+                raise JSONSchemaException(
+                    "Definition {} not in schema {}".format(definition, root))
+
+        JSONSchemaRegistry._aliases[name] = schema
+        return schema
+
+    @staticmethod
+    def load(name: str):
+        """
+        Retrieve a schema and all the schemas it references
+        """
+        pending = {name}
+        while pending:
+
+            # the schemas referenced at the same depth are retrieved together
+            names = sorted(n for n in pending if n not in JSONSchemaRegistry._schemas)
+            JSONSchemaObject._retrieve_schemas(names)
+
+            pending = set()
+            for name in names:
+                pending.update(JSONSchemaRegistry._dependencies[name])
+
+    @staticmethod
+    def dependencies(name: str):
+        """
+        Returns the names of all the schemas referenced by a schema, directly
+        or by the schemas it references
+        """
+        name = name.lower()
+        JSONSchemaRegistry.get(name)
+
+        result = set()
+        pending = [name]
+        while pending:
+            for dependency in JSONSchemaRegistry._dependencies.get(pending.pop(), ()):
+                if dependency not in result:
+                    JSONSchemaRegistry.get(dependency)
+                    result.add(dependency)
+                    pending.append(dependency)
+
+        return result
+
+    @staticmethod
+    def snapshot(names: list):
+        """
+        Returns the resolved state of the registry for some schemas
+        """
+        names = set(name.lower() for name in names)
+        return (
+            {path: schema for path, schema in JSONSchemaRegistry._schemas.items()
+             if path.split("/")[0] in names},
+            {key: path for key, path in JSONSchemaRegistry._refs.items() if key[0] in names},
+            {schema_id: name for schema_id, name in JSONSchemaRegistry._ids.items() if name in names},
+            {name: JSONSchemaRegistry._dependencies[name] for name in names})
+
+    @staticmethod
+    def restore(state: tuple):
+        """
+        Install a resolved state of the registry, the paths are interned
+        again since unpickled strings are not
+        """
+        schemas, refs, ids, dependencies = state
+
+        JSONSchemaRegistry._schemas.update(
+            (intern(path), schema) for path, schema in schemas.items())
+        JSONSchemaRegistry._refs.update(
+            (key, intern(path)) for key, path in refs.items())
+        JSONSchemaRegistry._ids.update(
+            (schema_id, intern(name)) for schema_id, name in ids.items())
+        JSONSchemaRegistry._dependencies.update(
+            (intern(name), frozenset(intern(d) for d in names)) for name, names in dependencies.items())
+        JSONSchemaRegistry._aliases.clear()
+
+    @staticmethod
+    def clear():
+        """
+        Remove all the schemas of the registry
+        """
+        JSONSchemaRegistry._schemas.clear()
+        JSONSchemaRegistry._aliases.clear()
+        JSONSchemaRegistry._refs.clear()
+        JSONSchemaRegistry._ids.clear()
+        JSONSchemaRegistry._dependencies.clear()
+
+
+class JSONSchemaObject(object):
+    '''
+    A general schema, the definition is stored in a json file
+    '''
+    __slots__ = ("__attrs__", "__dirty__", "__unset__", "__weakref__")
+
+    _schemas_url = "file://schema"
+    _schemas_version = "latest"
+    _schemas_http_folder = None
+    _schemas_http_max_age = 300
+    _schemas_http_timeout = 10
+    _schemas_http_cache = {}
+    _schemas_cache = {}
+    _models_cache = {}
+    _compiled_cache = {}
+    _decoder = JSONDecoder()
+    _validation_mode = "strict"
+    _compact_schemas = set()
+
+    # Set on the classes generated by the schema compiler
+    _compiled = False
+    _schema_name = None
+    _schema_path = None
+    _plan = None
+    _record = None
+
+
+    class JSONSchemaEncoder(JSONEncoder):
+        '''
+        SchemaModel to JSON encoder
+        '''
+
+        def encode(self, o):
+            # with the default settings objects and arrays are encoded by
+            # our serializer
+            if isinstance(o, (JSONSchemaObject, JSONSchemaArray)) and \
+                    self.indent is None and self.ensure_ascii and self.allow_nan and \
+                    not self.sort_keys and not self.skipkeys and \
+                    self.item_separator == ", " and self.key_separator == ": ":
+                return JSONSchemaSerializer.encode(o)
+
+            return super().encode(o)
+
+        def default(self, o):   # pylint: disable=method-hidden
+            if isinstance(o, JSONSchemaObject):
+                attrs = JSONSchemaObject._json_attrs(o)
+                if type(attrs) is not dict:
+                    return dict(attrs.items())
+                return attrs
+            elif isinstance(o, JSONSchemaArray):
+                return o._items.to_list(o.__array__)
+            elif isinstance(o, JSONSchemaArrayView):
+                return o.copy()
+            elif isinstance(o,uuid.UUID):
+                return str(o)
+            else:
+                # call base class implementation which takes care of
+                # raising exceptions for unsupported types
+                return JSONEncoder.default(self, o)
+
+    def to_json(self):
+        '''
+        Serialize class to json
+        '''
+        return JSONSchemaSerializer.encode_object(self)
+
+    def to_json_stream(self, fp, buffer_size: int = 65536):
+        '''
+        Serialize class to json into a file like object, text or binary
+        '''
+        JSONSchemaSerializer.dump(self, fp, buffer_size)
+
+    def to_bytes(self):
+        '''
+        Serialize class to the binary format of JSONSchemaCodec
+        '''
+        return JSONSchemaCodec.encode(self)
+
+    @staticmethod
+    def from_bytes(data: bytes):
+        '''
+        Deserialize class from the binary format of JSONSchemaCodec, the
+        document has the schema of the object and it is not validated
+        '''
+        return JSONSchemaCodec.decode(data)
+
+    @staticmethod
+    def from_json(schema_name:str,json: object, lazy: bool = False, trusted: bool = False):
+        '''
+        Deserialize class from json, with lazy the nested objects and
+        arrays are only created when read for the first time. Trusted
+        json (ie. loaded from our database) is not validated, the objects
+        are created lazily
+        '''
+        if isinstance(json, str):
+            json = JSONSchemaObject._decoder.decode(json)
+
+        if isinstance(json, dict):
+
+            T = JSONSchemaObject._models_cache.get(schema_name, JSONSchemaObject)
+
+            if lazy or trusted:
+                return JSONSchemaObject._lazy(
+                    JSONSchemaObject.compile_model(schema_name, base=T), json)
+
+            if T is not JSONSchemaObject:
+                return T(**json)
+
+            return JSONSchemaObject(schema_name=schema_name,**json)
+        
+        raise NotImplementedError
+
+    @staticmethod
+    def from_json_many(schema_name: str, documents, lazy: bool = False,
+                       processes: int = None, chunk_size: int = 1000):
+        '''
+        Deserialize many documents (JSON strings, bytes or dicts) of the same
+        schema, the objects are yielded in order as they are converted. With
+        processes the documents are converted in chunks by a process pool
+        '''
+        T = JSONSchemaObject._models_cache.get(schema_name, JSONSchemaObject)
+
+        if processes:
+            yield from JSONSchemaObject._from_json_pool(
+                T, schema_name, documents, lazy, processes, chunk_size)
+            return
+
+        yield from JSONSchemaObject._from_json_documents(
+            JSONSchemaObject.compile_model(schema_name, base=T), documents, lazy)
+
+    @staticmethod
+    def from_ndjson(schema_name: str, file, lazy: bool = False,
+                    processes: int = None, chunk_size: int = 1000):
+        '''
+        Deserialize the objects of a newline delimited JSON file, file is a
+        path or a file object opened in text or binary mode
+        '''
+        if isinstance(file, str):
+            with open(file, "rb") as fp:
+                yield from JSONSchemaObject.from_ndjson(
+                    schema_name, fp, lazy, processes, chunk_size)
+            return
+
+        # empty lines are allowed between the documents
+        lines = (line for line in file if not line.isspace())
+        yield from JSONSchemaObject.from_json_many(
+            schema_name, lines, lazy, processes, chunk_size)
+
+    @staticmethod
+    def _from_json_documents(model: type, documents, lazy: bool):
+        '''
+        Convert the documents to objects of a compiled model
+        '''
+        decode = JSONSchemaObject._decoder.decode
+        lazy_object = JSONSchemaObject._lazy
+
+        for json in documents:
+
+            if isinstance(json, (bytes, bytearray)):
+                json = json.decode("utf-8")
+            if isinstance(json, str):
+                json = decode(json)
+
+            if not isinstance(json, dict):
+                raise NotImplementedError
+
+            yield lazy_object(model, json) if lazy else model(**json)
+
+    @staticmethod
+    def _from_json_pool(base: type, schema_name: str, documents, lazy: bool,
+                        processes: int, chunk_size: int):
+        '''
+        Convert the documents in chunks on a process pool, the objects are
+        sent back pickled and yielded in order
+        '''
+        documents = iter(documents)
+        initargs = (
+            JSONSchemaObject._schemas_url,
+            JSONSchemaObject._schemas_version,
+            JSONSchemaObject._schemas_cache)
+
+        with ProcessPoolExecutor(processes, initializer=JSONSchemaObject._init_worker,
+                                 initargs=initargs) as executor:
+
+            # only two chunks per process are in flight, so big files are
+            # not read in memory at once
+            pending = deque()
+            chunk = list(islice(documents, chunk_size))
+            while chunk:
+                pending.append(executor.submit(
+                    JSONSchemaObject._from_json_chunk, base, schema_name, chunk, lazy))
+
+                if len(pending) >= 2 * processes:
+                    yield from pending.popleft().result()
+
+                chunk = list(islice(documents, chunk_size))
+
+            while pending:
+                yield from pending.popleft().result()
+
+    @staticmethod
+    def _init_worker(schemas_url: str, schemas_version: str, schemas: dict):
+        '''
+        Install the schemas of the parent process on a worker process
+        '''
+        JSONSchemaObject.set_schemas_location(schemas_url, schemas_version)
+        for name, schema in schemas.items():
+            JSONSchemaObject.set_schema(name, schema)
 
+    @staticmethod
+    def _from_json_chunk(base: type, schema_name: str, documents: list, lazy: bool):
+        '''
+        Convert a chunk of documents on a worker process
+        '''
+        model = JSONSchemaObject.compile_model(schema_name, base=base)
+        return list(JSONSchemaObject._from_json_documents(model, documents, lazy))
 
-    class JSONSchemaEncoder(JSONEncoder):
+    def __reduce__(self):
         '''
-        SchemaModel to JSON encoder
+        Compiled models are generated at runtime, objects are pickled with
+        the schema and the class they are compiled from
         '''
+        model = type(self)
+        return (JSONSchemaObject._restore, (
+            model.__bases__[0], model._schema_name, model._schema_path, self.__attrs__,
+            self.__unset__))
 
-        def default(self, o):   # pylint: disable=method-hidden
-            if isinstance(o, JSONSchemaObject):
-                return o.__dict__["__attrs__"]
-            elif isinstance(o, JSONSchemaArray):
-                return o.__dict__["__array__"]
-            elif isinstance(o,uuid.UUID):
-                return str(o)
-            else:
-                # call base class implementation which takes care of
-                # raising exceptions for unsupported types
-                return JSONEncoder.default(self, object)
+    @staticmethod
+    def _restore(base: type, schema_name: str, schema_path: str, attrs: dict, unset: tuple = ()):
+        '''
+        Returns an unpickled object, the attributes were already validated
+        '''
+        model = JSONSchemaObject._compiled_cache.get((base, schema_name, schema_path))
+        if model is None:
+            model = JSONSchemaObject.compile_model(schema_name, schema_path, base)
+        if model._record is not None:
+            attrs = model._record(map(attrs.get, model._record._keys))
+        obj = model.__new__(model)
+        obj.__attrs__ = attrs
+        obj.__dirty__ = None
+        obj.__unset__ = unset
+        return obj
 
-    def to_json(self):
+    @staticmethod
+    def _lazy(model: type, json: dict):
         '''
-        Serialize class to json
+        Returns an object of model which keeps the JSON values of the nested
+        objects and arrays, they are converted when read for the first time
         '''
-        return JSONSchemaObject.JSONSchemaEncoder().encode(self)
+        plan = model._plan
+        if plan is None:
+            plan = JSONSchemaPlan.compile(model)
+
+        attrs = plan.template.copy()
+        for attribute_name, factory in plan.factories:
+            if attribute_name not in json:
+                attrs[attribute_name] = factory()
+
+        for attribute_name, value in json.items():
+            if attribute_name in attrs:
+                attrs[attribute_name] = value
+
+        obj = model.__new__(model)
+        obj.__attrs__ = attrs
+        obj.__dirty__ = None
+        obj.__unset__ = JSONSchemaObject._unset(plan, json)
+        return obj
 
     @staticmethod
-    def from_json(schema_name:str,json: object):
+    def _unset(plan: JSONSchemaPlan, values: dict):
         '''
-        Deserialize class from json
+        The required attributes and the attributes without a valid default
+        of a plan missing in values, the objects check them instead of the
+        keys of their attributes
         '''
-        if isinstance(json, str):
-            json = JSONDecoder().decode(json)
+        if not plan.unset:
+            return ()
+        return tuple(name for name in plan.unset if name not in values)
 
-        if isinstance(json, dict):
+    @staticmethod
+    def _json_attrs(obj: object):
+        '''
+        Returns the attributes written to the JSON of an object, without the
+        attributes not set yet whose default is not valid
+        '''
+        attrs = obj.__attrs__
+        unset = obj.__unset__
+        if not unset:
+            return attrs
 
-            if schema_name in JSONSchemaObject._models_cache:
-                T = JSONSchemaObject._models_cache[schema_name]
-                return T(**json)
+        plan = obj._plan
+        if plan is None:
+            plan = JSONSchemaPlan.compile(type(obj))
 
-            return JSONSchemaObject(schema_name=schema_name,**json)
-        
-        raise NotImplementedError
+        omitted = plan.omitted.intersection(unset)
+        if not omitted:
+            return attrs
+        return {name: value for name, value in attrs.items() if name not in omitted}
+
+    def _materialize(self, attribute_name: str):
+        '''
+        Returns the value of an attribute, the JSON value kept by a lazy
+        object is converted and stored
+        '''
+        value = self.__attrs__[attribute_name]
+        raw_type, materialize = self._plan.lazy.get(attribute_name, (None, None))
+
+        if type(value) is raw_type:
+            value = materialize(value)
+            self.__attrs__[attribute_name] = value
+
+            # the JSON value was untouched, so are the converted values,
+            # but objects shared with other parents keep their changes
+            if self.__dirty__ is not None:
+                JSONSchemaObject._track(value, restart=False)
+
+        return value
+
+    @staticmethod
+    def _track(value: object, restart: bool = True):
+        '''
+        Start recording the changes of an object or array and its nested
+        objects and arrays, ie. after it was loaded or saved. Objects keep
+        the names of the attributes set since then, arrays the number of
+        items saved and the indexes set, or -1 if an item was deleted.
+        Without restart the values already recorded keep their changes
+        '''
+        if isinstance(value, JSONSchemaObject):
+            if not restart and value.__dirty__ is not None:
+                return
+            value.__dirty__ = set()
+            for attr in value.__attrs__.values():
+                if isinstance(attr, (JSONSchemaObject, JSONSchemaArray)):
+                    JSONSchemaObject._track(attr, restart)
+
+        elif isinstance(value, JSONSchemaArray):
+            if not restart and value._changes is not None:
+                return
+            value._changes = [len(value), set()]
+
+            # typed storages have no objects
+            if type(value.__array__) is list:
+                for item in value.__array__:
+                    if isinstance(item, JSONSchemaObject):
+                        JSONSchemaObject._track(item, restart)
 
     @staticmethod
     def set_schemas_location(uri: str, version: str = "latest"):
@@ -414,6 +3746,68 @@ class JSONSchemaObject(object):
         JSONSchemaObject._schemas_url = uri
         JSONSchemaObject._schemas_version = version
 
+    @staticmethod
+    def set_validation_mode(mode: str):
+        """
+        Set when the values are validated against the schema keywords:
+        strict validates every assignment, deferred validates the whole
+        object with validate() before it is stored and trusted skips all
+        the validations
+        """
+        if mode not in ("strict", "deferred", "trusted"):
+            raise ValueError("Unknown validation mode {}".format(mode))
+        JSONSchemaObject._validation_mode = mode
+
+    def validate(self):
+        """
+        Validates the object, and all its nested objects and arrays,
+        against its schema. Raises JSONSchemaValidationError
+        """
+        validator = JSONSchemaValidator.get(self._schema_path)
+        if validator is not None:
+            validator(self)
+
+    @staticmethod
+    def set_compact(schema_name: str, compact: bool = True):
+        """
+        Store the attributes of the objects of a schema and its definitions
+        in records, a list of values sharing the key table of the model,
+        instead of a dict per object. The objects created before keep
+        their attributes
+        """
+        schema_name = str(schema_name).lower()
+        if compact:
+            JSONSchemaObject._compact_schemas.add(schema_name)
+        else:
+            JSONSchemaObject._compact_schemas.discard(schema_name)
+
+        # the models are compiled again, the models of other schemas might
+        # have the models of this schema
+        JSONSchemaObject._compiled_cache.clear()
+        JSONSchemaArray._items_cache.clear()
+        JSONSchemaCodec._fields.clear()
+        JSONSchemaCodec._kinds.clear()
+
+    @staticmethod
+    def validate_many(schema_name: str, documents, use_numpy: bool = False):
+        """
+        Validates a batch of documents (dicts or JSON strings) without
+        creating the objects, returns a bitmap with a bit set for every
+        invalid document, see JSONSchemaValidator.validate_many
+        """
+        return JSONSchemaValidator.validate_many(schema_name, documents, use_numpy)
+
+    @staticmethod
+    def set_schemas_http_cache(folder: str = None, max_age: float = 300, timeout: float = 10):
+        """
+        Set the on-disk cache of the schemas downloaded by http(s), the
+        schemas downloaded less than max_age seconds ago are used without
+        requesting the server, older schemas are revalidated
+        """
+        JSONSchemaObject._schemas_http_folder = folder
+        JSONSchemaObject._schemas_http_max_age = max_age
+        JSONSchemaObject._schemas_http_timeout = timeout
+
     @staticmethod
     def set_schema(name: str, schema: object):
         """
@@ -426,63 +3820,294 @@ class JSONSchemaObject(object):
                 raise JSONSchemaException("Invalid schema")
 
         JSONSchemaObject._schemas_cache[name] = schema
+        JSONSchemaRegistry.register(name, schema)
+
+        # models compiled from a previous schema are not valid anymore
+        JSONSchemaObject._compiled_cache.clear()
+        JSONSchemaArray._items_cache.clear()
+        JSONSchemaValidator._validators.clear()
+        JSONSchemaValidator._batch_plans.clear()
+        JSONSchemaCodec._fields.clear()
+        JSONSchemaCodec._kinds.clear()
 
     @staticmethod
     def get_schema(name: str):
         """
         Get a JSON schema from the internal cache or try to download it 
-        if not available
+        if not available, with the schemas it references
         """
-        # we always user lowercase
-        name = name.lower()
-        definition = None
+        return JSONSchemaRegistry.get(name)
 
-        # we are trying to get a definition
-        if name.find("definitions") > 0:
-            parts = name.split('/')
+    @staticmethod
+    def bundle_schemas(bundle_path: str):
+        """
+        Read all the schemas of the schemas location and version, validate
+        and resolve them and write them to a single bundle file which is
+        loaded at once by preload_schemas. The schemas are also installed
+        in this process
+        """
+        names = JSONSchemaObject._read_schemas()
+
+        # every reference must be available and every model must compile
+        for name in names:
+            for ref in JSONSchemaRegistry._find_refs(JSONSchemaObject._schemas_cache[name]):
+                path = JSONSchemaRegistry.resolve(name, ref)
+                if path not in JSONSchemaRegistry._schemas:
+                    raise JSONSchemaException(
+                        "Schema {} references unknown schema {}".format(name, path))
+        JSONSchemaObject._compile_schemas()
+
+        bundle = {
+            "version": JSONSchemaObject._schemas_version,
+            "schemas": {name: JSONSchemaObject._schemas_cache[name] for name in names},
+            "registry": JSONSchemaRegistry.snapshot(names)
+        }
+        with open(bundle_path, "wb") as bundle_file:
+            pickle.dump(bundle, bundle_file, pickle.HIGHEST_PROTOCOL)
+
+        return names
 
-            if len(parts) < 3:
-                raise JSONSchemaException("Invalid definition name")
+    @staticmethod
+    def preload_schemas(bundle_path: str = None, compile_models: bool = True):
+        """
+        Load all the schemas at once, from a bundle written by bundle_schemas
+        or from the schemas location, so no request pays the retrieval of a
+        schema. With compile_models the models and their construction plans
+        are compiled as well
+        """
+        if bundle_path is None:
+            names = JSONSchemaObject._read_schemas()
 
-            name = parts[0]
-            definition = parts[2]
+        else:
+            with open(bundle_path, "rb") as bundle_file:
+                bundle = pickle.loads(bundle_file.read())
 
-        # Check if schema is already available
-        if name not in JSONSchemaObject._schemas_cache:
-            JSONSchemaObject._retrieve_schema(name)
+            if bundle["version"] != JSONSchemaObject._schemas_version:
+                raise JSONSchemaException("Bundle version {} does not match schemas version {}".format(
+                    bundle["version"], JSONSchemaObject._schemas_version))
 
-        # Get the schema from our cache
-        schema = JSONSchemaObject._schemas_cache[name]
+            names = list(bundle["schemas"])
+            JSONSchemaObject._schemas_cache.update(bundle["schemas"])
+            JSONSchemaRegistry.restore(bundle["registry"])
 
-        if definition is None:
-            # We want the all schema
-            return schema
+            # models compiled from a previous schema are not valid anymore
+            JSONSchemaObject._compiled_cache.clear()
+            JSONSchemaArray._items_cache.clear()
+            JSONSchemaValidator._validators.clear()
+            JSONSchemaValidator._batch_plans.clear()
+            JSONSchemaCodec._fields.clear()
 
-        # Check if schema have the definitions
-        if "definitions" not in schema:
-            raise JSONSchemaException(
-                "Schema {} does not provide definitions".format(name))
+        if compile_models:
+            JSONSchemaObject._compile_schemas()
 
-        # Check if schema have the definitions
-        if definition not in schema["definitions"]:
-            raise JSONSchemaException(
-                "Definition {} not in schema {}".format(definition, name))
+        return names
+
+    @staticmethod
+    def _read_schemas():
+        """
+        Read all the schemas of the schemas location and version
+        """
+        if not str(JSONSchemaObject._schemas_url).startswith("file://"):
+            raise NotImplementedError("URI {} not supported".format(
+                JSONSchemaObject._schemas_url))
+
+        folder = "{}/{}".format(
+            str(JSONSchemaObject._schemas_url).replace("file://", ""),
+            JSONSchemaObject._schemas_version)
+
+        try:
+            file_names = sorted(listdir(folder))
+        except FileNotFoundError:
+            raise JSONSchemaException("Schemas not found")
+
+        names = []
+        for file_name in file_names:
+            if not file_name.endswith(".json"):
+                continue
+
+            name = file_name[:-len(".json")]
+            try:
+                with open("{}/{}".format(folder, file_name)) as def_file:
+                    JSONSchemaObject.set_schema(name, load(def_file))
+            except JSONDecodeError:
+                raise JSONSchemaException("Invalid schema {}".format(name))
+            names.append(name)
+
+        return names
+
+    @staticmethod
+    def _compile_schemas():
+        """
+        Compile the models and the construction plans of all the schemas
+        and definitions, and of the model classes already declared
+        """
+        for path, schema in list(JSONSchemaRegistry._schemas.items()):
+            if "properties" in schema:
+                model = JSONSchemaObject.compile_model(path.split("/")[0], path)
+                JSONSchemaPlan.compile(model)
 
-        # we want just a definition
-        return schema["definitions"][definition]
+        for name, base in list(JSONSchemaObject._models_cache.items()):
+            if name in JSONSchemaRegistry._schemas:
+                JSONSchemaPlan.compile(JSONSchemaObject.compile_model(name, base=base))
 
     @staticmethod
     def new_model(name: str):
-        def new_schema_model():
-            return JSONSchemaObject(schema_name=name)
-        new_schema_model.__name__ = name
-        return new_schema_model
+        """
+        Returns the compiled model class of a schema
+        """
+        return JSONSchemaObject.compile_model(name)
+
+    @staticmethod
+    def compile_model(schema_name: str, schema_path: str = None, base: type = None):
+        """
+        Compile a schema into a model class, the generated class has
+        __slots__, a typed descriptor for every property and the array
+        helpers (ie. append_port, get_port, remove_port) already bound
+        to the array attributes
+        """
+        if base is None:
+            base = JSONSchemaObject
+
+        # we always use lowercase
+        schema_name = str(schema_name).lower()
+        if schema_path is None:
+            schema_path = schema_name
+        schema_path = str(schema_path).lower()
+
+        # Check if the model as already been compiled
+        key = (base, schema_name, schema_path)
+        if key in JSONSchemaObject._compiled_cache:
+            return JSONSchemaObject._compiled_cache[key]
+
+        schema = JSONSchemaObject.get_schema(schema_path)
+        properties = schema["properties"]
+
+        # the objects of compact schemas share the key table of a record class
+        record = None
+        if schema_name in JSONSchemaObject._compact_schemas:
+            record = JSONSchemaRecord.compile(list(properties))
+
+        namespace = {
+            "__slots__": (),
+            "__module__": base.__module__,
+            "__doc__": base.__doc__ if base is not JSONSchemaObject else schema.get("description"),
+            "_compiled": True,
+            "_schema_name": schema_name,
+            "_schema_path": schema_path,
+            "_plan": None,
+            "_record": record,
+        }
+
+        for index, (attribute_name, property_info) in enumerate(properties.items()):
+
+            # internals of the class always have precedence
+            if hasattr(JSONSchemaObject, attribute_name):
+                continue
+
+            descriptor = JSONSchemaProperty(
+                attribute_name, property_info, None if record is None else index)
+            namespace[attribute_name] = descriptor
+
+            # We might have _attribs in our schema (ie. _id, _version ...)
+            # this allows to access them without the _
+            if attribute_name.startswith("_") and attribute_name[1:] not in properties:
+                namespace[attribute_name[1:]] = descriptor
+
+        for attribute_name, property_info in properties.items():
+
+            # the helpers are only available for arrays, such as ports
+            # which are translated to append_port, get_port and remove_port
+            if property_info.get("type") != "array" or not attribute_name.endswith("s"):
+                continue
+
+            for prefix, method in (
+                    ("append_", JSONSchemaArray.append),
+                    ("get_", JSONSchemaArray.__getitem__),
+                    ("remove_", JSONSchemaArray.__delitem__)):
+
+                helper_name = "{}{}".format(prefix, attribute_name[:-1])
+                if helper_name not in namespace:
+                    namespace[helper_name] = JSONSchemaObject._array_helper(
+                        helper_name, attribute_name, method)
+
+            # keyed arrays also have get_port_by_key and remove_port_by_key
+            if "x-key" not in property_info:
+                continue
+
+            for prefix, method in (
+                    ("get_", JSONSchemaArray.get_by_key),
+                    ("remove_", JSONSchemaArray.remove_by_key)):
+
+                helper_name = "{}{}_by_key".format(prefix, attribute_name[:-1])
+                if helper_name not in namespace:
+                    namespace[helper_name] = JSONSchemaObject._array_helper(
+                        helper_name, attribute_name, method)
+
+        # Generated models keep the name of the class they extend, otherwise
+        # we name them after the schema
+        if base is JSONSchemaObject:
+            name = schema_path.split("/")[-1].replace(".json", "").capitalize()
+        else:
+            name = base.__name__
+        namespace["__qualname__"] = name
+
+        model = type(name, (base,), namespace)
+        JSONSchemaObject._compiled_cache[key] = model
+        return model
+
+    @staticmethod
+    def _ref_model(schema_name: str, ref: str):
+        """
+        Returns the compiled model of a reference, anchors (#) are
+        relative to schema_name
+        """
+        ref = JSONSchemaRegistry.resolve(schema_name, ref)
+
+        # the anchors of the referenced schema are relative to its root
+        return JSONSchemaObject.compile_model(ref.split("/")[0], ref)
+
+    @staticmethod
+    def _array_helper(helper_name: str, attribute_name: str, method):
+        """
+        Returns a method calling method on the array attribute
+        """
+        def helper(self, *args, **kwargs):
+            array = self.__attrs__[attribute_name]
+            if type(array) is list:
+                array = self._materialize(attribute_name)
+            return method(array, *args, **kwargs)
+        helper.__name__ = helper.__qualname__ = helper_name
+        return helper
 
     @staticmethod
     def get_attr_schema(schema_name:str,jpath:str):
 
         schema = JSONSchemaObject.get_schema(schema_name)
-        return parse(jpath).find(schema)        
+        return JSONSchemaQuery.compile(jpath).expression.find(schema)
+
+    def diff(self, other: object):
+        """
+        Returns the JSON patch (RFC 6902) which transforms the object into
+        other, the items of arrays with a x-key are compared by key
+        """
+        return JSONSchemaPatch.diff(self, other)
+
+    def apply_patch(self, patch: list):
+        """
+        Returns a new object with a JSON patch applied, the object is not
+        changed
+        """
+        json = JSONSchemaPatch.apply(JSONSchemaQuery._plain(self), patch)
+        if not isinstance(json, dict):
+            raise ValueError("The patched document is not an object")
+        return type(self)(**json)
+
+    def query(self, jpath: str):
+        """
+        Returns the values of the object (or array) matching a JSONPath
+        expression, ie. node.query("$.ports[*].callback._id")
+        """
+        return JSONSchemaQuery.compile(jpath).find(self)
 
 
     @staticmethod
@@ -515,12 +4140,121 @@ class JSONSchemaObject(object):
         elif str(JSONSchemaObject._schemas_url).startswith("http://") or \
                 str(JSONSchemaObject._schemas_url).startswith("https://"):
             # Handle http(s):// -> http download
-            raise NotImplementedError(
-                "HTTP/HTTPS protocol not implemented yet")
+            JSONSchemaObject.set_schema(name, JSONSchemaObject._download_schema(name))
+            return JSONSchemaObject._schemas_cache[name]
         else:
             raise NotImplementedError("URI {} not supported".format(
                 JSONSchemaObject._schemas_url))
 
+    @staticmethod
+    def _retrieve_schemas(names: list):
+        """
+        Download several schemas, in parallel if they are retrieved by
+        http(s)
+        """
+        if len(names) < 2 or not str(JSONSchemaObject._schemas_url).startswith(("http://", "https://")):
+            for name in names:
+                JSONSchemaObject._retrieve_schema(name)
+            return
+
+        with ThreadPoolExecutor(min(len(names), 8)) as executor:
+            schemas = list(executor.map(JSONSchemaObject._download_schema, names))
+
+        for name, schema in zip(names, schemas):
+            JSONSchemaObject.set_schema(name, schema)
+
+    @staticmethod
+    def _download_schema(name: str):
+        """
+        Download a schema by http(s), the schema is revalidated with the
+        ETag and Last-Modified of the cached copy
+        """
+        url = "{}/{}/{}.json".format(
+            str(JSONSchemaObject._schemas_url).rstrip("/"), JSONSchemaObject._schemas_version, name)
+
+        entry = JSONSchemaObject._read_http_cache(url)
+        if entry is not None and time() - entry["fetched"] < JSONSchemaObject._schemas_http_max_age:
+            return entry["schema"]
+
+        headers = {"Accept": "application/json"}
+        if entry is not None and entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            with urlopen(Request(url, headers=headers),
+                         timeout=JSONSchemaObject._schemas_http_timeout) as response:
+                entry = {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "schema": load(response)
+                }
+
+        except HTTPError as e:
+            if e.code == 404:
+                raise JSONSchemaException("Schema not found")
+
+            # our copy is still valid
+            if e.code != 304 or entry is None:
+                raise JSONSchemaException("Schema {} not available, HTTP {}".format(name, e.code))
+
+        except JSONDecodeError:
+            raise JSONSchemaException("Invalid schema")
+
+        except (URLError, OSError):
+            if entry is None:
+                raise JSONSchemaException("Schema {} not available".format(name))
+
+            # the server is not available, a stale schema is better than none
+            return entry["schema"]
+
+        entry["fetched"] = time()
+        JSONSchemaObject._write_http_cache(url, entry)
+        return entry["schema"]
+
+    @staticmethod
+    def _read_http_cache(url: str):
+        """
+        Returns the cached copy of a downloaded schema, from memory or disk
+        """
+        entry = JSONSchemaObject._schemas_http_cache.get(url)
+        if entry is not None or JSONSchemaObject._schemas_http_folder is None:
+            return entry
+
+        try:
+            with open("{}/{}.json".format(JSONSchemaObject._schemas_http_folder,
+                                          sha256(url.encode()).hexdigest())) as cache_file:
+                entry = load(cache_file)
+        except (FileNotFoundError, JSONDecodeError):
+            return None
+
+        # the file name might collide
+        if entry.get("url") != url:
+            return None
+
+        JSONSchemaObject._schemas_http_cache[url] = entry
+        return entry
+
+    @staticmethod
+    def _write_http_cache(url: str, entry: dict):
+        """
+        Store a downloaded schema in memory and disk
+        """
+        JSONSchemaObject._schemas_http_cache[url] = entry
+        if JSONSchemaObject._schemas_http_folder is None:
+            return
+
+        # the file is replaced at once, other processes share the cache
+        makedirs(JSONSchemaObject._schemas_http_folder, exist_ok=True)
+        file_name = "{}/{}.json".format(
+            JSONSchemaObject._schemas_http_folder, sha256(url.encode()).hexdigest())
+        with open("{}.{}".format(file_name, uuid.uuid4().hex), "w") as cache_file:
+            cache_file.write(JSONEncoder().encode(entry))
+            temp_name = cache_file.name
+        replace(temp_name, file_name)
+
     @staticmethod
     def _get_python_type(property_info):
         """
@@ -560,35 +4294,72 @@ class JSONSchemaObject(object):
         """
         Validates the value against the schema,
         """
+        attr_schema = JSONSchemaObject.get_schema(schema_path)["properties"][name]
+        return JSONSchemaObject._value_check(attr_schema)(value)
+
+    @staticmethod
+    def _value_check(attr_schema: dict):
+        """
+        Returns the basic validation of the values of an attribute, it only
+        checks the python type of the value
+        """
         # For now we only do a basic validation, the goal is not to 
         # make the attribute assignment too complicated, a proper validation 
-        # should be done before storing the structure 
-        
-        # Get the current schema so we can validate the data
-        attr_schema = JSONSchemaObject.get_schema(schema_path)["properties"][name]
+        # is done by the validator of the schema
+
+        # a reference to another object
+        if "$ref" in attr_schema:
+            return lambda value: isinstance(value, (JSONSchemaObject, dict))
 
         # the null type is special kind of type
         if attr_schema["type"] == "null":
             # A null is a None
-            return value == None
+            return lambda value: value is None
 
         # Get the current python type to compare
         py_type = JSONSchemaObject._get_python_type(attr_schema)
 
         if attr_schema["type"] == "array":
             # A List
-            return type(value) is JSONSchemaArray or type(value) is list
-        
+            return lambda value: type(value) is JSONSchemaArray or type(value) is list
+
         if attr_schema["type"] == "object":
-            
+
             if "properties" in attr_schema:
                 # if we have a properties, it is a JSONSchemaObject
-                return type(value) is JSONSchemaObject or type(value) is dict
+                return lambda value: isinstance(value, (JSONSchemaObject, dict))
 
             # otherwise is just a dictionary
-            return dict
+            return lambda value: isinstance(value, dict)
+
+        return lambda value: type(value) is py_type
+
+    @staticmethod
+    def _coerce_value(obj, name: str, property_info: dict, value: object):
+        """
+        Validates a value assigned to an attribute, lists and dicts are
+        converted to JSONSchemaArray and JSONSchemaObject
+        """
+        plan = obj._plan
+        if plan is None:
+            plan = JSONSchemaPlan.compile(type(obj))
+
+        mode = JSONSchemaObject._validation_mode
+        if mode != "trusted":
+
+            # Before setting the value do a basic validation
+            if not plan.checks[name](value):
+                raise ValueError("value is not valid")
+
+            # and the keywords of the schema in strict mode
+            if mode == "strict" and name in plan.validators:
+                JSONSchemaValidator._nested(plan.validators[name], value, name)
 
-        return type(value) is py_type
+        if isinstance(value, (list, dict)) and name in plan.lazy:
+            # convert the attribute as if it was passed to the constructor
+            return plan.converters[name](value)
+
+        return value
 
     @staticmethod
     def _get_json_type(T: type):
@@ -680,238 +4451,96 @@ class JSONSchemaObject(object):
             raise JSONSchemaException(
                 "Unknown data type {}".format(T))
 
-    def __init__(self, **kwargs):
+    def __new__(cls, *args, **kwargs):
         """
-        The constructor of the class
+        Instantiate the compiled model of the schema
         """
+        # compiled models are instantiated directly
+        if cls._compiled:
+            return super().__new__(cls)
+
         # By default we use the name of the classname as a reference
-        if self.__class__.__name__ != JSONSchemaObject.__name__:
-           
+        if cls is not JSONSchemaObject:
+
             # Get the schema from the class name
-            self._schema_name = self.__class__.__name__.lower()
-            
+            schema_name = cls.__name__.lower()
+
             # Store the class on our classes cache for reflection
-            if self._schema_name not in JSONSchemaObject._models_cache:
-                JSONSchemaObject._models_cache[self._schema_name] = self.__class__
+            if schema_name not in JSONSchemaObject._models_cache:
+                JSONSchemaObject._models_cache[schema_name] = cls
 
         elif "schema_name" in kwargs:
 
             # otherwise check if we are sending the schema name on
             # kwargs
-            self._schema_name = kwargs["schema_name"]
-            del kwargs["schema_name"]
-        
+            schema_name = kwargs["schema_name"]
+
         else:
             # This cannot happen
             raise NotImplementedError("Invalid classname")
 
-        schema_path = kwargs.get("schema_path")
-
-        # get the schema from our store
-        if schema_path is None:
-            self._schema_path = self._schema_name
-            schema = JSONSchemaObject.get_schema(
-                str(self._schema_name).lower())
-        else:
-            self._schema_path = schema_path.lower()
-            schema = JSONSchemaObject.get_schema(
-                str(self._schema_path).lower())
-            del kwargs["schema_path"]
-
-        # Generate the class attributes
-        self.__dict__["__attrs__"] = self._generate_from_schema(
-            schema, **kwargs)
-
-    def _generate_from_schema(self, schema: dict, **kwargs):
-        '''
-        Dynamically generate the class from schema
-        '''
-        obj = {}
+        model = JSONSchemaObject.compile_model(
+            schema_name, kwargs.get("schema_path"), cls)
 
-        for attribute_name, property_info in dict(schema["properties"]).items():
+        return super().__new__(model)
 
-            if "$ref" in property_info:
-                
-                # a reference to another object
-                ref = property_info["$ref"]
-                
-                # check if it's an anchor reference
-                if str(ref).startswith("#"):
-                    ref = str(ref).replace(
-                        "#", self._schema_name)
-
-                # Check if attribute as been passed in kwargs
+    def __init__(self, **kwargs):
+        """
+        The constructor of the class
+        """
+        plan = self._plan
+        if plan is None:
+            plan = JSONSchemaPlan.compile(type(self))
+
+        # Start from the default values of the schema, the nested objects,
+        # arrays and dicts are only created if not passed in kwargs
+        attrs = plan.template.copy()
+        for attribute_name, factory in plan.factories:
+            if attribute_name not in kwargs:
+                attrs[attribute_name] = factory()
+
+        # the keywords of the schema are validated in strict mode, the
+        # attributes not passed keep their default and are not validated
+        if plan.validators and JSONSchemaObject._validation_mode == "strict":
+            for attribute_name, validator in plan.validators.items():
                 if attribute_name in kwargs:
-                    # passed, we send them instead of the all kwargs
-                    obj[attribute_name] = JSONSchemaObject(
-                        schema_name=ref, schema_path=ref, **(kwargs[attribute_name]))
-                else:
-                    # not passed, we do not send anything
-                    obj[attribute_name] = JSONSchemaObject(
-                        schema_name=ref, schema_path=ref)
-
-            elif "type" in property_info:
-                # it's not a reference, it is a defined type
-                obj[attribute_name] = self._generate_attribute(
-                    attribute_name, property_info, **kwargs)
-
-            else:
-                raise JSONSchemaException(
-                    "Unhandled property {}".format(attribute_name))
-
-        return obj
-
-    def _generate_attribute(self, attribute_name: str, property_info: dict, **kwargs):
-        """ 
-        Generate the object attribute, based on the schema 
-        """
-        # If we do not have a key "type" this is not a valid property definition
-        if "type" not in property_info:
-            raise AttributeError("Not a valid property definition")
-
-        # Get the Python type from the property definition
-        py_type = JSONSchemaObject._get_python_type(
-            property_info)
-
-        # Get the default value for this property, we always send the schema definition
-        py_default = JSONSchemaObject._get_default_value(
-            py_type,
-            schema_name=self._schema_name,
-            schema_path=self._schema_path,
-            attribute_name=attribute_name,
-            **kwargs
-        )
-
-        # No initial value, return default value
-        if not kwargs:
-            return py_default
-
-        # Try to get it from the initial_values dict
-        if attribute_name not in kwargs:
-            return py_default
-
-        # Get the value from passed kwargs
-        value = kwargs.get(attribute_name)
-
-        # if we have a array of objects we must convert it to a JSON
-        # array
-        if py_type is JSONSchemaArray and isinstance(value, list):
-
-            # compose the objects with the dict data
-            array = JSONSchemaArray(
-                schema_name=self._schema_name,
-                schema_path=self._schema_path,
-                attribute_name=attribute_name,
-            )
-
-            for v in value:
-                array.append(**v)                                
-
-            return array
-
-        # check if the value is a valid type
-        if isinstance(value, py_type):
-            return value
-
-        # oops someting went wrong
-        raise AttributeError("{} attribute {} is not type {}".format(
-            self._schema_path, attribute_name, py_type))
-
-    def __setattr__(self, name: str, value: object):
-        '''
-        Set an object attribute 
-        '''
-        # We might have _attribs in our schema (ie. _id, _version ...)
-        # this allows to access them without the _
-        u_name = "_{}".format(name)
-
-        if name in JSONSchemaObject.__internals__:
-            # is it an internal attribute? we must use super class
-            return super().__setattr__(name,value)
-        elif name in self.__dict__["__attrs__"]:
-            
-            # Before setting the value do a basic validation
-            if not JSONSchemaObject._validate_value(name,self._schema_path,value):
-                raise ValueError("value is not valid")
-
-            self.__dict__["__attrs__"][name] = value
-        
-        elif u_name in self.__dict__["__attrs__"]:
-
-            
-            # Before setting the value do a basic validation
-            if not JSONSchemaObject._validate_value(u_name,self._schema_path,value):
-                raise ValueError("value is not valid")
-
-            self.__dict__["__attrs__"][u_name] = value
-
-        elif hasattr(self, name):
-            super().__setattr__(name, value)
-            
-        else:
-            raise AttributeError("{} instance has no attribute {}\n".format(
-                self.__class__.__name__, name))
-
-    def __getattribute__(self, name):
-        '''
-        Get the object value
-        '''
-        # We might have _attribs in our schema (ie. _id, _version ...)
-        # this allows to access them without the _
-        u_name = "_{}".format(name)
-
-        if name in JSONSchemaObject.__internals__:
-            # is it an internal attribute? we must use super class
-            # to return it
-            return super().__getattribute__(name)
-
-        elif str(name).startswith("remove_"):
-            # this helper allows to use attributes such as remove_port which is
-            # translated to the attr ports.remove
-            attrib = "{}s".format(str(name).replace("remove_", ""))
-
-            if attrib not in self.__dict__["__attrs__"]:
-                return super().__getattribute__(name)
-
-            if not isinstance(self.__dict__['__attrs__'][attrib], JSONSchemaArray):
-                raise AttributeError("{} not an attribute".format(attrib))
-
-            return self.__dict__['__attrs__'][attrib].__delitem__
-
-        elif str(name).startswith("get_"):
-            # this helper allows to use attributes such as get_port which is
-            # translated to the attr ports.get
-            attrib = "{}s".format(str(name).replace("get_", ""))
+                    JSONSchemaValidator._nested(validator, kwargs[attribute_name], attribute_name)
 
-            if attrib not in self.__dict__["__attrs__"]:
-                return super().__getattribute__(name)
+        # the schema name and path are already known by our compiled model
+        # and unknown attributes are ignored
+        converters = plan.converters
+        for attribute_name, value in kwargs.items():
+            if attribute_name in converters:
+                attrs[attribute_name] = converters[attribute_name](value)
 
-            if not isinstance(self.__dict__['__attrs__'][attrib], JSONSchemaArray):
-                raise AttributeError("{} not an attribute".format(attrib))
-            return self.__dict__['__attrs__'][attrib].__getitem__
-
-        elif str(name).startswith("append_"):
-            # this helper allows to use attributes such as append_port which is
-            # translated to the attr ports.append
-            attrib = "{}s".format(str(name).replace("append_", ""))
-
-            if attrib not in self.__dict__["__attrs__"]:
-                return super().__getattribute__(name)
-
-            if not isinstance(self.__dict__['__attrs__'][attrib], JSONSchemaArray):
-                raise AttributeError("{} not an attribute".format(attrib))
-            return self.__dict__['__attrs__'][attrib].append
-
-        elif name in self.__dict__['__attrs__']:
-            # are we asking for an existing attribute?
-            return self.__dict__['__attrs__'][name]
-
-        elif u_name in self.__dict__['__attrs__']:
-            # are we asking for an existing attribute?
-            return self.__dict__['__attrs__'][u_name]
-
-        # let the supper handle with the rest of it
-        return super().__getattribute__(name)
+        self.__attrs__ = attrs
+        self.__dirty__ = None
+        self.__unset__ = JSONSchemaObject._unset(plan, kwargs)
 
     def __str__(self):
         return self.to_json()
+
+
+# the encoder used by the serializer for dicts, lists and other values,
+# and the arguments of the C encoder of the json module when available
+JSONSchemaSerializer._encoder = JSONSchemaObject.JSONSchemaEncoder()
+JSONSchemaSerializer._c_encoder_args = (
+    JSONSchemaSerializer._encoder.default, encode_basestring_ascii, None,
+    ": ", ", ", False, False, True)
+
+# the keywords compiled together, by the type of value they validate
+JSONSchemaValidator._keywords = (
+    (frozenset(("enum",)), JSONSchemaValidator._compile_enum),
+    (frozenset(("const",)), JSONSchemaValidator._compile_const),
+    (frozenset(("minimum", "maximum", "exclusiveMinimum", "exclusiveMaximum", "multipleOf")),
+     JSONSchemaValidator._compile_number),
+    (frozenset(("minLength", "maxLength", "pattern", "format")),
+     JSONSchemaValidator._compile_string),
+    (frozenset(("items", "minItems", "maxItems", "uniqueItems", "contains")),
+     JSONSchemaValidator._compile_array),
+    (frozenset(("properties", "required", "minProperties", "maxProperties", "patternProperties",
+                "additionalProperties", "propertyNames", "dependencies")),
+     JSONSchemaValidator._compile_object),
+    (frozenset(("allOf", "anyOf", "oneOf", "not", "if")),
+     JSONSchemaValidator._compile_combinators),
+)
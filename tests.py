@@ -1,7 +1,23 @@
+import asyncio
+import http.server
+import io
+import json
+import os
+import pickle
+import sys
+import tempfile
+import threading
 import unittest
-from schema import JSONSchemaObject, JSONSchemaArray
-from database import DatabaseLayer
-from redisdriver import RedisDriver
+from schema import JSONSchemaObject, JSONSchemaArray, JSONSchemaCodec, JSONSchemaException, JSONSchemaPatch, \
+    JSONSchemaQuery, JSONSchemaRegistry, JSONSchemaSerializer, JSONSchemaValidationError, JSONSchemaValidator
+from database import AsyncDatabaseLayer, DatabaseCache, DatabaseLayer, NullDriver
+from redisdriver import AsyncRedisDriver, RedisDriver
+from jsonpath import parse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 schema_user = """
 {
@@ -215,7 +231,8 @@ schema_node = """
         "parameters": {
             "description" : "Node parameters",
             "type": "array",
-            "items": { "$ref" : "#/definitions/parameter" }
+            "items": { "$ref" : "#/definitions/parameter" },
+            "x-key": "name"
         },
         "ports": {
             "description" : "Node ports",
@@ -380,6 +397,40 @@ schema_flow = """
 }
 """
 
+schema_telemetry = """
+{
+    "$schema": "http://json-schema.org/draft-07/schema#",
+    "$id": "http://test.local/telemetry.json",
+    "title": "Telemetry",
+    "description": "Telemetry samples",
+    "type": "object",
+    "properties": {
+        "name": {
+            "type": "string"
+        },
+        "samples": {
+            "type": "array",
+            "items": { "type": "number" }
+        },
+        "counters": {
+            "type": "array",
+            "items": { "type": "integer" }
+        },
+        "flags": {
+            "type": "array",
+            "items": { "type": "boolean" }
+        },
+        "points": {
+            "type": "array",
+            "items": [
+                { "type": "number" },
+                { "type": "number" }
+            ]
+        }
+    }
+}
+"""
+
 # Define models as class extension
 
 class Node(JSONSchemaObject):
@@ -392,20 +443,11 @@ class Node(JSONSchemaObject):
         super().__init__(**kwargs)
 
     def delete_parameter(self,name):
-        i = 0
-        for param in self.parameters:
-            if param.name == name:
-                self.remove_parameter(i)
-                return
-            i+=1                    
-
+        if self.get_parameter_by_key(name) is not None:
+            self.remove_parameter_by_key(name)
 
     def get_parameters_by_name(self, name):
-        for param in self.parameters:
-            if param.name != name:
-                continue
-            return param
-        return None
+        return self.get_parameter_by_key(name)
 
     def move(self, x, y):
         visual_params = self.get_parameters_by_name("visual")
@@ -716,6 +758,1418 @@ class JsonSchemaObjectTests(unittest.TestCase):
         self.assertEqual(node_1.get_color(), "#F0F0F0")
         self.assertEqual(node.to_json(), node_1.to_json())
 
+    def test_compiled_model(self):
+
+        # Models are compiled classes of the schema
+        node = Node(name="node1")
+        self.assertIsInstance(node, Node)
+        self.assertIs(type(node), type(Node()))
+        self.assertIs(type(node), type(JSONSchemaObject.from_json("node", str(node))))
+
+        # Plain models have slots, no instance dict
+        NodeModel = JSONSchemaObject.new_model("Node")
+        self.assertIs(type(NodeModel()), NodeModel)
+        self.assertFalse(hasattr(NodeModel(), "__dict__"))
+
+        # Properties and array helpers are part of the class
+        for name in ("name", "_id", "id", "append_port", "get_port", "remove_port"):
+            self.assertIn(name, type(node).__dict__)
+
+        # _attribs can be accessed without the _
+        node.version = "1.1"
+        self.assertEqual(node._version, "1.1")
+        self.assertEqual(node.version, "1.1")
+
+        # dicts and lists are converted on assignment
+        node.append_port(name="port1")
+        node.ports[0].callback = {"_name": "callback1"}
+        self.assertEqual(node.ports[0].callback.name, "callback1")
+        node.tags = [{"name": "label", "value": "node1"}]
+        self.assertEqual(node.get_tag(0).value, "node1")
+
+        with self.assertRaises(ValueError):
+            node.name = 1
+
+        with self.assertRaises(AttributeError):
+            node.ports[0].undefined = 1
+
+    def test_array_items(self):
+
+        # the items definition is resolved once per attribute
+        node = Node()
+        self.assertIs(node.ports._items, Node().ports._items)
+        self.assertEqual(node.ports._items.refs, ("node/definitions/port",))
+
+        # Tuple validation
+        role = JSONSchemaObject(schema_name="role", name="admin")
+        role.permissions.append("users", "write")
+        role.permissions.append("nodes", "read")
+        self.assertEqual(role.permissions._items.arity, 2)
+        self.assertEqual(len(role.permissions), 2)
+        self.assertEqual(role.permissions[1], ["nodes", "read"])
+
+        role.permissions[1] = ("nodes", "write")
+        self.assertEqual(role.permissions[-1], ["nodes", "write"])
+
+        del role.permissions[0]
+        self.assertEqual(len(role.permissions), 1)
+        self.assertEqual(role.permissions[0], ["nodes", "write"])
+
+        with self.assertRaises(IndexError):
+            role.permissions[1]
+
+        # Single typed items
+        callback = JSONSchemaObject(schema_name="callback")
+        callback.libraries.append("numpy")
+        self.assertEqual(len(callback.libraries), 1)
+        self.assertEqual(callback.libraries[0], "numpy")
+
+        with self.assertRaises(ValueError):
+            callback.libraries.append(1)
+
+    def test_array_iteration(self):
+
+        node = Node()
+        for i in range(5):
+            node.append_port(name="port{}".format(i))
+
+        # Nested loops over the same array
+        pairs = [(a.name, b.name) for a in node.ports for b in node.ports]
+        self.assertEqual(len(pairs), 25)
+        self.assertEqual(pairs[6], ("port1", "port1"))
+
+        # Batches of objects
+        batches = list(node.ports.iter_batches(2))
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.assertEqual(batches[2][0].name, "port4")
+
+        # Batches of tuples
+        role = JSONSchemaObject(schema_name="role")
+        for i in range(3):
+            role.permissions.append("resource{}".format(i), "read")
+
+        self.assertEqual(list(role.permissions)[2], ["resource2", "read"])
+        self.assertEqual(
+            list(role.permissions.iter_batches(2)),
+            [[["resource0", "read"], ["resource1", "read"]], [["resource2", "read"]]])
+
+    def test_keyed_array(self):
+
+        node = Node()
+        for name in ("visual", "ros", "debug"):
+            node.append_parameter(name=name, data={"value": name})
+
+        self.assertEqual(node.get_parameter_by_key("ros").data["value"], "ros")
+        self.assertIsNone(node.get_parameter_by_key("undefined"))
+
+        # the index follows deletes
+        node.remove_parameter(0)
+        self.assertEqual(node.get_parameter_by_key("debug").data["value"], "debug")
+        node.remove_parameter_by_key("ros")
+        self.assertEqual(len(node.parameters), 1)
+        self.assertIsNone(node.get_parameter_by_key("ros"))
+
+        with self.assertRaises(KeyError):
+            node.remove_parameter_by_key("ros")
+
+        # the index follows appends and assignments
+        node.append_parameter(name="ros", data={})
+        node.parameters[0] = {"name": "visual", "data": {}}
+        self.assertIs(node.get_parameter_by_key("ros"), node.parameters[1])
+        self.assertIs(node.get_parameter_by_key("visual"), node.parameters[0])
+        self.assertIsNone(node.get_parameter_by_key("debug"))
+
+        # and renamed items
+        node.parameters[1].name = "ros1"
+        self.assertIsNone(node.get_parameter_by_key("ros"))
+        self.assertIs(node.get_parameter_by_key("ros1"), node.parameters[1])
+
+        # a renamed item is found by its new key before the old one is missed
+        node = Node()
+        node.append_parameter(name="a", data={})
+        node.append_parameter(name="b", data={})
+        self.assertIs(node.get_parameter_by_key("a"), node.parameters[0])
+        node.parameters[1].name = "c"
+        self.assertIs(node.get_parameter_by_key("c"), node.parameters[1])
+        self.assertIsNone(node.get_parameter_by_key("b"))
+
+        # misses, deletes and assignments keep the index, later items move back
+        index = node.parameters._index
+        self.assertIsNone(node.get_parameter_by_key("visual"))
+        node.append_parameter(name="d", data={})
+        node.remove_parameter_by_key("a")
+        node.append_parameter(name="e", data={})
+        self.assertIs(node.get_parameter_by_key("d"), node.parameters[1])
+        self.assertIs(node.get_parameter_by_key("e"), node.parameters[2])
+        node.parameters[1] = {"name": "c", "data": {}}
+        self.assertIsNone(node.get_parameter_by_key("d"))
+        self.assertIs(node.get_parameter_by_key("c"), node.parameters[0])
+        self.assertIs(node.parameters._index, index)
+
+        # the next item with a duplicated key is found after a delete
+        node.remove_parameter(0)
+        self.assertIs(node.get_parameter_by_key("c"), node.parameters[0])
+        self.assertIs(node.get_parameter_by_key("e"), node.parameters[1])
+
+        # many deletes rebuild the index once
+        for i in range(100):
+            node.append_parameter(name="p{}".format(i), data={})
+        for i in range(100):
+            node.remove_parameter_by_key("p{}".format(i))
+        self.assertEqual([parameter.name for parameter in node.parameters], ["c", "e"])
+        self.assertIs(node.get_parameter_by_key("e"), node.parameters[1])
+
+        # arrays without x-key are not keyed
+        with self.assertRaises(ValueError):
+            node.ports.get_by_key("port1")
+
+    def test_typed_array(self):
+
+        telemetry = JSONSchemaObject(schema_name="telemetry", name="imu")
+        for i in range(4):
+            telemetry.samples.append(i * 0.5)
+            telemetry.counters.append(i)
+            telemetry.flags.append(i % 2 == 0)
+            telemetry.points.append(float(i), float(-i))
+
+        # numbers are stored in typed arrays
+        self.assertEqual(telemetry.samples.__array__.typecode, "d")
+        self.assertEqual(telemetry.points.__array__.typecode, "d")
+        self.assertEqual(telemetry.samples[3], 1.5)
+        self.assertIs(telemetry.flags[0], True)
+        self.assertEqual(list(telemetry.flags), [True, False, True, False])
+        self.assertEqual(telemetry.points[2], [2.0, -2.0])
+
+        with self.assertRaises(ValueError):
+            telemetry.samples.append(1)
+
+        # the buffer is shared with the array
+        view = telemetry.points.buffer()
+        self.assertEqual(view.shape, (4, 2))
+        self.assertEqual(view.tolist()[3], [3.0, -3.0])
+        self.assertEqual(telemetry.points.column(1).tolist(), [0.0, -1.0, -2.0, -3.0])
+        view.release()
+
+        # serialization is the same as for lists
+        json = telemetry.to_json()
+        self.assertIn('"flags": [true, false, true, false]', json)
+        self.assertIn('"points": [0.0, 0.0, 1.0, -1.0, 2.0, -2.0, 3.0, -3.0]', json)
+        telemetry_1 = JSONSchemaObject.from_json("telemetry", json)
+        self.assertEqual(telemetry_1.to_json(), json)
+        self.assertEqual(telemetry_1.points[1], [1.0, -1.0])
+
+        # integers which do not fit fallback to a list
+        telemetry.counters.append(2**70)
+        self.assertEqual(telemetry.counters[4], 2**70)
+        self.assertEqual(len(telemetry.counters), 5)
+
+    def test_array_view(self):
+
+        node = Node()
+        for i in range(10):
+            node.append_port(name="port{}".format(i))
+
+        # slices are views over the array
+        page = node.ports[2:8]
+        self.assertEqual(len(page), 6)
+        self.assertIs(page[0], node.ports[2])
+        self.assertEqual([p.name for p in page[::2]], ["port2", "port4", "port6"])
+        self.assertEqual(page[-1].name, "port7")
+
+        # changes of the array are seen by the view
+        node.ports[3] = {"name": "port3b"}
+        self.assertEqual(page[1].name, "port3b")
+
+        # changing the view copies the items
+        del page[0]
+        self.assertEqual(len(page), 5)
+        self.assertEqual(len(node.ports), 10)
+        self.assertEqual(node.ports[2].name, "port2")
+
+        # views respect the tuples
+        telemetry = JSONSchemaObject(schema_name="telemetry")
+        for i in range(5):
+            telemetry.points.append(float(i), float(i * i))
+
+        points = telemetry.points[1:4]
+        self.assertEqual(list(points), [[1.0, 1.0], [2.0, 4.0], [3.0, 9.0]])
+        self.assertEqual(points[1:][0], [2.0, 4.0])
+        self.assertEqual(points.copy().__array__.tolist(), [1.0, 1.0, 2.0, 4.0, 3.0, 9.0])
+        self.assertEqual(str(points), "[1.0, 1.0, 2.0, 4.0, 3.0, 9.0]")
+
+    def test_construction_plan(self):
+
+        # the plan is compiled once per model
+        node = Node(name="node1")
+        self.assertIsNotNone(type(node)._plan)
+        self.assertIs(type(node)._plan, type(Node())._plan)
+
+        # defaults are not shared between objects
+        node_1 = Node()
+        node_1.append_tag(name="label", value="node")
+        self.assertEqual(len(node.tags), 0)
+
+        # plain objects default to an empty dict
+        node.append_parameter(name="visual")
+        self.assertEqual(node.parameters[0].data, {})
+        node.parameters[0].data["color"] = "red"
+        node_1.append_parameter(name="visual")
+        self.assertEqual(node_1.parameters[0].data, {})
+
+        # nested objects are created from the passed values
+        node.append_port(name="port1", callback={"_name": "callback1", "libraries": ["os"]})
+        self.assertEqual(node.ports[0].callback.name, "callback1")
+        self.assertEqual(node.ports[0].callback.libraries[0], "os")
+        self.assertEqual(node.ports[0].callback.tags._items.refs, ("callback/definitions/tag",))
+
+        # objects declared inline are dicts
+        flow = JSONSchemaObject(schema_name="flow")
+        flow.append_node(name="node1", links=[{"from": "port1", "to": {"node": "node2", "port": "port2"}}])
+        self.assertEqual(flow.nodes[0].links[0].to["node"], "node2")
+
+        with self.assertRaises(AttributeError):
+            Node(name=1)
+
+    def test_lazy_from_json(self):
+
+        node = Node(name="node1")
+        node.append_port(name="port1", callback={"_id": "cb1", "code": "pass"})
+        node.append_parameter(name="visual", data={"color": "red"})
+        node_str = node.to_json()
+
+        node_1 = JSONSchemaObject.from_json("node", node_str, lazy=True)
+        self.assertIsInstance(node_1, Node)
+
+        # nested values are kept as json until they are read
+        self.assertIsInstance(node_1.__attrs__["ports"], list)
+        self.assertEqual(node_1.to_json(), node_str)
+
+        self.assertEqual(node_1.name, "node1")
+        self.assertEqual(node_1.ports[0].callback.code, "pass")
+        self.assertIsInstance(node_1.__attrs__["ports"], JSONSchemaArray)
+        self.assertIsInstance(node_1.ports[0].__attrs__["parameters"], list)
+        self.assertIs(node_1.ports[0], node_1.ports[0])
+        self.assertEqual(node_1.get_parameter_by_key("visual").data["color"], "red")
+        self.assertEqual(node_1.to_json(), node_str)
+
+        # relations are extracted from untouched subtrees
+        node_2 = JSONSchemaObject.from_json("node", node_str, lazy=True)
+        relations = DatabaseLayer._extract_relations(node_2)
+        self.assertEqual(relations[2]["ports"][0]["callback"], "ref:callback:cb1:latest")
+        self.assertEqual(relations[2]["tags"], [])
+
+    def test_serializer(self):
+
+        node = Node(name="node \"1\" \u00e9")
+        node.append_port(name="port1", callback={"_id": "cb1", "code": "pass"})
+        node.append_parameter(name="visual", data={"color": "red", "ratio": 0.5})
+        node.append_port(name="port2")
+
+        telemetry = JSONSchemaObject(schema_name="telemetry", name="t1")
+        telemetry.samples.extend([1.5, float("inf"), -0.0])
+        telemetry.counters.extend([1, -2])
+        telemetry.flags.extend([True, False])
+        telemetry.points.extend([(1.0, 2.0)])
+
+        # same output as the json module
+        for obj in (node, telemetry):
+            expected = json.JSONEncoder(default=JSONSchemaObject.JSONSchemaEncoder().default).encode(obj)
+            self.assertEqual(obj.to_json(), expected)
+            self.assertEqual(JSONSchemaObject.JSONSchemaEncoder().encode(obj), expected)
+
+            text_stream = io.StringIO()
+            obj.to_json_stream(text_stream, buffer_size=8)
+            self.assertEqual(text_stream.getvalue(), expected)
+
+            binary_stream = io.BytesIO()
+            obj.to_json_stream(binary_stream, buffer_size=8)
+            self.assertEqual(binary_stream.getvalue(), expected.encode("ascii"))
+
+        # lazy objects keep their json
+        node_1 = JSONSchemaObject.from_json("node", node.to_json(), lazy=True)
+        self.assertEqual(node_1.to_json(), node.to_json())
+
+        # the threads encode the same values at once
+        shared = {"ports": [port for port in node.ports], "data": [{"i": i} for i in range(100)]}
+        errors = []
+
+        def encode():
+            try:
+                for _ in range(50):
+                    JSONSchemaSerializer.encode(shared)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=encode) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        # the values which can't be encoded raise, the object is not encoded again
+        node.parameters[0].data["bad"] = {1}
+        encode_attrs = JSONSchemaSerializer.encode_attrs
+        JSONSchemaSerializer.encode_attrs = staticmethod(lambda attrs: self.fail("encoded again"))
+        try:
+            with self.assertRaises(TypeError):
+                node.to_json()
+        finally:
+            JSONSchemaSerializer.encode_attrs = encode_attrs
+
+    def test_from_json_many(self):
+
+        documents = []
+        for i in range(10):
+            node = Node(name="node{}".format(i))
+            node.append_port(name="port1", callback={"_id": "cb{}".format(i), "code": "pass"})
+            node.append_parameter(name="visual", data={"color": "red"})
+            documents.append(node.to_json())
+
+        # strings, bytes and dicts can be mixed
+        mixed = documents[:4] + [d.encode() for d in documents[4:8]] + [json.loads(d) for d in documents[8:]]
+        nodes = JSONSchemaObject.from_json_many("node", mixed)
+        self.assertNotIsInstance(nodes, list)
+        nodes = list(nodes)
+        self.assertTrue(all(isinstance(node, Node) for node in nodes))
+        self.assertEqual([node.to_json() for node in nodes], documents)
+
+        ndjson = io.StringIO("\n".join(documents[:5]) + "\n\n" + "\n".join(documents[5:]) + "\n")
+        nodes = list(JSONSchemaObject.from_ndjson("node", ndjson, lazy=True))
+        self.assertEqual([node.to_json() for node in nodes], documents)
+        self.assertEqual(nodes[3].ports[0].callback._id, "cb3")
+
+        # objects and arrays can be pickled, so they can be converted on a process pool
+        node_1 = pickle.loads(pickle.dumps(nodes[3]))
+        self.assertIsInstance(node_1, Node)
+        self.assertEqual(node_1.get_parameter_by_key("visual").data["color"], "red")
+        self.assertEqual(node_1.to_json(), documents[3])
+
+        ndjson = io.BytesIO("\n".join(documents).encode())
+        nodes = list(JSONSchemaObject.from_ndjson("node", ndjson, processes=2, chunk_size=3))
+        self.assertTrue(all(isinstance(node, Node) for node in nodes))
+        self.assertEqual([node.to_json() for node in nodes], documents)
+
+    def test_schema_registry(self):
+
+        # references are resolved to interned canonical paths
+        self.assertEqual(JSONSchemaRegistry.resolve("node", "#/definitions/Port"), "node/definitions/port")
+        self.assertEqual(JSONSchemaRegistry.resolve("user", "role.json"), "role")
+        self.assertEqual(JSONSchemaRegistry.resolve("flow", "http://test.local/node.json#/definitions/port"), "node/definitions/port")
+        self.assertIs(JSONSchemaObject.get_schema("Node/Definitions/Port"), JSONSchemaObject.get_schema("node/definitions/port"))
+
+        self.assertEqual(JSONSchemaRegistry.dependencies("node"), {"callback"})
+        self.assertEqual(JSONSchemaRegistry.dependencies("user"), {"role"})
+        self.assertEqual(JSONSchemaRegistry.dependencies("callback"), set())
+
+        with self.assertRaises(JSONSchemaException):
+            JSONSchemaObject.get_schema("node/definitions/unknown")
+        with self.assertRaises(JSONSchemaException):
+            JSONSchemaObject.get_schema("telemetry/definitions/unknown")
+
+        # the schemas referenced by a retrieved schema are retrieved together
+        with tempfile.TemporaryDirectory() as folder:
+            os.mkdir(os.path.join(folder, "latest"))
+            for name, schema in (
+                    ("sensor", {"$id": "http://test.local/sensor.json", "type": "object",
+                                "properties": {"unit": {"$ref": "http://test.local/unit.json"}}}),
+                    ("unit", {"type": "object", "properties": {"name": {"type": "string"}}})):
+                with open(os.path.join(folder, "latest", name + ".json"), "w") as schema_file:
+                    json.dump(schema, schema_file)
+
+            schemas_url = JSONSchemaObject._schemas_url
+            JSONSchemaObject.set_schemas_location("file://" + folder)
+            try:
+                JSONSchemaObject.get_schema("sensor")
+                self.assertIn("unit", JSONSchemaObject._schemas_cache)
+            finally:
+                JSONSchemaObject.set_schemas_location(schemas_url)
+
+        sensor = JSONSchemaObject(schema_name="sensor", unit={"name": "celsius"})
+        self.assertEqual(sensor.unit.name, "celsius")
+
+    def test_schema_bundle(self):
+
+        schemas_url = JSONSchemaObject._schemas_url
+        with tempfile.TemporaryDirectory() as folder:
+            os.mkdir(os.path.join(folder, "v1"))
+            for name, schema in (
+                    ("gauge", {"$id": "http://test.local/gauge.json", "type": "object",
+                               "properties": {"name": {"type": "string"},
+                                              "scale": {"$ref": "scale.json"},
+                                              "marks": {"type": "array", "items": {"$ref": "#/definitions/mark"}}},
+                               "definitions": {"mark": {"type": "object", "properties": {"value": {"type": "number"}}}}}),
+                    ("scale", {"type": "object", "properties": {"min": {"type": "number"}, "max": {"type": "number"}}})):
+                with open(os.path.join(folder, "v1", name + ".json"), "w") as schema_file:
+                    json.dump(schema, schema_file)
+
+            bundle_path = os.path.join(folder, "v1.bundle")
+            try:
+                JSONSchemaObject.set_schemas_location("file://" + folder, "v1")
+                self.assertEqual(JSONSchemaObject.bundle_schemas(bundle_path), ["gauge", "scale"])
+
+                # the schema files are not needed anymore
+                os.remove(os.path.join(folder, "v1", "gauge.json"))
+                os.remove(os.path.join(folder, "v1", "scale.json"))
+                self.assertEqual(JSONSchemaObject.preload_schemas(bundle_path), ["gauge", "scale"])
+                self.assertIsNotNone(JSONSchemaObject.compile_model("gauge")._plan)
+                self.assertEqual(JSONSchemaRegistry.dependencies("gauge"), {"scale"})
+
+                gauge = JSONSchemaObject(schema_name="gauge", name="g1", scale={"max": 10.0})
+                gauge.marks.append(value=5.0)
+                self.assertEqual(gauge.scale.max, 10.0)
+                self.assertEqual(gauge.marks[0].value, 5.0)
+
+                JSONSchemaObject.set_schemas_location("file://" + folder, "v2")
+                with self.assertRaises(JSONSchemaException):
+                    JSONSchemaObject.preload_schemas(bundle_path)
+
+                # every reference must be available
+                os.mkdir(os.path.join(folder, "v2"))
+                with open(os.path.join(folder, "v2", "probe.json"), "w") as schema_file:
+                    json.dump({"type": "object", "properties": {"gauge": {"$ref": "meter.json"}}}, schema_file)
+                with self.assertRaises(JSONSchemaException):
+                    JSONSchemaObject.bundle_schemas(bundle_path)
+            finally:
+                JSONSchemaObject.set_schemas_location(schemas_url)
+
+    def test_schema_http_retrieval(self):
+
+        files = {
+            "/schemas/v1/meter.json": {"type": "object", "properties": {
+                "name": {"type": "string"},
+                "unit": {"$ref": "http://test.local/unit.json"},
+                "range": {"$ref": "range.json"}}},
+            "/schemas/v1/unit.json": {"type": "object", "properties": {"name": {"type": "string"}}},
+            "/schemas/v1/range.json": {"type": "object", "properties": {"max": {"type": "number"}}}
+        }
+        requests = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                requests.append((self.path, self.headers.get("If-None-Match")))
+                if self.path not in files:
+                    self.send_error(404)
+                    return
+
+                body = json.dumps(files[self.path]).encode()
+                etag = '"{}"'.format(hash(body))
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        schemas_url = JSONSchemaObject._schemas_url
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                JSONSchemaObject.set_schemas_location("http://127.0.0.1:{}/schemas".format(server.server_port), "v1")
+                JSONSchemaObject.set_schemas_http_cache(folder, max_age=60)
+
+                # the referenced schemas are downloaded together
+                meter = JSONSchemaObject(schema_name="meter", name="m1", unit={"name": "volt"}, range={"max": 5.0})
+                self.assertEqual(meter.unit.name, "volt")
+                self.assertEqual(sorted(path for path, _ in requests), sorted(files))
+                self.assertEqual(len(os.listdir(folder)), 3)
+
+                # a fresh copy is used without requesting the server, even
+                # by another process sharing the folder
+                JSONSchemaObject._schemas_http_cache.clear()
+                self.assertEqual(JSONSchemaObject._download_schema("meter"), files["/schemas/v1/meter.json"])
+                self.assertEqual(len(requests), 3)
+
+                # a stale copy is revalidated
+                JSONSchemaObject.set_schemas_http_cache(folder, max_age=0)
+                self.assertEqual(JSONSchemaObject._download_schema("meter"), files["/schemas/v1/meter.json"])
+                self.assertEqual(len(requests), 4)
+                self.assertIsNotNone(requests[-1][1])
+
+                files["/schemas/v1/meter.json"]["properties"]["serial"] = {"type": "string"}
+                self.assertIn("serial", JSONSchemaObject._download_schema("meter")["properties"])
+
+                with self.assertRaises(JSONSchemaException):
+                    JSONSchemaObject._download_schema("missing")
+
+                # without server the cached copy is used
+                server.shutdown()
+                server.server_close()
+                self.assertIn("serial", JSONSchemaObject._download_schema("meter")["properties"])
+        finally:
+            server.shutdown()
+            JSONSchemaObject.set_schemas_location(schemas_url)
+            JSONSchemaObject.set_schemas_http_cache()
+
+    def test_query(self):
+
+        node = Node(name="node1")
+        node.append_port(name="port1", direction="in", callback={"_id": "cb1", "code": "pass"})
+        node.append_port(name="port2", direction="out", callback={"_id": "cb2", "code": "pass"})
+        node.append_parameter(name="visual", data={"color": "red"})
+        plain = json.loads(node.to_json())
+
+        # same values as jsonpath on the json of the object
+        for jpath in ("$.name", "$.ports[*].name", "$.ports[-1].callback._id", "$.ports[0:1].direction",
+                      "$..name", "$..callback._id", "$.parameters[*].data.color", "$.*", "$.ports[5].name",
+                      '$.ports[direction = "out"].name'):
+            values = json.loads(JSONSchemaObject.JSONSchemaEncoder().encode(node.query(jpath)))
+            self.assertEqual(values, parse(jpath).find(plain), jpath)
+
+        # objects are returned, not copies
+        self.assertIs(node.query("$.ports[1].callback")[0], node.ports[1].callback)
+        self.assertIs(JSONSchemaObject.query(node.ports, "$[0]")[0], node.ports[0])
+
+        # lazy objects are materialized when traversed
+        node_1 = JSONSchemaObject.from_json("node", node.to_json(), lazy=True)
+        self.assertEqual(node_1.query("$.ports[*].callback._id"), ["cb1", "cb2"])
+
+        # the values of tuples are flat, as in the json
+        telemetry = JSONSchemaObject(schema_name="telemetry", name="imu")
+        for i in range(3):
+            telemetry.points.append(float(i), float(-i))
+            telemetry.flags.append(i % 2 == 0)
+        plain = json.loads(telemetry.to_json())
+        for jpath in ("$.points[1]", "$.points[*]", "$.points[1:4]", "$..points", "$.flags[*]", "$.*"):
+            values = json.loads(JSONSchemaObject.JSONSchemaEncoder().encode(telemetry.query(jpath)))
+            self.assertEqual(values, parse(jpath).find(plain), jpath)
+        self.assertEqual(telemetry.query("$.points[@ > 1]"), parse("$.points[@ > 1]").find(plain))
+
+        self.assertIs(JSONSchemaQuery.compile("$..name"), JSONSchemaQuery.compile("$..name"))
+        self.assertEqual(JSONSchemaObject.get_attr_schema("node", "$.properties.name.type"), ["string"])
+
+    def test_validation(self):
+
+        # draft-07 keywords
+        for schema, valid, invalid in (
+                ({"type": ["string", "null"]}, [None, "a"], [1]),
+                ({"type": "integer", "minimum": 1, "exclusiveMaximum": 3}, [1, 2, 2.0], [0, 3, True, 1.5]),
+                ({"type": "number", "multipleOf": 0.5}, [1.5, 2], [1.2]),
+                ({"multipleOf": 0.1}, [0.3, 0.7, 3], [0.35]),
+                ({"multipleOf": 3}, [9, 3 * 2 ** 60], [10, 3 * 2 ** 60 + 1]),
+                ({"type": "string", "minLength": 2, "maxLength": 3, "pattern": "^[a-z]+$"}, ["ab", "abc"], ["a", "abcd", "AB"]),
+                ({"type": "string", "format": "date-time"}, ["2020-01-01T10:00:00Z"], ["2020-01-01"]),
+                ({"enum": [1, "a", None]}, [1, 1.0, "a", None], [True, "b"]),
+                ({"const": {"a": [1]}}, [{"a": [1]}], [{"a": [True]}, {}]),
+                ({"type": "array", "items": {"type": "integer"}, "minItems": 1, "uniqueItems": True}, [[1, 2]], [[], [1, 1], [1, "a"]]),
+                ({"type": "array", "contains": {"const": 2}}, [[1, 2]], [[1]]),
+                ({"type": "object", "required": ["a"], "properties": {"a": {"type": "string"}},
+                  "additionalProperties": False}, [{"a": "x"}], [{}, {"a": 1}, {"a": "x", "b": 1}]),
+                ({"patternProperties": {"^x-": {"type": "integer"}}, "propertyNames": {"maxLength": 3}}, [{"x-a": 1}], [{"x-a": "1"}, {"abcd": 1}]),
+                ({"dependencies": {"a": ["b"]}}, [{"a": 1, "b": 2}, {"b": 2}], [{"a": 1}]),
+                ({"oneOf": [{"type": "integer"}, {"minimum": 2}]}, [1, 2.5], [3, 1.5]),
+                ({"anyOf": [{"type": "string"}, {"type": "null"}], "not": {"const": ""}}, ["a", None], ["", 1]),
+                ({"if": {"type": "integer"}, "then": {"minimum": 1}, "else": {"type": "string"}}, [1, "a"], [0, None])):
+            validator = JSONSchemaValidator.compile(schema, "node")
+            for value in valid:
+                validator(value)
+            for value in invalid:
+                with self.assertRaises(JSONSchemaValidationError, msg="{} {}".format(schema, value)):
+                    validator(value)
+
+        node = Node(name="node1")
+        node.append_port(name="port1", direction="in")
+
+        # strict validates every assignment
+        with self.assertRaises(JSONSchemaValidationError) as error:
+            node.ports[0].direction = "up"
+        self.assertEqual(error.exception.path, "/direction")
+        self.assertEqual(error.exception.keyword, "enum")
+        with self.assertRaises(ValueError):
+            node.append_port(name="port2", direction="up")
+        self.assertEqual(len(node.ports), 1)
+
+        db = DatabaseLayer(drv=NullDriver())
+        try:
+            # deferred validates the whole object before storing it
+            JSONSchemaObject.set_validation_mode("deferred")
+            node.ports[0].direction = "up"
+            node.append_port(name="port2", direction="up")
+            with self.assertRaises(JSONSchemaValidationError) as error:
+                db.store(node)
+            self.assertEqual(error.exception.path, "/ports/0/direction")
+
+            node.ports[0].direction = "in"
+            node.ports[1].direction = "out"
+            node.validate()
+            db.store(node)
+
+            # trusted skips all the validations
+            JSONSchemaObject.set_validation_mode("trusted")
+            node.ports[0].direction = 5
+            with self.assertRaises(JSONSchemaValidationError):
+                node.validate()
+        finally:
+            JSONSchemaObject.set_validation_mode("strict")
+
+        with self.assertRaises(ValueError):
+            JSONSchemaObject.set_validation_mode("none")
+
+        # the defaults of the attributes not set are not validated, the
+        # invalid ones are not written so the objects can read their own json
+        node = Node(name="node1")
+        node.append_port(name="port1")
+        node.validate()
+        self.assertNotIn("direction", json.loads(node.to_json())["ports"][0])
+        self.assertEqual(JSONSchemaObject.from_json("node", node.to_json()).to_json(), node.to_json())
+
+        # but the values passed or assigned are, even if equal to the default
+        JSONSchemaObject.set_schema("limits", {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string", "minLength": 1},
+                "kind": {"type": "string", "enum": ["a", "b"]},
+                "count": {"type": "integer", "minimum": 1}}})
+        JSONSchemaObject(schema_name="limits").validate()
+        for values in ({"count": 0}, {"name": ""}, {"kind": ""}):
+            with self.assertRaises(JSONSchemaValidationError):
+                JSONSchemaObject(schema_name="limits", **values)
+            with self.assertRaises(JSONSchemaValidationError):
+                JSONSchemaObject.from_json("limits", values)
+        limits = JSONSchemaObject(schema_name="limits")
+        with self.assertRaises(JSONSchemaValidationError):
+            limits.count = 0
+        try:
+            JSONSchemaObject.set_validation_mode("deferred")
+            for values in ({"count": 0}, {"name": "", "kind": ""}):
+                with self.assertRaises(JSONSchemaValidationError):
+                    JSONSchemaObject(schema_name="limits", **values).validate()
+            limits.name = ""
+            with self.assertRaises(JSONSchemaValidationError):
+                limits.validate()
+        finally:
+            JSONSchemaObject.set_validation_mode("strict")
+
+        # the required attributes must be set or loaded
+        JSONSchemaObject.set_schema("account", {
+            "type": "object",
+            "required": ["login", "password"],
+            "properties": {"login": {"type": "string"}, "password": {"type": "string"}}})
+        account = JSONSchemaObject(schema_name="account", login="user1")
+        with self.assertRaises(JSONSchemaValidationError) as error:
+            account.validate()
+        self.assertEqual(error.exception.keyword, "required")
+        account.password = "secret"
+        account.validate()
+        JSONSchemaObject.from_json("account", account.to_json()).validate()
+        with self.assertRaises(JSONSchemaValidationError):
+            JSONSchemaObject.from_json("account", {"login": "user1"}, trusted=True).validate()
+
+    def test_validate_many(self):
+
+        JSONSchemaObject.set_schema("reading", {
+            "type": "object",
+            "required": ["sensor", "value"],
+            "properties": {
+                "sensor": {"type": "string", "minLength": 1},
+                "unit": {"type": "string", "enum": ["C", "F"]},
+                "value": {"type": "number", "minimum": -50, "exclusiveMaximum": 150},
+                "count": {"type": "integer", "multipleOf": 2},
+                "tags": {"type": "array", "items": {"type": "string"}}
+            }
+        })
+
+        documents = [
+            {"sensor": "s1", "unit": "C", "value": 20.5, "count": 2, "tags": ["a"]},   # valid
+            {"sensor": "s1", "value": 20},                                            # valid
+            {"value": 20},                                                            # required
+            {"sensor": "s1", "value": "20"},                                          # type
+            {"sensor": "s1", "value": 150},                                           # exclusiveMaximum
+            {"sensor": "s1", "value": -51.0},                                         # minimum
+            {"sensor": "s1", "value": 1, "unit": "K"},                                # enum
+            {"sensor": "s1", "value": 1, "count": 3},                                 # multipleOf
+            {"sensor": "s1", "value": 1, "count": 2.5},                               # integer
+            {"sensor": "", "value": 1},                                               # minLength
+            {"sensor": "s1", "value": 1, "tags": ["a", 1]},                           # items
+            '{"sensor": "s1", "value": true}',                                        # json, type
+            '{"sensor": "s1", "value": 3}',                                           # json, valid
+            ["sensor"],                                                               # not an object
+        ] * 100
+
+        bitmap = JSONSchemaObject.validate_many("reading", documents)
+        self.assertEqual(len(bitmap), (len(documents) + 7) // 8)
+        self.assertEqual(JSONSchemaValidator.invalid(bitmap)[:12], [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13, 16])
+
+        # the same documents as the full validator
+        validator = JSONSchemaValidator.get("reading")
+        for i in JSONSchemaValidator.invalid(bitmap)[:12]:
+            document = json.loads(documents[i]) if isinstance(documents[i], str) else documents[i]
+            with self.assertRaises(JSONSchemaValidationError):
+                validator(document)
+
+        # nested objects are validated by their schema
+        port = {"name": "port1", "direction": "in", "callback": {"_id": "cb1", "code": "pass"}}
+        bitmap = JSONSchemaObject.validate_many("node/definitions/port", [port, dict(port, direction="up"), dict(port, callback=[])])
+        self.assertEqual(JSONSchemaValidator.invalid(bitmap), [1, 2])
+
+    @unittest.skipIf(numpy is None, "numpy is not available")
+    def test_validate_many_numpy(self):
+
+        JSONSchemaObject.set_schema("sample", {
+            "type": "object",
+            "properties": {
+                "value": {"type": "number", "minimum": -1, "multipleOf": 0.1},
+                "count": {"type": "integer", "maximum": 2 ** 53}
+            }
+        })
+
+        documents = [
+            {"value": 0.3, "count": 2 ** 53},       # valid
+            {"value": 0.7, "count": 1},             # valid
+            {"value": 0.35},                        # multipleOf
+            {"value": -1.5},                        # minimum
+            {"value": float("inf")},                # multipleOf
+            {"count": 2 ** 53 + 1},                 # maximum, not exact as float64
+        ] * 200
+
+        bitmap = JSONSchemaObject.validate_many("sample", documents, use_numpy=True)
+        self.assertEqual(JSONSchemaValidator.invalid(bitmap)[:4], [2, 3, 4, 5])
+        self.assertEqual(bitmap, JSONSchemaObject.validate_many("sample", documents))
+
+    def test_dirty_tracking(self):
+
+        class RecordingDriver(NullDriver):
+            def save(self, obj_list, indexed_attrs):
+                self.saved = obj_list
+                self.indexed = indexed_attrs
+                return super().save(obj_list, [])
+
+        def changes(schema_path):
+            return [obj[3] if len(obj) > 3 else None
+                    for obj in drv.saved if obj[0] == schema_path]
+
+        drv = RecordingDriver()
+        db = DatabaseLayer(drv=drv)
+
+        node = Node(name="node1")
+        node.append_port(name="port1", direction="in", callback={"_id": "cb1", "code": "pass"})
+        db.store(node)
+
+        # new objects are written in full
+        self.assertEqual(changes("node"), [None])
+        self.assertEqual(changes("callback"), [None])
+
+        node.name = "node2"
+        node.ports[0].direction = "out"
+        node.append_port(name="port2", direction="in")
+        db.store(node)
+        node_changes = changes("node")[0]
+        self.assertEqual(node_changes[:2], [
+            ("set", ("name",), "node2"), ("set", ("ports", 0, "direction"), "out")])
+        self.assertEqual(node_changes[2][:2], ("append", ("ports",)))
+        self.assertEqual([port["name"] for port in node_changes[2][2]], ["port2"])
+
+        # unchanged objects are not written, only the new callback of port2
+        self.assertEqual(changes("callback"), [None])
+
+        # related objects are written on their own
+        node.ports[0].callback.code = "print()"
+        db.store(node)
+        self.assertEqual(changes("node"), [])
+        self.assertEqual(changes("callback"), [[("set", ("code",), "print()")]])
+
+        # deleted items shift the indexes, the whole array is written
+        node.remove_port(0)
+        db.store(node)
+        self.assertEqual([(c[0], c[1]) for c in changes("node")[0]], [("set", ("ports",))])
+        self.assertEqual(len(changes("node")[0][0][2]), 1)
+
+        # a new key is a new document
+        node.version = "1.1"
+        db.store(node)
+        self.assertEqual(changes("node"), [None])
+        self.assertEqual(drv.saved[-1][1], "{}:1.1".format(node.id))
+
+        # loaded objects only write what changed
+        loaded = JSONSchemaObject.from_json("node", node.to_json(), trusted=True)
+        JSONSchemaObject._track(loaded)
+        loaded.ports[0].protocol = "ros2"
+        loaded.get_port(0).tags.append(name="t", value="v")
+        db.store(loaded)
+        self.assertEqual(changes("node"), [[
+            ("set", ("ports", 0, "protocol"), "ros2"),
+            ("append", ("ports", 0, "tags"), [{"name": "t", "value": "v"}])]])
+        self.assertEqual(drv.indexed, [])
+
+        # a tuple which is not valid changes nothing
+        telemetry = JSONSchemaObject(schema_name="telemetry", name="t1")
+        telemetry.points.append(1.0, 2.0)
+        JSONSchemaObject._track(telemetry)
+        with self.assertRaises(ValueError):
+            telemetry.points[0] = [5.0, "x"]
+        self.assertEqual(telemetry.points[0], [1.0, 2.0])
+        self.assertEqual(telemetry.points._changes[1], set())
+
+        self.assertEqual(RedisDriver._path(("ports", 0, "my tag")).strPath, '.ports[0]["my tag"]')
+        self.assertEqual(RedisDriver._path(()).strPath, ".")
+
+    def test_patch(self):
+
+        node = Node(name="node1")
+        node.append_port(name="port1", direction="in")
+        node.append_parameter(name="a", data={"x": 1})
+        node.append_parameter(name="b", data={"x": 2})
+        node.append_parameter(name="c", data={"x": 3})
+
+        other = JSONSchemaObject.from_json("node", node.to_json())
+        self.assertEqual(node.diff(other), [])
+
+        # keyed arrays are compared by key, not by position
+        other.name = "node/2"
+        other.ports[0].direction = "out"
+        other.remove_parameter_by_key("a")
+        other.get_parameter_by_key("c").data = {"x": 3, "y": [1]}
+        other.append_parameter(name="d")
+        other.append_parameter(name="b", data={"x": 2})
+        other.remove_parameter(0)
+
+        patch = node.diff(other)
+        self.assertEqual(patch, [
+            {"op": "replace", "path": "/name", "value": "node/2"},
+            {"op": "remove", "path": "/parameters/0"},
+            {"op": "move", "from": "/parameters/1", "path": "/parameters/0"},
+            {"op": "add", "path": "/parameters/0/data/y", "value": [1]},
+            {"op": "add", "path": "/parameters/1", "value": {"name": "d", "data": {}}},
+            {"op": "replace", "path": "/ports/0/direction", "value": "out"}])
+
+        # the patch is plain json and can be replayed
+        patched = node.apply_patch(json.loads(json.dumps(patch)))
+        self.assertIsInstance(patched, Node)
+        self.assertEqual(patched.to_json(), other.to_json())
+        self.assertEqual(node.name, "node1")
+        self.assertEqual(patched.diff(other), [])
+
+        # the patched object is validated
+        with self.assertRaises(JSONSchemaValidationError):
+            node.apply_patch([{"op": "replace", "path": "/ports/0/direction", "value": "up"}])
+
+        # the attributes holding their default are not validated
+        node = Node(name="node1")
+        node.append_port(name="port1")
+        patched = node.apply_patch([{"op": "replace", "path": "/name", "value": "node2"}])
+        self.assertEqual(patched.name, "node2")
+        self.assertEqual(patched.ports[0].direction, "")
+
+        # the pointers of tuples are the ones of their flat json
+        telemetry = JSONSchemaObject(schema_name="telemetry", name="imu")
+        for i in range(3):
+            telemetry.points.append(float(i), float(-i))
+        document = json.loads(telemetry.to_json())
+        changed = json.loads(telemetry.to_json())
+        changed["points"][3] = 5.0
+        other = JSONSchemaObject.from_json("telemetry", changed)
+        patch = telemetry.diff(other)
+        self.assertEqual(patch, [{"op": "replace", "path": "/points/3", "value": 5.0}])
+        self.assertEqual(JSONSchemaPatch.apply(document, patch), changed)
+        self.assertEqual(telemetry.apply_patch(patch).to_json(), other.to_json())
+
+        document = {"a~b": [1, 2, 3], "c": {"d": True}}
+        self.assertEqual(JSONSchemaPatch.apply(document, [
+            {"op": "test", "path": "/a~0b/1", "value": 2},
+            {"op": "add", "path": "/a~0b/-", "value": 4},
+            {"op": "copy", "from": "/c", "path": "/e"},
+            {"op": "move", "from": "/c/d", "path": "/c~1d"},
+            {"op": "remove", "path": "/a~0b/0"}]),
+            {"a~b": [2, 3, 4], "c": {}, "c/d": True, "e": {"d": True}})
+
+        for operation in (
+                {"op": "test", "path": "/e/d", "value": 1},
+                {"op": "remove", "path": "/x"},
+                {"op": "add", "path": "/a~0b/9", "value": 1},
+                {"op": "replace", "path": "/a~0b/01", "value": 1},
+                {"op": "move", "from": "/c", "path": "/c/x"},
+                {"op": "undo", "path": "/c"}):
+            with self.assertRaises(ValueError):
+                JSONSchemaPatch.apply(document, [operation])
+
+    def test_binary_codec(self):
+
+        node = Node(name="node \u00e9")
+        node.append_port(name="port1", direction="in", callback={"_id": "cb1", "_name": "cb", "code": "pass"})
+        node.append_parameter(name="visual", data={"ratio": 0.5, "n": -300, "list": [None, True]})
+
+        data = node.to_bytes()
+        self.assertLess(len(data), len(node.to_json()) // 2)
+
+        node_1 = JSONSchemaObject.from_bytes(data)
+        self.assertIsInstance(node_1, Node)
+        self.assertIsInstance(node_1.ports[0].callback, JSONSchemaObject)
+        self.assertEqual(node_1.to_json(), node.to_json())
+        self.assertEqual(node_1.get_parameter_by_key("visual").data["n"], -300)
+
+        # typed arrays are written as their storage
+        telemetry = JSONSchemaObject(schema_name="telemetry", name="t1")
+        telemetry.samples.extend([1.5, float("inf"), -0.0])
+        telemetry.counters.extend([1, -2, 2**40])
+        telemetry.flags.extend([True, False])
+        telemetry.points.extend([(1.0, 2.0), (3.0, 4.0)])
+        telemetry_1 = JSONSchemaObject.from_bytes(telemetry.to_bytes())
+        self.assertEqual(telemetry_1.to_json(), telemetry.to_json())
+        self.assertEqual(telemetry_1.samples.__array__.typecode, "d")
+
+        # the kinds of the arrays of a schema registered again are compiled again
+        self.assertNotEqual(JSONSchemaCodec._kinds, {})
+        JSONSchemaObject.set_schema("telemetry", schema_telemetry)
+        self.assertEqual(JSONSchemaCodec._kinds, {})
+        self.assertEqual(JSONSchemaObject.from_bytes(telemetry.to_bytes()).to_json(), telemetry.to_json())
+
+        # the json of the database, with its references
+        json = {"name": "node1", "ports": [{"name": "port1", "callback": "ref:callback:cb1:latest"}]}
+        data = JSONSchemaCodec.encode_json("node", json)
+        self.assertIn(b"callback", data)
+        self.assertNotIn(b"ref:", data)
+        self.assertEqual(JSONSchemaCodec.decode(data, json=True), json)
+
+        with self.assertRaises(ValueError):
+            JSONSchemaCodec.decode(b"\x09node")
+
+        class FakeClient(object):
+            def __init__(self):
+                self.data = {}
+            def get(self, name):
+                return self.data.get(name)
+            def set(self, name, value):
+                self.data[name] = value
+            def mget(self, names):
+                return [self.data.get(name) for name in names]
+            def register_script(self, script):
+                def run(keys, args):
+                    # the binary writes of the save script are all SET
+                    arg = args[0] + 1
+                    while arg < len(args):
+                        self.data[keys[args[arg + 2] - 1]] = args[arg + 3]
+                        arg += args[arg] + 2
+                    return 0
+                return run
+
+        drv = RedisDriver.__new__(RedisDriver)
+        drv._client = drv._binary = FakeClient()
+        drv.partial_writes = False
+        db = DatabaseLayer(drv=drv)
+        db.store(node)
+
+        ref = "node:{}:latest".format(node.id)
+        self.assertIsInstance(drv._binary.data[ref], bytes)
+        self.assertEqual(db.find_by_ref("node", "{}:latest".format(node.id))["ports"][0]["callback"],
+                         "ref:callback:cb1:latest")
+
+        # the changed objects are written whole, without reading them first
+        node.name = "node2"
+        node.append_port(name="port2", direction="out", callback={"_name": "cb2"})
+        drv._binary.mget = None
+        db.store(node)
+        del drv._binary.mget
+        json = drv.find_by_ref(ref)
+        self.assertEqual(json["name"], "node2")
+        self.assertEqual([port["name"] for port in json["ports"]], ["port1", "port2"])
+
+        # binary documents can't be changed in place
+        with self.assertRaises(ValueError):
+            drv.save([["node", "{}:latest".format(node.id), None, [("set", ("name",), "node3")]]], [])
+
+    def test_compact_records(self):
+
+        node = Node(name="node1")
+        node.append_port(name="port1", direction="in", callback={"_id": "cb1", "code": "pass"})
+        node.append_parameter(name="visual", data={"color": "red"})
+        node_json = node.to_json()
+
+        JSONSchemaObject.set_compact("node")
+        try:
+            compact = JSONSchemaObject.from_json("node", node_json)
+            self.assertIsInstance(compact, Node)
+            self.assertNotIsInstance(compact.__attrs__, dict)
+            self.assertNotIsInstance(compact.ports[0].__attrs__, dict)
+            self.assertLess(sys.getsizeof(compact.ports[0].__attrs__), sys.getsizeof(node.ports[0].__attrs__))
+
+            # the objects of a model share the key table
+            self.assertIs(compact.__attrs__._keys, Node(name="node2").__attrs__._keys)
+
+            self.assertEqual(compact.to_json(), node_json)
+            self.assertEqual(json.dumps(compact, cls=JSONSchemaObject.JSONSchemaEncoder), node_json)
+            self.assertEqual(compact.ports[0].callback.code, "pass")
+            compact.ports[0].direction = "out"
+            compact.id = "n1"
+            self.assertEqual(compact.ports[0].direction, "out")
+            self.assertEqual(compact.query("$.ports[*].direction"), ["out"])
+            with self.assertRaises(JSONSchemaValidationError):
+                compact.ports[0].direction = "up"
+
+            self.assertEqual(pickle.loads(pickle.dumps(compact)).to_json(), compact.to_json())
+            self.assertEqual(JSONSchemaObject.from_bytes(compact.to_bytes()).to_json(), compact.to_json())
+            self.assertEqual(node.diff(compact), [
+                {"op": "replace", "path": "/_id", "value": "n1"},
+                {"op": "replace", "path": "/ports/0/direction", "value": "out"}])
+
+            relations = DatabaseLayer._extract_relations(compact)
+            self.assertEqual(relations[2]["ports"][0]["callback"], "ref:callback:cb1:latest")
+        finally:
+            JSONSchemaObject.set_compact("node", False)
+
+        self.assertIsInstance(Node().__attrs__, dict)
+
+    def test_find_all_by_batched(self):
+
+        class MemoryDriver(NullDriver):
+            def __init__(self):
+                self.data = {}
+                self.indexes = {}
+                self.round_trips = []
+
+            def find_by_ref(self, ref):
+                data = self.data.get(ref)
+                return None if data is None else json.loads(json.dumps(data))
+
+            def find_by_refs(self, refs):
+                self.round_trips.append(list(refs))
+                return super().find_by_refs(refs)
+
+            def find_id_by(self, idx, value, version):
+                return sorted(self.indexes.get("{}:{}".format(idx, value), ()))
+
+            def save(self, obj_list, indexed_attrs):
+                for obj in obj_list:
+                    self.data["{}:{}".format(obj[0], obj[1])] = obj[2]
+                for obj in indexed_attrs:
+                    key = "{}:indexes:{}:{}".format(obj[0], obj[1], obj[2])
+                    self.indexes.setdefault(key, set()).add(obj[3])
+                return []
+
+        drv = MemoryDriver()
+        db = DatabaseLayer(drv=drv)
+
+        callback = {"_id": "cb1", "code": "pass"}
+        node = Node(name="node1")
+        node.append_port(name="port1", direction="in", callback=callback)
+        node.append_port(name="port2", direction="out", callback=callback)
+        db.store(node)
+
+        # one round trip per level, the shared callback is fetched once
+        loaded = db.find_all_by("node", "id", node.id)
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual(drv.round_trips, [
+            ["node:{}:latest".format(node.id)], ["callback:cb1:latest"]])
+        ports = loaded[0].ports
+        self.assertEqual([port.callback.code for port in ports], ["pass", "pass"])
+
+        # every place gets its own object
+        ports[0].callback.code = "print()"
+        self.assertEqual(ports[1].callback.code, "pass")
+
+        # missing references are None
+        del drv.data["callback:cb1:latest"]
+        loaded = db.find_all_by("node", "id", node.id)
+        self.assertIsNone(loaded[0].ports[0].callback)
+
+    def test_redis_save_script(self):
+
+        class FakeClient(object):
+            def __init__(self):
+                self.scripts = []
+                self.calls = []
+                self.violation = 0
+            def _encode(self, value):
+                return json.dumps(value)
+            def register_script(self, script):
+                self.scripts.append(script)
+                def run(keys, args):
+                    self.calls.append((keys, args))
+                    return self.violation
+                return run
+
+        def commands(keys, args):
+            result = []
+            arg = args[0] + 1
+            while arg < len(args):
+                argc = args[arg]
+                result.append((args[arg + 1], keys[args[arg + 2] - 1]) + tuple(args[arg + 3:arg + argc + 2]))
+                arg += argc + 2
+            return result
+
+        drv = RedisDriver.__new__(RedisDriver)
+        drv._client = FakeClient()
+        db = DatabaseLayer(drv=drv)
+
+        node = Node(name="node1")
+        node.append_port(name="port1", direction="in", callback={"_id": "cb1", "_name": "c1", "code": "pass"})
+        node.append_port(name="port2", direction="out", callback={"_id": "cb2", "_name": "c2", "code": "pass"})
+        db.store(node)
+
+        # the whole graph is checked and written by a single script call
+        self.assertEqual(len(drv._client.scripts), 1)
+        self.assertEqual(len(drv._client.calls), 1)
+        keys, args = drv._client.calls[0]
+        self.assertEqual(sorted(zip(keys[:args[0]], args[1:args[0] + 1])), [
+            ("callback:indexes:_name:c1", "cb1:latest"), ("callback:indexes:_name:c2", "cb2:latest")])
+        self.assertEqual(sorted((c[0], c[1], c[2]) for c in commands(keys, args)), [
+            ("JSON.SET", "callback:cb1:latest", "."), ("JSON.SET", "callback:cb2:latest", "."),
+            ("JSON.SET", "node:{}:latest".format(node.id), ".")])
+
+        # partial writes are commands of the same call
+        node.name = "node2"
+        node.append_port(name="port3", direction="in", callback={"_name": "c4"})
+        db.store(node)
+        self.assertEqual(len(drv._client.calls), 2)
+        node_commands = [c for c in commands(*drv._client.calls[1]) if c[1].startswith("node:")]
+        self.assertEqual(node_commands[0], ("JSON.SET", "node:{}:latest".format(node.id), ".name", '"node2"'))
+        self.assertEqual(node_commands[1][:3], ("JSON.ARRAPPEND", "node:{}:latest".format(node.id), ".ports"))
+
+        # the script reports the violated index
+        drv._client.violation = 1
+        other = Node(name="node3")
+        other.append_port(name="port1", direction="in", callback={"_id": "cb3", "_name": "c1", "code": "pass"})
+        with self.assertRaises(ValueError):
+            db.store(other)
+        self.assertEqual(len(drv._client.scripts), 1)
+
+    def test_store_many(self):
+
+        class RecordingDriver(NullDriver):
+            def __init__(self):
+                self.saves = []
+            def save(self, obj_list, indexed_attrs):
+                if any(obj[0] == "node" and obj[2] is not None and obj[2]["name"] == "bad"
+                       for obj in obj_list):
+                    raise ValueError("bad node")
+                self.saves.append((obj_list, indexed_attrs))
+                return [obj[1] for obj in obj_list]
+
+        drv = RecordingDriver()
+        db = DatabaseLayer(drv=drv)
+
+        callback = JSONSchemaObject.from_json("callback", {"_name": "shared", "code": "pass"})
+        nodes = []
+        for i in range(5):
+            node = Node(name="node{}".format(i))
+            node.append_port(name="port", direction="in", callback=callback)
+            nodes.append(node)
+
+        # the shared callback is written once by a single save
+        results = db.store_many(nodes)
+        self.assertEqual(len(drv.saves), 1)
+        obj_list, indexed_attrs = drv.saves[0]
+        self.assertEqual([obj[0] for obj in obj_list].count("callback"), 1)
+        self.assertEqual(len(obj_list), 6)
+        self.assertEqual(results[0], ["{}:latest".format(callback._id), "{}:latest".format(nodes[0].id)])
+
+        # the batches are saved on their own, unchanged objects are not written
+        nodes[0].name = "renamed"
+        drv.saves = []
+        results = db.store_many(nodes, batch_size=2)
+        self.assertEqual(len(drv.saves), 3)
+        self.assertEqual(results[1], ["{}:latest".format(nodes[1].id)])
+        self.assertEqual(drv.saves[0][0], [["node", "{}:latest".format(nodes[0].id), None,
+                                            [("set", ("name",), "renamed")]]])
+
+        # the failed objects don't abort the others
+        bad = Node(name="bad")
+        first = Node(name="first")
+        first.append_port(name="port", direction="in", callback={"_name": "dup", "code": "pass"})
+        conflict = Node(name="conflict")
+        conflict.append_port(name="port", direction="in", callback={"_name": "dup", "code": "pass"})
+        drv.saves = []
+        results = db.store_many([bad, first, conflict])
+        self.assertIsInstance(results[0], ValueError)
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual([[obj[1] for obj in obj_list] for obj_list, _ in drv.saves], [results[1]])
+        self.assertEqual(results[1][-1], "{}:latest".format(first.id))
+
+        # the documents written one by one are not cached anymore
+        cache = DatabaseCache()
+        db = DatabaseLayer(drv=drv, cache=cache)
+        first.name = "first1"
+        nodes[1].name = "renamed1"
+        refs = ["node:{}:latest".format(node.id) for node in (first, nodes[1])]
+        cache.put_many(refs, [{}, {}], cache.generation)
+        results = db.store_many([first, bad, nodes[1]])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(cache.get_many(refs), {})
+
+    def test_async_database_layer(self):
+
+        documents = {}
+        indexes = {}
+        commands = []
+
+        def reply(value):
+            if value is None:
+                return b"$-1\r\n"
+            if isinstance(value, int):
+                return b":%d\r\n" % value
+            if isinstance(value, Exception):
+                return b"-%s\r\n" % str(value).encode()
+            if isinstance(value, list):
+                return b"*%d\r\n" % len(value) + b"".join(map(reply, value))
+            return b"$%d\r\n%s\r\n" % (len(value), value.encode())
+
+        def run(command):
+            name = command[0].decode()
+            args = [arg.decode() for arg in command[1:]]
+            commands.append(name)
+            if name == "SMEMBERS":
+                return sorted(indexes.get(args[0], ()))
+            if name == "JSON.MGET":
+                return [documents.get(key) for key in args[:-1]]
+            if name == "EVALSHA":
+                return Exception("NOSCRIPT No matching script")
+
+            # the writes of the save script, the new objects are written whole
+            keys, argv = args[2:2 + int(args[1])], args[2 + int(args[1]):]
+            for i in range(int(argv[0])):
+                indexes.setdefault(keys[i], set()).add(argv[i + 1])
+            arg = int(argv[0]) + 1
+            while arg < len(argv):
+                documents[keys[int(argv[arg + 2]) - 1]] = argv[arg + 4]
+                arg += int(argv[arg]) + 2
+            return 0
+
+        async def serve(reader, writer):
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = []
+                for _ in range(int(line[1:])):
+                    length = int((await reader.readline())[1:])
+                    command.append((await reader.readexactly(length + 2))[:-2])
+                writer.write(reply(run(command)))
+                await writer.drain()
+            writer.close()
+
+        async def main():
+            server = await asyncio.start_server(serve, "127.0.0.1", 0)
+            drv = AsyncRedisDriver("127.0.0.1", server.sockets[0].getsockname()[1], pool_size=2)
+            db = AsyncDatabaseLayer(drv)
+
+            callback = {"_id": "cb1", "_name": "c1", "code": "pass"}
+            node = Node(name="node1")
+            node.append_port(name="port1", direction="in", callback=callback)
+            node.append_port(name="port2", direction="out", callback=callback)
+            ids = await db.store(node)
+            self.assertEqual(ids[-1], "{}:latest".format(node.id))
+            self.assertEqual(commands, ["EVALSHA", "EVAL"])
+
+            # the references are fetched a level at a time
+            indexes["node:indexes:_id:{}".format(node.id)] = {"{}:latest".format(node.id)}
+            del commands[:]
+            loaded = await db.find_one_by("node", "id", node.id)
+            self.assertEqual(commands, ["SMEMBERS", "JSON.MGET", "JSON.MGET"])
+            self.assertEqual([port.callback.code for port in loaded.ports], ["pass", "pass"])
+            self.assertIsNone(await db.find_one_by("node", "id", "missing"))
+
+            # a ref is a single object of the session
+            session = db.session()
+            await session.store(node)
+            del commands[:]
+            self.assertIs(await session.find_one_by("node", "id", node.id), node)
+            self.assertEqual(commands, ["SMEMBERS"])
+            session.clear()
+            loaded = await session.find_one_by("node", "id", node.id)
+            self.assertIsNot(loaded, node)
+            self.assertIs(loaded.ports[0].callback, loaded.ports[1].callback)
+            self.assertIs(await session.find_one_by("node", "id", node.id), loaded)
+
+            # the tasks share the connections of the pool
+            refs = await asyncio.gather(*(db.find_by_ref("callback", "cb1:latest") for _ in range(5)))
+            self.assertEqual([ref["code"] for ref in refs], ["pass"] * 5)
+            self.assertEqual(len(drv._pool._idle), 2)
+
+            await drv._pool.close()
+            server.close()
+            await server.wait_closed()
+
+        asyncio.run(main())
+
+    def test_identity_map_and_cache(self):
+
+        class MemoryDriver(NullDriver):
+            def __init__(self):
+                self.data = {}
+                self.indexes = {}
+                self.fetched = []
+
+            def find_by_ref(self, ref):
+                self.fetched.append(ref)
+                data = self.data.get(ref)
+                return None if data is None else json.loads(json.dumps(data))
+
+            def find_id_by(self, idx, value, version):
+                return sorted(self.indexes.get("{}:{}".format(idx, value), ()))
+
+            def save(self, obj_list, indexed_attrs):
+                for obj in obj_list:
+                    key = "{}:{}".format(obj[0], obj[1])
+                    if len(obj) > 3:
+                        self.data[key] = RedisDriver._apply_changes(self.data[key], obj[3])
+                    else:
+                        self.data[key] = obj[2]
+                for obj in indexed_attrs:
+                    key = "{}:indexes:{}:{}".format(obj[0], obj[1], obj[2])
+                    self.indexes.setdefault(key, set()).add(obj[3])
+                return []
+
+        drv = MemoryDriver()
+        cache = DatabaseCache(size=10)
+        db = DatabaseLayer(drv=drv, cache=cache)
+
+        callback = {"_id": "cb1", "code": "pass"}
+        node = Node(name="node1")
+        node.append_port(name="port1", direction="in", callback=callback)
+        node.append_port(name="port2", direction="out", callback=callback)
+
+        # a ref is a single object of the session
+        session = db.session()
+        session.store(node)
+        self.assertIs(session.find_one_by("node", "id", node.id), node)
+
+        # the related objects written by the store are in the session too
+        drv.fetched = []
+        self.assertIs(session.find_one_by("callback", "id", "cb1"), node.ports[0].callback)
+        self.assertEqual(drv.fetched, [])
+        session.clear()
+        loaded = session.find_one_by("node", "id", node.id)
+        self.assertIsNot(loaded, node)
+        self.assertIs(loaded.ports[0].callback, loaded.ports[1].callback)
+
+        # the objects of the session keep their changes
+        loaded.ports[0].callback.code = "print()"
+        drv.fetched = []
+        self.assertIs(session.find_one_by("node", "id", node.id), loaded)
+        self.assertEqual(drv.fetched, [])
+        loaded.ports[1].direction = "in"
+        session.store(loaded)
+        self.assertEqual(drv.data["callback:cb1:latest"]["code"], "print()")
+
+        # the cache is read through and invalidated by the writes
+        cache.clear()
+        db.find_one_by("node", "id", node.id)
+        drv.fetched = []
+        other = db.find_one_by("node", "id", node.id)
+        self.assertEqual(drv.fetched, [])
+        self.assertEqual([port.callback.code for port in other.ports], ["print()", "print()"])
+        self.assertEqual(cache.stats()["hits"], 2)
+
+        other.ports[0].callback.code = "pass"
+        db.store(other)
+        loaded = db.find_one_by("node", "id", node.id)
+        self.assertEqual(drv.fetched, ["callback:cb1:latest"])
+        self.assertEqual(loaded.ports[1].callback.code, "pass")
+        self.assertEqual(db.find_by_ref("callback", "cb1:latest")["code"], "pass")
+
+        small = DatabaseCache(size=1)
+        DatabaseLayer(drv=drv, cache=small).find_one_by("node", "id", node.id)
+        self.assertEqual(small.stats(), {"hits": 0, "misses": 2, "evictions": 1, "size": 1})
+
     def test_database_layer_nulldriver(self):
 
         # Define models by calling the class
@@ -776,4 +2230,5 @@ if __name__ == '__main__':
     JSONSchemaObject.set_schema("callback", schema_callback)
     JSONSchemaObject.set_schema("node", schema_node)
     JSONSchemaObject.set_schema("flow", schema_flow)
+    JSONSchemaObject.set_schema("telemetry", schema_telemetry)
     unittest.main()